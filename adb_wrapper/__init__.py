@@ -1,7 +1,11 @@
+import sys
 from .adb_wrapper import AdbWrapper
 from .adb_wrapper import AdbFailException
 from .adb_auto import AdbAuto
+from .adb_fleet import AdbFleet, run_all, push_many
 from .aapt_wrapper import AaptWrapper
 from .aapt_wrapper import AaptFailException
 from .fastboot_wrapper import FastbootWrapper
 from .fastboot_wrapper import FastbootFailException
+if sys.version_info >= (3, 6):
+    from .async_adb import AsyncAdbWrapper, AsyncAdbAuto
@@ -1,15 +1,192 @@
 # -*- coding: utf-8 -*-
 from datetime import datetime
+from collections import OrderedDict
+import os
 import re
+import time
+import stat
+import json
+import hashlib
+import posixpath
 
 from .adb_wrapper import AdbWrapper
-from .adb_wrapper import ADB_SERVER_PORT
+from .adb_wrapper import ADB_SERVER_PORT, ADB_SERVER_POOL_SIZE
 from .adb_wrapper import FILE_TRANSFORM_TIMEOUT
+from .adb_wrapper import SHELL_BATCH_SCRIPT_MAX
 from .adb_wrapper import BUGREPORT_TIMEOUT
 from .adb_wrapper import NOFILEORFOLDER, PERMISSION_DENY, READONLY, SHELL_FAILED
-from .adb_wrapper import AdbFailException, AdbConnectFail
+from .adb_wrapper import AdbFailException, AdbConnectFail, AdbNoDevice
+from .adb_wrapper import Lock, RLock
+from .adb_wrapper import ignored
+from .adb_wrapper import _to_unicode, _shell_quote
 from .intent import Intent
 
+DEVICE_STATE_TTL = 5  # Default seconds connect_auto trust last connection check of device, 0 to disable
+GETPROP_TTL = 2  # Default seconds getprop snapshot serve mutable keys, and ro.* keys without boot_id check
+BOOT_ID_FILE = u'/proc/sys/kernel/random/boot_id'  # Changed on every boot
+STAT_FORMAT = u'%f %s %Y %U %G %C %n'  # stat -c format of file_stat_many: raw mode(hex) size mtime owner group context name
+HASH_READ_SIZE = 1024 * 1024  # Bytes read once when hash local file
+PULL_CHUNK_SIZE = 8 * 1024 * 1024  # Default bytes of one pull_resume chunk (one dd on device)
+PULL_CHUNK_TIMEOUT = 60  # Default timeout of one pull_resume chunk
+PULL_PART_SUFFIX = u'.adbpart'  # pull_resume partial data file, progress is in PULL_PART_SUFFIX + .json
+
+
+class PropSnapshot(object):
+    '''
+    Whole getprop output of one device boot
+    Mutable key fetched alone later is updated in a new props dict, fetch_times keep its time
+    '''
+    __slots__ = ('boot_id', 'props', 'load_time', 'check_time', 'fetch_times')
+
+    def __init__(self, boot_id, props, load_time):
+        self.boot_id, self.props = boot_id, props
+        self.load_time = self.check_time = load_time
+        self.fetch_times = {}  # key: time
+
+
+class DeviceProfile(object):
+    '''
+    Capabilities of one device probed once, None means not probed yet
+    Dropped when device connection changed (root/unroot/reboot/disconnect)
+    root: adbd run as root(bool)
+    busybox: busybox in PATH(bool)
+    ls_context: ls support -Z(bool)
+    net_cmd: netcfg / ifconfig(str)
+    stat_format: stat -c support STAT_FORMAT(bool)
+    Probe hold lock, so one field is probed once when device is used by many threads (AdbFleet)
+    '''
+    __slots__ = ('device', 'root', 'busybox', 'ls_context', 'net_cmd', 'stat_format', 'lock')
+
+    def __init__(self, device):
+        self.device = device
+        self.root = self.busybox = self.ls_context = self.net_cmd = self.stat_format = None
+        self.lock = RLock()
+
+    def __repr__(self):
+        return u'DeviceProfile({!r}, root={}, busybox={}, ls_context={}, net_cmd={}, stat_format={})'.format(
+            self.device, self.root, self.busybox, self.ls_context, self.net_cmd, self.stat_format)
+
+
+class FileStat(object):
+    '''
+    Stat of one remote path
+    mode: st_mode(int), with file type bits
+    mtime: modify time(int), seconds since epoch
+    context: SELinux context(str) / None
+    '''
+    __slots__ = ('path', 'size', 'mode', 'mtime', 'owner', 'group', 'context')
+
+    def __init__(self, path, size, mode, mtime, owner, group, context=None):
+        self.path, self.size, self.mode, self.mtime = path, size, mode, mtime
+        self.owner, self.group, self.context = owner, group, context
+
+    def isdir(self):
+        return stat.S_ISDIR(self.mode)
+
+    def isfile(self):
+        return stat.S_ISREG(self.mode)
+
+    def islink(self):
+        return stat.S_ISLNK(self.mode)
+
+    @property
+    def permission(self):
+        '''
+        Output: permission string such as drwxr-xr-x
+        '''
+        return _permission_string(self.mode)
+
+    def __repr__(self):
+        return u'FileStat({!r}, {}, {}, {}, {}:{}, {})'.format(
+            self.path, self.permission, self.size, self.mtime, self.owner, self.group, self.context)
+
+
+class SyncResult(object):
+    '''
+    Outcome of sync_push
+    pushed: remote paths transferred(list)
+    deleted: remote paths removed(list)
+    skipped: remote paths already up to date(list)
+    bytes_sent: bytes transferred(int)
+    bytes_saved: bytes of skipped files, not transferred(int)
+    '''
+    __slots__ = ('pushed', 'deleted', 'skipped', 'bytes_sent', 'bytes_saved', 'duration')
+
+    def __init__(self):
+        self.pushed, self.deleted, self.skipped = [], [], []
+        self.bytes_sent = self.bytes_saved = 0
+        self.duration = 0.0
+
+    def __repr__(self):
+        return u'SyncResult({} pushed, {} skipped, {} deleted, {} bytes sent, {} bytes saved, {:.3f}s)'.format(
+            len(self.pushed), len(self.skipped), len(self.deleted), self.bytes_sent, self.bytes_saved, self.duration)
+
+
+_FILE_TYPE_CHARS = ((stat.S_IFDIR, u'd'), (stat.S_IFLNK, u'l'), (stat.S_IFCHR, u'c'), (stat.S_IFBLK, u'b'),
+                    (stat.S_IFIFO, u'p'), (stat.S_IFSOCK, u's'), (stat.S_IFREG, u'-'))
+_PERMISSION_BITS = ((stat.S_IRUSR, u'r'), (stat.S_IWUSR, u'w'), (stat.S_IXUSR, u'x'),
+                    (stat.S_IRGRP, u'r'), (stat.S_IWGRP, u'w'), (stat.S_IXGRP, u'x'),
+                    (stat.S_IROTH, u'r'), (stat.S_IWOTH, u'w'), (stat.S_IXOTH, u'x'))
+_SPECIAL_BITS = ((2, stat.S_ISUID, u's', u'S'), (5, stat.S_ISGID, u's', u'S'), (8, stat.S_ISVTX, u't', u'T'))
+
+
+def _permission_string(mode):
+    chars = [u'?'] + [char if mode & bit else u'-' for bit, char in _PERMISSION_BITS]
+    for file_type, char in _FILE_TYPE_CHARS:
+        if stat.S_IFMT(mode) == file_type:
+            chars[0] = char
+    for index, bit, exec_char, noexec_char in _SPECIAL_BITS:
+        if mode & bit:
+            chars[index + 1] = exec_char if chars[index + 1] == u'x' else noexec_char
+    return u''.join(chars)
+
+
+def _permission_mode(permission):
+    '''
+    Convert permission string from ls (drwxr-xr-x) to st_mode(int)
+    '''
+    mode = 0
+    for file_type, char in _FILE_TYPE_CHARS:
+        if permission[0] == char:
+            mode = file_type
+    for (bit, char), perm_char in zip(_PERMISSION_BITS, permission[1:10]):
+        if perm_char in (char, u's', u't'):
+            mode |= bit
+    for index, bit, exec_char, noexec_char in _SPECIAL_BITS:
+        if permission[index + 1] in (exec_char, noexec_char):
+            mode |= bit
+    return mode
+
+
+def _md5_file(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_READ_SIZE), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def _path_batches(paths, reserve=0):
+    '''
+    Shell quote paths and split them, so command of each batch fit in SHELL_BATCH_SCRIPT_MAX
+    Input: paths (list of str)
+           reserve(int), size of command besides the paths
+    Output: generator of (paths of batch(list), quoted paths joined by space(str))
+    '''
+    batch, quoted, size = [], [], reserve
+    for path in paths:
+        item = _shell_quote(path)
+        item_size = len(item.encode('UTF-8')) + 1
+        if batch and size + item_size > SHELL_BATCH_SCRIPT_MAX:
+            yield batch, u' '.join(quoted)
+            batch, quoted, size = [], [], reserve
+        batch.append(path)
+        quoted.append(item)
+        size += item_size
+    if batch:
+        yield batch, u' '.join(quoted)
+
+
 class AdbAuto(AdbWrapper):
     '''Here is a little smart AdbWrapper'''
     file_property_nose_re = re.compile((r'(?P<permission>[-lspbcdrwx\.]{10}) *'
@@ -38,11 +215,82 @@ class AdbAuto(AdbWrapper):
     android_ps_re = re.compile(r'(\w+) +(\d+) *(\d+) +(\d+) +(\d+) *(.*?) +(\w*) +(D|R|S|T|W|X|Z) +(.*)')
     # BusyBox ps command:pid    userid time      command
     busybox_ps_re = re.compile(r'(\d+) +(\d+) +(\d+:\d+) +(.*)')
+    # stat -c STAT_FORMAT command
+    stat_re = re.compile(r'^([0-9a-fA-F]+) (\d+) (\d+) (\S+) (\S+) (\S+) (.+)$')
+    # md5sum command: md5  filename
+    md5sum_re = re.compile(r'^([0-9a-fA-F]{32})\s', re.M)
+    # getprop command: [key]: [value], value may take more lines
+    getprop_re = re.compile(r'^\[([^\]]+)\]: \[(.*?)\]$', re.M | re.S)
     # mount command:
     mount_re = mount_re = re.compile(r'(?P<device>.*?) on (?P<mount_point>/.*?) type (?P<type>.*?) \((?P<options>.*?)\)')
 
-    def __init__(self, adb_file=None, logger=None, adb_server_port=ADB_SERVER_PORT):
-        super(AdbAuto, self).__init__(adb_file, logger)
+    def __init__(self, adb_file=None, logger=None, adb_server_port=ADB_SERVER_PORT, use_server_socket=False,
+                 server_pool_size=ADB_SERVER_POOL_SIZE, persistent_shell=False, device_state_ttl=DEVICE_STATE_TTL,
+                 track_devices=False, getprop_ttl=GETPROP_TTL):
+        super(AdbAuto, self).__init__(adb_file, logger, adb_server_port, use_server_socket, server_pool_size,
+                                      track_devices)
+        # shell_auto (and all helpers based on it) run by persistent shell session of device
+        self.persistent_shell = persistent_shell
+        # connect_auto result cache, input device: (device name, expire time)
+        self.device_state_ttl = device_state_ttl
+        self._device_states = {}
+        self._device_states_lock = Lock()
+        # getprop cache, device name: PropSnapshot
+        self.getprop_ttl = getprop_ttl
+        self._props = {}
+        self._props_lock = Lock()
+        # capability cache, device name: DeviceProfile
+        self._profiles = {}
+        self._profiles_lock = Lock()
+
+    def _device_state_get(self, device):
+        '''
+        Output: device name(str) checked by connect_auto within device_state_ttl / None
+        '''
+        with self._device_states_lock:
+            state = self._device_states.get(device)
+            if state is None:
+                return None
+            if state[1] < time.time():
+                del self._device_states[device]
+                return None
+            return state[0]
+
+    def _device_state_set(self, device, device_name):
+        if self.device_state_ttl > 0:
+            with self._device_states_lock:
+                self._device_states[device] = (device_name, time.time() + self.device_state_ttl)
+
+    def _device_reset(self, device=None):
+        '''
+        Drop connect_auto cache of device (input name and translated name) too
+        '''
+        names = set([device])
+        with self._device_states_lock:
+            for name, state in list(self._device_states.items()):
+                if device is None or device in (name, state[0]):
+                    names.add(state[0])  # device may be IP only, its device name is translated by connect_auto
+                    del self._device_states[name]
+        for cache, lock in ((self._props, self._props_lock), (self._profiles, self._profiles_lock)):
+            with lock:
+                if device is None:
+                    cache.clear()
+                for name in names:
+                    cache.pop(name, None)
+        super(AdbAuto, self)._device_reset(device)
+
+    def device_profile(self, device=None):
+        '''
+        Get capability cache of device, fields are probed by helpers when first needed
+        Input: device [SN(for USB device) / IP:Port(for network device)](str) / None(for self._device)]
+        Output: DeviceProfile
+        '''
+        devicename = self.connect_auto(device=device)
+        with self._profiles_lock:
+            profile = self._profiles.get(devicename)
+            if profile is None:
+                profile = self._profiles[devicename] = DeviceProfile(devicename)
+        return profile
 
     def check_connection(self, device=None):
         '''
@@ -68,6 +316,7 @@ class AdbAuto(AdbWrapper):
 
     def connect_auto(self, device=None, retry_times=3):
         '''
+        Trust last success result within device_state_ttl, skip all checks
         Before connect, auto check exist connect from adb devices
         If already in connect
             *. If in connect with wrong status, do disconnect
@@ -87,9 +336,14 @@ class AdbAuto(AdbWrapper):
             else:
                 self.logger.error("connect_auto: device not define")
                 raise AdbFailException("device not define")
+        device_name = self._device_state_get(_device)
+        if device_name:
+            self.logger.info("connect_auto: connected in last %ss - %s", self.device_state_ttl, device_name)
+            return device_name
         try:
             # Check Devices List First
-            devices = self.devices()
+            tracked = self._tracked_devices()
+            devices = tracked if tracked is not None else self.devices()
             for exist_device in devices:
                 if _device in exist_device:
                     device_name = exist_device  # Because Input Device may be IP only, translate it to SN
@@ -99,8 +353,10 @@ class AdbAuto(AdbWrapper):
                         self.logger.error("connect_auto: Try to disconnect it")
                         self.disconnect(device_name)
                     else:
-                        if self.check_connection(device=device_name):
+                        # "device" state in live track-devices table is as good as shell exit check
+                        if tracked is not None or self.check_connection(device=device_name):
                             self.logger.info("connect_auto: already connected")
+                            self._device_state_set(_device, device_name)
                             return device_name
                     break
             else:
@@ -114,6 +370,7 @@ class AdbAuto(AdbWrapper):
                 self.logger.info("connect_auto: connect success")
                 if self.check_connection(device=device_name):
                     self.logger.info("connect_auto: check connect Pass")
+                    self._device_state_set(_device, device_name)
                     return device_name
                 else:
                     self.logger.error("connect_auto: check connect Fail")
@@ -132,6 +389,23 @@ class AdbAuto(AdbWrapper):
         '''
         return self.disconnect(device=device)
 
+    def _auto_run(self, func, device, *args, **kwargs):
+        '''
+        Do connect_auto then func(*args, device=<device name>, **kwargs)
+        If connect_auto trusted cached state but device is gone (AdbNoDevice), drop the cache and do it again
+        '''
+        cached = self._device_state_get(device if device else self._device) is not None
+        devicename = self.connect_auto(device=device)
+        try:
+            return func(*args, device=devicename, **kwargs)
+        except AdbNoDevice:
+            self._device_reset(devicename)
+            if not cached:
+                raise
+            self.logger.warning("%s: %s is gone, connect again", func.__name__, devicename)
+        devicename = self.connect_auto(device=device)
+        return func(*args, device=devicename, **kwargs)
+
     def shell_auto(self, cmd, device=None, timeout=None):
         '''
         Do adb connect auto then do shell cmd
@@ -142,14 +416,43 @@ class AdbAuto(AdbWrapper):
                 stderr(str)
         '''
         self.logger.info("shell_auto: start")
-        try:
-            devicename = self.connect_auto(device=device)
-            stdout, stderr = self.shell(cmd=cmd, device=devicename, timeout=timeout)
-            self.logger.info("shell_auto: complete")
-        except (AdbFailException, AdbConnectFail):
-            raise
+        if self.persistent_shell:
+            return self._session_shell_auto(cmd, device, timeout)[:2]
+        stdout, stderr = self._auto_run(self.shell, device, cmd=cmd, timeout=timeout)
+        self.logger.info("shell_auto: complete")
         return stdout, stderr
 
+    def _session_shell_auto(self, cmd, device, timeout):
+        '''
+        shell_auto by persistent shell session
+        Alive session means device is still connected, so connect_auto only when session need start
+        '''
+        _device = device if device else self._device
+        session = self._shell_sessions.get(_device)
+        if session is None or not session.isalive():
+            devicename = self.connect_auto(device=device)
+            session = self.shell_session(device=devicename)
+            if devicename != _device:
+                # Input device may be IP only, keep session for it too
+                with self._shell_sessions_lock:
+                    self._shell_sessions[_device] = session
+        return session.run(cmd, timeout)
+
+    def shell_auto_status(self, cmd, device=None, timeout=None):
+        '''
+        Do adb connect auto then do shell cmd, get its exit code
+        Input: device [SN(for USB device) / IP:Port(for network device)](str) / None(for self._device)]
+               cmd [list or string]
+               timeout [int/float/None(infinite)]
+        Output: stdout[from adb command](str)
+                stderr(str)
+                exit_code(int)
+        '''
+        self.logger.info("shell_auto_status: start")
+        if self.persistent_shell:
+            return self._session_shell_auto(cmd, device, timeout)
+        return self._auto_run(self.shell_status, device, cmd=cmd, timeout=timeout)
+
     def is_root(self, device=None):
         '''
         Use adb shell id to get adb connect permission
@@ -158,19 +461,26 @@ class AdbAuto(AdbWrapper):
         Output: Result(bool)
         '''
         self.logger.info("is_root: start")
-        try:
-            stdout, stderr = self.shell_auto(cmd='id', device=device, timeout=5)
-        except AdbFailException:
-            raise
-        if u'uid=0(root)' in stdout:
-            self.logger.info("is_root: Now adb %s is root", device)
-            return True
-        elif u'uid=' in stdout:
-            self.logger.info("is_root: Now adb %s is not root - %r", device, stdout)
-            return False
-        else:
-            self.logger.error("is_root: Fail to get response from shell id")
-            raise AdbFailException(u"Invalid response from id", stdout, stderr)
+        profile = self.device_profile(device)
+        with profile.lock:
+            if profile.root is not None:
+                self.logger.info("is_root: adb %s root - %s (probed)", device, profile.root)
+                return profile.root
+            try:
+                stdout, stderr = self.shell_auto(cmd='id', device=profile.device, timeout=5)
+            except AdbFailException:
+                raise
+            if u'uid=0(root)' in stdout:
+                self.logger.info("is_root: Now adb %s is root", device)
+                profile.root = True
+                return True
+            elif u'uid=' in stdout:
+                self.logger.info("is_root: Now adb %s is not root - %r", device, stdout)
+                profile.root = False
+                return False
+            else:
+                self.logger.error("is_root: Fail to get response from shell id")
+                raise AdbFailException(u"Invalid response from id", stdout, stderr)
 
     def root_auto(self, device=None):
         '''
@@ -329,7 +639,7 @@ class AdbAuto(AdbWrapper):
         if vfstype != vfstype_ and vfstype != 'None':
             self.logger.warning("I expect vfstype is {},but it is {}".format(vfstype_, vfstype))
 
-        version = self.android_sdk_version_get()
+        version = self.android_sdk_version_get(device=device)
         if version:
             if not vfstype:
                 mount_src_ = None
@@ -349,7 +659,7 @@ class AdbAuto(AdbWrapper):
 
         self.mount2local(mount_device, dir, vfstype, mount_src, device, *options)
 
-    def push_auto(self, src, dst, device=None, timeout=FILE_TRANSFORM_TIMEOUT):
+    def push_auto(self, src, dst, device=None, timeout=FILE_TRANSFORM_TIMEOUT, streams=1):
         '''
         Try adb connect first, then push
         if push fail, try root, then push again
@@ -357,6 +667,7 @@ class AdbAuto(AdbWrapper):
         Input: device [SN(for USB device) / IP:Port(for network device)](str) / None(for self._device)]
                src/dst[can be file/folder absolute/relative path](str)
                timeout(int/float)
+               streams(int), same as push
                Support all adb push support method
         Output: None
         User should know file path after push
@@ -368,7 +679,7 @@ class AdbAuto(AdbWrapper):
         remount_try_flag = False
         while 1:
             try:
-                self.push(src=src, dst=dst, device=devicename, timeout=timeout)
+                self.push(src=src, dst=dst, device=devicename, timeout=timeout, streams=streams)
                 self.logger.info("push_auto: success")
                 break
             except AdbFailException as err:
@@ -394,13 +705,14 @@ class AdbAuto(AdbWrapper):
                 raise
             break
 
-    def pull_auto(self, src, dst, device=None, timeout=FILE_TRANSFORM_TIMEOUT):
+    def pull_auto(self, src, dst, device=None, timeout=FILE_TRANSFORM_TIMEOUT, streams=1):
         '''
         Try adb connect first, then pull
         if pull fail, try root, then pull again
         Input: device [SN(for USB device) / IP:Port(for network device)](str) / None(for self._device)]
                src/dst[can be file/folder absolute/relative path](str)
                timeout(int/float)
+               streams(int), same as pull
                Support all adb pull support method
         Output: filelist
         '''
@@ -409,7 +721,7 @@ class AdbAuto(AdbWrapper):
         root_try_flag = False
         while 1:
             try:
-                filelist = self.pull(src=src, dst=dst, device=devicename, timeout=timeout)
+                filelist = self.pull(src=src, dst=dst, device=devicename, timeout=timeout, streams=streams)
                 self.logger.info("pull_auto: success")
                 return filelist
             except AdbFailException as err:
@@ -422,6 +734,98 @@ class AdbAuto(AdbWrapper):
                 raise
             break
 
+    def pull_resume(self, src, dst, device=None, chunk_size=PULL_CHUNK_SIZE, chunk_timeout=PULL_CHUNK_TIMEOUT,
+                    retry_times=3):
+        '''
+        Pull one big remote file chunk by chunk, resumable after fail / in next call
+        Each chunk is read once by dd skip= on device through exec-out, and checked by its size
+        Data is written to dst + PULL_PART_SUFFIX, progress to dst + PULL_PART_SUFFIX + .json after each chunk,
+        renamed to dst when finished. Progress is dropped if remote file size/mtime or chunk_size changed
+        On fail (device lost / timeout / short chunk), connect again and continue from last good chunk,
+        raise after retry_times fails in a row, progress is kept for next call
+        Whole file is checked by md5sum on device at the end, progress is dropped if md5 mismatch
+        Input: device [SN(for USB device) / IP:Port(for network device)](str) / None(for self._device)]
+               src [sugguest to Absolute path](str), remote file
+               dst(str), local file / folder (dst/basename(src))
+               chunk_size(int), bytes of one chunk
+               chunk_timeout(int/float), timeout of one chunk
+               retry_times(int), fails in a row to give up
+        Output: local abspath(str)
+        '''
+        self.logger.info("pull_resume: start - %s -> %s", src, dst)
+        devicename = self.connect_auto(device=device)
+        remote = self.file_stat_many([src], device=devicename)[_to_unicode(src)]
+        if remote is None or not remote.isfile():
+            self.logger.error("pull_resume: %s is not a file", src)
+            raise AdbFailException(NOFILEORFOLDER, u'', u'{}: No such file'.format(src))
+        if os.path.isdir(dst):
+            dst = os.path.join(dst, posixpath.basename(_to_unicode(src)))
+        dst = os.path.abspath(dst)
+        part_file, progress_file = dst + PULL_PART_SUFFIX, dst + PULL_PART_SUFFIX + u'.json'
+        progress = {u'src': _to_unicode(src), u'size': remote.size, u'mtime': remote.mtime,
+                    u'chunk_size': chunk_size, u'done': 0}
+        try:
+            with open(progress_file) as f:
+                saved = json.load(f)
+            if all(saved.get(key) == value for key, value in progress.items() if key != u'done') and \
+                    os.path.getsize(part_file) >= saved[u'done'] * chunk_size:
+                progress[u'done'] = saved[u'done']
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            pass
+        chunks = (remote.size + chunk_size - 1) // chunk_size
+        self.logger.info("pull_resume: %d bytes, chunk %d/%d done", remote.size, progress[u'done'], chunks)
+        fails = 0
+        with open(part_file, 'r+b' if progress[u'done'] else 'wb') as f:
+            f.truncate(progress[u'done'] * chunk_size)
+            while progress[u'done'] < chunks:
+                index = progress[u'done']
+                try:
+                    data = self.exec_out(u'dd if={} bs={} skip={} count=1 2>/dev/null'.format(
+                        _shell_quote(src), chunk_size, index), device=devicename, timeout=chunk_timeout)
+                    length = min(chunk_size, remote.size - index * chunk_size)
+                    if len(data) != length:
+                        raise AdbFailException(u'chunk {} size {} != {}'.format(index, len(data), length), u'', u'')
+                except AdbFailException as err:
+                    fails += 1
+                    self.logger.warning("pull_resume: chunk %d fail (%d/%d) - %s", index, fails, retry_times, err.msg)
+                    if fails >= retry_times:
+                        raise
+                    self._device_reset(devicename)
+                    with ignored(AdbFailException):
+                        devicename = self.connect_auto(device=device)
+                    continue
+                fails = 0
+                f.seek(index * chunk_size)
+                f.write(data)
+                f.flush()
+                progress[u'done'] = index + 1
+                with open(progress_file, 'w') as progress_f:
+                    json.dump(progress, progress_f)
+        self._pull_resume_check(src, part_file, progress_file, devicename, chunk_timeout * max(1, chunks))
+        if os.path.exists(dst):
+            os.remove(dst)
+        os.rename(part_file, dst)
+        os.remove(progress_file)
+        self.logger.info("pull_resume: success - %s", dst)
+        return dst
+
+    def _pull_resume_check(self, src, part_file, progress_file, device, timeout):
+        '''
+        Compare md5 of pulled data with md5sum of remote file, drop progress if mismatch
+        Not checked if md5sum not available on device
+        '''
+        stdout, stderr, exit_code = self.shell_status(u'md5sum {}'.format(_shell_quote(src)),
+                                                      device=device, timeout=timeout)
+        md5s = self.md5sum_re.findall(stdout)
+        if exit_code != 0 or not md5s:
+            self.logger.warning("pull_resume: md5sum not available, skip check - %r", stdout or stderr)
+            return
+        if md5s[0].lower() != _md5_file(part_file):
+            self.logger.error("pull_resume: md5 of %s mismatch, drop pulled data", src)
+            os.remove(part_file)
+            os.remove(progress_file)
+            raise AdbFailException(u'md5 check fail', stdout, stderr)
+
     def bugreport_auto(self, filename=None, device=None, timeout=BUGREPORT_TIMEOUT):
         '''
         Try adb connect first, then bugreport
@@ -431,8 +835,7 @@ class AdbAuto(AdbWrapper):
                           full filepath filename!=None
         '''
         self.logger.info("bugreport_auto: start")
-        devicename = self.connect_auto(device=device)
-        res = self.bugreport(filename=filename, device=devicename, timeout=timeout)
+        res = self._auto_run(self.bugreport, device, filename=filename, timeout=timeout)
         self.logger.info("bugreport_auto: success")
         return res
 
@@ -468,10 +871,8 @@ class AdbAuto(AdbWrapper):
               Or you need ignore this function return and wait timeout
         '''
         self.logger.info("install_auto: start")
-        devicename = self.connect_auto(device=device)
-        self.install(apkfile=apkfile, forward=forward, replace=replace, test=test,
-                     sdcard=sdcard, downgrade=downgrade, permission=permission,
-                     timeout=timeout, device=devicename)
+        self._auto_run(self.install, device, apkfile=apkfile, forward=forward, replace=replace, test=test,
+                       sdcard=sdcard, downgrade=downgrade, permission=permission, timeout=timeout)
         self.logger.info("install_auto: success")
 
     def uninstall_auto(self, package, keepdata=False,
@@ -484,8 +885,7 @@ class AdbAuto(AdbWrapper):
         Output: None
         '''
         self.logger.info("uninstall_auto: start")
-        devicename = self.connect_auto(device=device)
-        self.uninstall(package, keepdata=keepdata, timeout=timeout, device=devicename)
+        self._auto_run(self.uninstall, device, package, keepdata=keepdata, timeout=timeout)
         self.logger.info("uninstall_auto: success")
 
     def disable_verity_auto(self, device=None):
@@ -577,18 +977,82 @@ class AdbAuto(AdbWrapper):
 
     def android_getprop(self, key, device=None):
         '''
-        Use adb shell getprop
+        Use adb shell getprop, served from getprop snapshot of device
+        ro.* keys are kept until device boot_id changed, other keys are kept for getprop_ttl then fetched alone
         Input: device [SN(for USB device) / IP:Port(for network device)](str) / None(for self._device)]
                key(str)
-        Output: stdout[from adb command](str)
+        Output: value(str), u'' if no such key
         '''
         self.logger.info("getprop: start - %s", key)
-        stdout, stderr = self.shell_auto(cmd='getprop {}'.format(key), device=device, timeout=5)
-        if not stderr:
-            self.logger.warning("stderr: %r", stderr)
+        props = self._auto_run(self._getprop_snapshot, device, key)
+        if props is None:
+            stdout, stderr = self.shell_auto(cmd='getprop {}'.format(key), device=device, timeout=5)
+            if stderr:
+                self.logger.warning("stderr: %r", stderr)
+        else:
+            stdout = props.get(key, u'')
         self.logger.info("getprop - %s: %r", key, stdout)
         return stdout
 
+    def android_getprop_all(self, device=None):
+        '''
+        Use adb shell getprop, get all properties
+        Input: device [SN(for USB device) / IP:Port(for network device)](str) / None(for self._device)]
+        Output: {key: value}(dict)
+        '''
+        props = self._auto_run(self._getprop_snapshot, device, None)
+        if props is None:
+            self.logger.error("getprop: Fail to parse getprop output")
+            raise AdbFailException(SHELL_FAILED, u'', u'')
+        return dict(props)
+
+    def _getprop_snapshot(self, key, device=None):
+        '''
+        Get getprop snapshot of device, reload whole snapshot only if too old (key None) or boot_id changed
+        key(str), only this key needed: ro.* key is still good if boot_id not changed, other key is fetched alone
+           None, all keys needed
+        Output: {key: value}(dict) / None [getprop output cannot be parsed]
+        '''
+        now = time.time()
+        with self._props_lock:
+            snapshot = self._props.get(device)
+        if snapshot is not None:
+            if key is None:
+                if now - snapshot.load_time <= self.getprop_ttl:
+                    return snapshot.props
+            elif key.startswith(u'ro.'):
+                if now - snapshot.check_time <= self.getprop_ttl:
+                    return snapshot.props
+                stdout, stderr = self.shell(cmd='cat {}'.format(BOOT_ID_FILE), device=device, timeout=5)
+                if stdout == snapshot.boot_id:
+                    snapshot.check_time = now
+                    return snapshot.props
+                self.logger.info("getprop: boot_id of %s changed, reload", device)
+            else:
+                if now - snapshot.fetch_times.get(key, snapshot.load_time) <= self.getprop_ttl:
+                    return snapshot.props
+                stdout, stderr = self.shell(cmd='cat {}; getprop {}'.format(BOOT_ID_FILE, _shell_quote(key)),
+                                            device=device, timeout=5)
+                boot_id, _, value = stdout.partition(u'\n')
+                if boot_id.strip() == snapshot.boot_id:
+                    with self._props_lock:
+                        # New dict, props returned before are not changed under readers
+                        props = dict(snapshot.props)
+                        props[key] = value.replace(u'\r\n', u'\n')
+                        snapshot.props = props
+                        snapshot.check_time = snapshot.fetch_times[key] = now
+                    return props
+                self.logger.info("getprop: boot_id of %s changed, reload", device)
+        stdout, stderr = self.shell(cmd='cat {}; getprop'.format(BOOT_ID_FILE), device=device, timeout=10)
+        boot_id, _, output = stdout.partition(u'\n')
+        props = dict(self.getprop_re.findall(output.replace(u'\r\n', u'\n')))
+        if not props:
+            self.logger.warning("getprop: no property found in output: %r", stdout[:200])
+            return None
+        with self._props_lock:
+            self._props[device] = PropSnapshot(boot_id.strip(), props, now)
+        return props
+
     def android_sdk_version_get(self, device=None):
         '''
         Use adb shell getprop ro.build.version.sdk
@@ -599,7 +1063,7 @@ class AdbAuto(AdbWrapper):
                 stderr(str)
         '''
         self.logger.info("get_android_sdk_version: start")
-        stdout, stderr = self.shell_auto(cmd='getprop ro.build.version.sdk', device=device, timeout=5)
+        stdout, stderr = self.android_getprop(u'ro.build.version.sdk', device=device), u''
         version_r = re.search(r'^(\d+)$', stdout)
         if version_r:
             version = version_r.group(1)
@@ -675,15 +1139,12 @@ class AdbAuto(AdbWrapper):
         '''
         self.logger.info("file_property: start")
         self.root_auto(device)
-        file_property_re = self.file_property_nose_re
-        try:
-            if self.android_sdk_version_get(device=device) > 22:
-                cmd = u'ls -alZ \'{}\''.format(filepath)
-                file_property_re = self.file_property_se_re
-            else:
-                cmd = u'ls -al \'{}\''.format(filepath)
-        except AdbFailException:
+        if self._ls_context_support(device):
+            cmd = u'ls -alZ \'{}\''.format(filepath)
+            file_property_re = self.file_property_se_re
+        else:
             cmd = u'ls -al \'{}\''.format(filepath)
+            file_property_re = self.file_property_nose_re
         stdout, stderr = self.shell_auto(cmd=cmd, device=device, timeout=5)
         property_num = len(file_property_re.findall(stdout))
         if property_num > 1:
@@ -709,41 +1170,267 @@ class AdbAuto(AdbWrapper):
 
     def file_exist(self, filepath, device=None):
         '''
-        Check file exist or not by ls
+        Check file exist or not by exit code of ls -d
+        For list of filepath, all are checked in one shell command
         Input: device [SN(for USB device) / IP:Port(for network device)](str) / None(for self._device)]
-               filepath [sugguest to Absolute path](str)
-        Output: bool
+               filepath [sugguest to Absolute path](str / list of str)
+        Output: bool / {filepath: bool}(OrderedDict) for list
         '''
-        if self.file_property(filepath=filepath, device=device):
-            return True
-        else:
-            return False
+        self.root_auto(device)
+        if not isinstance(filepath, (list, tuple)):
+            stdout, stderr, exit_code = self.shell_auto_status(u'ls -d \'{}\''.format(filepath), device=device, timeout=5)
+            return exit_code == 0
+        results = OrderedDict()
+        cmd = u'for f in {}; do ls -d "$f" >/dev/null 2>&1; echo $?; done'
+        for batch, quoted in _path_batches(filepath, len(cmd)):
+            stdout, stderr = self.shell_auto(cmd.format(quoted), device=device, timeout=max(5, len(batch) * 0.05))
+            exit_codes = stdout.split()
+            if len(exit_codes) != len(batch):
+                self.logger.error("file_exist: invalid output %r", stdout)
+                raise AdbFailException(SHELL_FAILED, stdout, stderr)
+            results.update((path, exit_code == u'0') for path, exit_code in zip(batch, exit_codes))
+        return results
+
+    def file_stat_many(self, paths, device=None, timeout=30):
+        '''
+        Stat many paths in as few shell commands as adb service payload allow,
+        by stat -c if device support it, else by ls -ld(Z)
+        Input: device [SN(for USB device) / IP:Port(for network device)](str) / None(for self._device)]
+               paths (list of str), sugguest to Absolute path
+               timeout [int/float/None(infinite)]
+        Output: {path: FileStat / None [no such file]}(OrderedDict), same order as paths
+        '''
+        self.logger.info("file_stat_many: start - %d paths", len(paths))
+        self.root_auto(device)
+        results = OrderedDict((_to_unicode(path), None) for path in paths)
+        if not results:
+            return results
+        if self._stat_format_support(device):
+            cmd = u'stat -c {} {{}}'.format(_shell_quote(STAT_FORMAT))
+            for _, quoted in _path_batches(list(results), len(cmd)):
+                # Missing paths make stat exit non-zero, they are just not in output
+                stdout, stderr, _ = self.shell_auto_status(cmd.format(quoted), device=device, timeout=timeout)
+                for line in stdout.splitlines():
+                    match = self.stat_re.match(line)
+                    if match is not None and match.group(7) in results:
+                        results[match.group(7)] = self._stat_file_stat(match)
+            return results
+        ls_context = self._ls_context_support(device)
+        file_property_re = self.file_property_se_re if ls_context else self.file_property_nose_re
+        cmd = u'ls -ld{} {{}}'.format(u'Z' if ls_context else u'')
+        for _, quoted in _path_batches(list(results), len(cmd)):
+            stdout, stderr, _ = self.shell_auto_status(cmd.format(quoted), device=device, timeout=timeout)
+            for match in file_property_re.finditer(stdout):
+                path = match.group(u'filename').split(u' -> ', 1)[0].strip()
+                if path in results:
+                    results[path] = self._ls_file_stat(path, match)
+        return results
+
+    def _stat_format_support(self, device=None):
+        '''
+        Probe once whether stat -c of device support STAT_FORMAT
+        Output: (bool)
+        '''
+        profile = self.device_profile(device)
+        with profile.lock:
+            if profile.stat_format is None:
+                # Exit code is not checked, stat may fail to get context on system without SELinux
+                stdout, stderr, _ = self.shell_auto_status(u'stat -c {} /'.format(_shell_quote(STAT_FORMAT)),
+                                                           device=device, timeout=5)
+                profile.stat_format = any(self.stat_re.match(line) for line in stdout.splitlines())
+                self.logger.info("stat -c support - %s", profile.stat_format)
+            return profile.stat_format
+
+    def _ls_context_support(self, device=None):
+        '''
+        Probe once whether ls of device support -Z
+        Output: (bool)
+        '''
+        profile = self.device_profile(device)
+        with profile.lock:
+            if profile.ls_context is None:
+                try:
+                    profile.ls_context = self.android_sdk_version_get(device=device) > 22
+                except AdbFailException:
+                    profile.ls_context = False
+            return profile.ls_context
+
+    def _stat_file_stat(self, match):
+        '''
+        Convert match of stat_re to FileStat
+        '''
+        mode, size, mtime, owner, group, context, path = match.groups()
+        return FileStat(path, int(size), int(mode, 16), int(mtime), owner, group, None if context == u'?' else context)
+
+    def _ls_file_stat(self, path, match):
+        '''
+        Convert match of file_property_nose_re/file_property_se_re to FileStat
+        '''
+        ret = match.groupdict()
+        mtime = time.mktime(datetime.strptime(ret[u'datetime'], '%Y-%m-%d %H:%M').timetuple())
+        return FileStat(path, int(ret[u'filesize'] or 0), _permission_mode(ret[u'permission']),
+                        int(mtime), ret[u'owner'], ret[u'group'], ret.get(u'seprop'))
+
+    def walk(self, remote_root, device=None, timeout=None):
+        '''
+        Walk remote tree like os.walk, but flat: yield FileStat of every entry under remote_root (not itself)
+        Whole tree is listed by one shell command, find -exec stat if device support stat -c, else ls -laR
+        Output is parsed while it arrives, caller can stop early by break
+        stderr is dropped (may be mixed into stdout), entries without permission are just not yielded
+        Order is same as find / ls -R, every entry of a folder come after the folder
+        Input: device [SN(for USB device) / IP:Port(for network device)](str) / None(for self._device)]
+               remote_root [sugguest to Absolute path](str), symlink root (such as /sdcard) is followed
+               timeout [int/float/None(infinite)], for whole walk
+        Output: generator of FileStat
+        '''
+        self.logger.info("walk: start - %s", remote_root)
+        self.root_auto(device)
+        devicename = self.connect_auto(device=device)
+        remote_root = _to_unicode(remote_root).rstrip(u'/') + u'/'
+        if self._stat_format_support(devicename):
+            cmd = u'find {} -exec stat -c {} {{}} + 2>/dev/null'.format(_shell_quote(remote_root), _shell_quote(STAT_FORMAT))
+            for line in self.shell_iter(cmd, device=devicename, timeout=timeout):
+                match = self.stat_re.match(line.rstrip(u'\r'))
+                if match is not None and match.group(7).rstrip(u'/') + u'/' != remote_root:
+                    yield self._stat_file_stat(match)
+            return
+        ls_context = self._ls_context_support(devicename)
+        file_property_re = self.file_property_se_re if ls_context else self.file_property_nose_re
+        cmd = u'ls -laR{} {} 2>/dev/null'.format(u'Z' if ls_context else u'', _shell_quote(remote_root))
+        folder = remote_root
+        for line in self.shell_iter(cmd, device=devicename, timeout=timeout):
+            line = line.rstrip(u'\r')
+            match = file_property_re.match(line)
+            if match is None:
+                # Header of each folder, such as "/sdcard/DCIM:"
+                if line.endswith(u':') and line.startswith(u'/'):
+                    folder = line[:-1].rstrip(u'/') + u'/'
+                continue
+            name = match.group(u'filename').split(u' -> ', 1)[0].strip()
+            if name in (u'.', u'..'):
+                continue
+            yield self._ls_file_stat(folder + name, match)
+
+    def sync_push(self, local_dir, remote_dir, device=None, delete=False, checksum=True,
+                  timeout=FILE_TRANSFORM_TIMEOUT, streams=1):
+        '''
+        Push local_dir into remote_dir (local_dir/a -> remote_dir/a), only files changed are transferred
+        Remote manifest is listed by one walk, file with same size and mtime is regarded as up to date
+        Same size but different mtime (e.g. ls fallback only has minute) is compared by md5sum if checksum
+        Changed files are pushed by one push per remote folder
+        Input: device [SN(for USB device) / IP:Port(for network device)](str) / None(for self._device)]
+               local_dir (str), local folder
+               remote_dir [sugguest to Absolute path](str), remote folder, created if not exist
+               delete (bool), remove remote files/folders not in local_dir
+               checksum (bool), compare md5 of files with same size but different mtime
+               timeout(int/float), for each push
+               streams(int), same as push
+        Output: SyncResult
+        '''
+        self.logger.info("sync_push: start - %s -> %s", local_dir, remote_dir)
+        start_time = time.time()
+        result = SyncResult()
+        devicename = self.connect_auto(device=device)
+        remote_dir = _to_unicode(remote_dir).rstrip(u'/') or u'/'
+        remote_root = remote_dir.rstrip(u'/') + u'/'
+        local_files, local_folders = OrderedDict(), set()
+        for root, folders, files in os.walk(local_dir):
+            rel = os.path.relpath(root, local_dir)
+            rel = u'' if rel == os.curdir else _to_unicode(rel).replace(os.sep, u'/') + u'/'
+            local_folders.update(rel + _to_unicode(name) for name in folders)
+            for name in sorted(files):
+                local_files[rel + _to_unicode(name)] = os.path.join(root, name)
+        remote = dict((item.path[len(remote_root):], item) for item in self.walk(remote_dir, device=devicename)
+                      if item.path.startswith(remote_root))
+        changed, candidates, removes = [], [], []
+        for rel, local_path in local_files.items():
+            local_stat = os.stat(local_path)
+            remote_stat = remote.get(rel)
+            if remote_stat is None:
+                changed.append(rel)
+            elif not remote_stat.isfile():
+                # Folder/link in the way of file, remove it first
+                removes.append(rel)
+                changed.append(rel)
+            elif remote_stat.size != local_stat.st_size:
+                changed.append(rel)
+            elif remote_stat.mtime == int(local_stat.st_mtime):
+                result.skipped.append(remote_root + rel)
+            elif checksum:
+                candidates.append(rel)
+            else:
+                changed.append(rel)
+        if candidates:
+            remote_hashes = self._md5sum_many([remote_root + rel for rel in candidates], device=devicename)
+            for rel in candidates:
+                if remote_hashes.get(remote_root + rel) == _md5_file(local_files[rel]):
+                    result.skipped.append(remote_root + rel)
+                else:
+                    changed.append(rel)
+        for rel in local_folders:
+            if rel in remote and not remote[rel].isdir():
+                removes.append(rel)
+        if delete:
+            extras = set(rel for rel in remote if rel not in local_files and rel not in local_folders)
+            removes.extend(rel for rel in extras if posixpath.dirname(rel) not in extras)
+        if removes:
+            self.file_remove([remote_root + rel for rel in sorted(removes)], device=devicename)
+            result.deleted.extend(remote_root + rel for rel in sorted(removes) if rel not in changed)
+        groups = OrderedDict()
+        for rel in changed:
+            groups.setdefault(posixpath.dirname(rel), []).append(rel)
+        if groups:
+            # Push of many files need existed remote folder
+            folders = [remote_dir] + [remote_root + folder for folder in groups
+                                      if folder and (folder in removes or folder not in remote)]
+            self.shell_auto(u'mkdir -p {}'.format(u' '.join(_shell_quote(folder) for folder in folders)),
+                            device=devicename, timeout=30)
+        for folder, rels in groups.items():
+            self.push_auto([local_files[rel] for rel in rels], remote_root + folder if folder else remote_dir,
+                           device=devicename, timeout=timeout, streams=streams)
+            result.pushed.extend(remote_root + rel for rel in rels)
+            result.bytes_sent += sum(os.path.getsize(local_files[rel]) for rel in rels)
+        result.bytes_saved = sum(remote[path[len(remote_root):]].size for path in result.skipped)
+        result.duration = time.time() - start_time
+        self.logger.info("sync_push: %r", result)
+        return result
+
+    def _md5sum_many(self, paths, device=None):
+        '''
+        md5sum many remote files, in as few shell commands as adb service payload allow
+        Output: {path: md5(str)}, path fail to hash is not in it
+        '''
+        hashes = {}
+        for batch, quoted in _path_batches(paths, len(u'md5sum ')):
+            stdout, stderr, _ = self.shell_auto_status(u'md5sum {}'.format(quoted),
+                                                       device=device, timeout=max(30, len(batch)))
+            for line in stdout.splitlines():
+                md5, _, path = line.partition(u'  ')
+                if len(md5) == 32 and path:
+                    hashes[path] = md5.lower()
+        return hashes
 
     def file_remove(self, filepath, device=None):
         '''
-        Use rm -rf to delete target
+        Use rm -rf to delete target, no exist target is regarded as success
         For folder, filepath cannot endwith /
-        Check file exist first
-        If exist use rm -f file
-        Then check file exist again
+        Result is checked by exit code of rm
         Input: device [SN(for USB device) / IP:Port(for network device)](str) / None(for self._device)]
-               filepath [sugguest to Absolute path](str)
+               filepath [sugguest to Absolute path](str / list of str, removed by as few rm as adb service payload allow)
         Output: None
         '''
         self.logger.info("file_remove: start")
-        try:
-            self.root_auto(device)
-            if self.file_exist(filepath=filepath, device=device):
-                self.logger.info("file_remove: try to delete")
-                self.shell_auto(cmd='rm -rf \'{}\''.format(filepath), device=device, timeout=60)
-                if not self.file_exist(filepath=filepath, device=device):
-                    self.logger.info("file_remove: success")
-                    return
-        except AdbFailException as err:
-            if err.msg == NOFILEORFOLDER:
-                self.logger.info("file_remove: file no exist")
-                return
-            raise
+        self.root_auto(device)
+        if isinstance(filepath, (list, tuple)):
+            cmds = [u'rm -rf {}'.format(quoted) for _, quoted in _path_batches(filepath, len(u'rm -rf '))]
+        else:
+            cmds = [u'rm -rf \'{}\''.format(filepath)]
+        for cmd in cmds:
+            stdout, stderr, exit_code = self.shell_auto_status(cmd, device=device, timeout=60)
+            if exit_code != 0:
+                self.logger.info("file_remove: fail - %s", stderr or stdout)
+                raise AdbFailException(SHELL_FAILED, stdout, stderr)
+        self.logger.info("file_remove: success")
 
     def file_find(self, filename, device=None, timeout=None):
         '''
@@ -762,7 +1449,7 @@ class AdbAuto(AdbWrapper):
         self.logger.info("file_find: start")
         self.root_auto(device)
         stdout, stderr = self.shell_auto('find / -name \'{}\''.format(filename), device=device, timeout=timeout)
-        filelist = re.findall(r'^(\.\/.*)$', stdout)
+        filelist = re.findall(r'^(/.*?)\r?$', stdout, re.M)
         if len(filelist) < 1:
             self.logger.info("file_find: no target find")
             raise AdbFailException(NOFILEORFOLDER, stdout, stderr)
@@ -786,11 +1473,11 @@ class AdbAuto(AdbWrapper):
         '''
         self.logger.info("file_chmod: start")
         self.root_auto(device)
-        stdout, stderr = self.shell_auto('chmod {0} \'{1}\''.format(permission, filename), device=device, timeout=5)
-        if stdout == u'':
+        stdout, stderr, exit_code = self.shell_auto_status('chmod {0} \'{1}\''.format(permission, filename), device=device, timeout=5)
+        if exit_code == 0:
             self.logger.info("file_chmod: success")
         else:
-            self.logger.info("file_chmod: fail - %s", stdout)
+            self.logger.info("file_chmod: fail - %s", stderr or stdout)
             raise AdbFailException(SHELL_FAILED, stdout, stderr)
 
     def file_link(self, target, filename, params=None, device=None):
@@ -813,11 +1500,12 @@ class AdbAuto(AdbWrapper):
             _params = ''
         else:
             _params = params
-        stdout, stderr = self.shell_auto('ln {0} \'{1}\' \'{2}\''.format(_params, target, filename), device=device, timeout=5)
-        if stdout == u'':
+        stdout, stderr, exit_code = self.shell_auto_status('ln {0} \'{1}\' \'{2}\''.format(_params, target, filename),
+                                                           device=device, timeout=5)
+        if exit_code == 0:
             self.logger.info("file_link: success")
         else:
-            self.logger.info("file_link: %s", stdout)
+            self.logger.info("file_link: %s", stderr or stdout)
             raise AdbFailException(SHELL_FAILED, stdout, stderr)
 
     def file_alias(self, cmd, target, device=None):
@@ -830,11 +1518,11 @@ class AdbAuto(AdbWrapper):
         '''
         self.logger.info("file_alias: start")
         self.root_auto(device)
-        stdout, stderr = self.shell_auto('alias \'{0}\'=\'{1}\''.format(target, cmd), device=device, timeout=5)
-        if stdout == u'':
+        stdout, stderr, exit_code = self.shell_auto_status('alias \'{0}\'=\'{1}\''.format(target, cmd), device=device, timeout=5)
+        if exit_code == 0:
             self.logger.info("file_alias: success")
         else:
-            self.logger.info("file_alias: %s", stdout)
+            self.logger.info("file_alias: %s", stderr or stdout)
             raise AdbFailException(SHELL_FAILED, stdout, stderr)
 
     def folder_create(self, folderpath, device=None):
@@ -846,11 +1534,11 @@ class AdbAuto(AdbWrapper):
         '''
         self.logger.info("folder_create: start")
         self.root_auto(device)
-        stdout, stderr = self.shell_auto('mkdir -p \'{}\''.format(folderpath), device=device, timeout=5)
-        if stdout == u'':
+        stdout, stderr, exit_code = self.shell_auto_status('mkdir -p \'{}\''.format(folderpath), device=device, timeout=5)
+        if exit_code == 0:
             self.logger.info("folder_create: success")
         else:
-            self.logger.info("folder_create: %r", stdout)
+            self.logger.info("folder_create: %r", stderr or stdout)
             raise AdbFailException(SHELL_FAILED, stdout, stderr)
 
     def busybox_exist(self, device=None):
@@ -862,17 +1550,22 @@ class AdbAuto(AdbWrapper):
         '''
         self.logger.info("busybox_exist: start")
         self.root_auto(device)
-        stdout, stderr = self.shell_auto('busybox', device=device, timeout=5)
-        if u'Busybox' in stdout:
-            self.logger.info("busybox_exist: success")
-            res = True
-        elif u'not found' in stdout:
-            self.logger.info("busybox_exist: fail to found")
-            res = False
-        else:
-            self.logger.info("busybox_exist: %r", stdout)
-            raise AdbFailException(SHELL_FAILED, stdout, stderr)
-        return res
+        profile = self.device_profile(device)
+        with profile.lock:
+            if profile.busybox is not None:
+                return profile.busybox
+            stdout, stderr = self.shell_auto('busybox', device=device, timeout=5)
+            if u'Busybox' in stdout:
+                self.logger.info("busybox_exist: success")
+                res = True
+            elif u'not found' in stdout:
+                self.logger.info("busybox_exist: fail to found")
+                res = False
+            else:
+                self.logger.info("busybox_exist: %r", stdout)
+                raise AdbFailException(SHELL_FAILED, stdout, stderr)
+            profile.busybox = res
+            return res
 
     def interface_list_get(self, device=None):
         '''
@@ -890,21 +1583,23 @@ class AdbAuto(AdbWrapper):
         '''
         self.logger.info("interface_list_get: start")
         self.root_auto(device=device)
-        try:
-            version = self.android_sdk_version_get(device=device)
-        except AdbFailException:
-            self.logger.info("None-Android platform, may try ifconfig directly")
-            interface_re = self.ifconfig_re
-            cmd = u'ifconfig'
-        else:
-            if version < 23:
-                self.logger.info("interface_list_get: target system Android Version <= 5.0 (SDK 22)")
-                interface_re = self.netcfg_re
-                cmd = u'netcfg'
-            else:
-                self.logger.info("interface_list_get: target system Android Version >= 6.0 (SDK 23) or other Linux System")
-                interface_re = self.ifconfig_re
-                cmd = u'ifconfig'
+        profile = self.device_profile(device)
+        with profile.lock:
+            if profile.net_cmd is None:
+                try:
+                    version = self.android_sdk_version_get(device=device)
+                except AdbFailException:
+                    self.logger.info("None-Android platform, may try ifconfig directly")
+                    profile.net_cmd = u'ifconfig'
+                else:
+                    if version < 23:
+                        self.logger.info("interface_list_get: target system Android Version <= 5.0 (SDK 22)")
+                        profile.net_cmd = u'netcfg'
+                    else:
+                        self.logger.info("interface_list_get: target system Android Version >= 6.0 (SDK 23) or other Linux System")
+                        profile.net_cmd = u'ifconfig'
+            cmd = profile.net_cmd
+        interface_re = self.netcfg_re if cmd == u'netcfg' else self.ifconfig_re
         stdout, stderr = self.shell_auto(cmd, device=device, timeout=5)
         interfaces_list = []
         if not interface_re.search(stdout):
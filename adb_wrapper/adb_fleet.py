@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+'''
+Run one operation against many devices concurrently
+'''
+import os
+import time
+import logging
+import posixpath
+from io import open
+from collections import OrderedDict
+
+from .base_wrapper import Thread, Queue, Empty, Condition, FILE_TRANSFORM_TIMEOUT
+from .adb_sync import SYNC_DATA_MAX, SYNC_DEFAULT_MODE
+from .adb_auto import AdbAuto
+
+FLEET_MAX_WORKERS = 8  # Default max devices handled at the same time
+PUSH_MANY_WINDOW = 64  # Max SYNC_DATA_MAX blocks read ahead of the slowest device in push_many
+
+
+class FleetResult(object):
+    '''
+    Outcome of an operation on one device
+    result is return value if succeeded, exception is the raised exception if failed
+    '''
+    __slots__ = ('device', 'result', 'exception', 'duration')
+
+    def __init__(self, device, result=None, exception=None, duration=0.0):
+        self.device, self.result, self.exception, self.duration = device, result, exception, duration
+
+    @property
+    def ok(self):
+        return self.exception is None
+
+    def __repr__(self):
+        if self.ok:
+            return u'FleetResult({!r}: {!r}, {:.3f}s)'.format(self.device, self.result, self.duration)
+        return u'FleetResult({!r}: raise {!r}, {:.3f}s)'.format(self.device, self.exception, self.duration)
+
+
+class FleetResults(OrderedDict):
+    '''
+    device: FleetResult, same order as input devices
+    '''
+    @property
+    def succeeded(self):
+        return OrderedDict((device, res.result) for device, res in self.items() if res.ok)
+
+    @property
+    def failed(self):
+        return OrderedDict((device, res.exception) for device, res in self.items() if not res.ok)
+
+    def raise_first(self):
+        '''
+        Raise exception of first failed device, for callers who want fail-fast after all finish
+        '''
+        for res in self.values():
+            if not res.ok:
+                raise res.exception
+
+
+def run_all(func, devices, max_workers=FLEET_MAX_WORKERS, logger=None):
+    '''
+    Call func(device) for each device on a bounded thread pool
+    Exception of one device does not stop others
+    Input: func (callable), take device as only param
+           devices (list of str), SN/IP:Port
+           max_workers (int), max devices run at the same time
+    Output: FleetResults
+    '''
+    _logger = logger if logger else logging.getLogger('adb')
+    devices = list(OrderedDict.fromkeys(devices))
+    results = FleetResults((device, None) for device in devices)
+    tasks = Queue()
+    for device in devices:
+        tasks.put(device)
+
+    def worker():
+        while 1:
+            try:
+                device = tasks.get_nowait()
+            except Empty:
+                return
+            start_time = time.time()
+            try:
+                res = FleetResult(device, result=func(device))
+            except Exception as err:
+                _logger.error("run_all: %s fail: %r", device, err)
+                res = FleetResult(device, exception=err)
+            res.duration = time.time() - start_time
+            results[device] = res
+
+    threads = [Thread(target=worker, name=u'adb-fleet-{}'.format(num))
+               for num in range(max(1, min(max_workers, len(devices))))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+class _FanoutBuffer(object):
+    '''
+    Read source once in SYNC_DATA_MAX blocks, each block is kept until every reader got it
+    Source is read ahead of the slowest attached reader by at most window blocks
+    '''
+    def __init__(self, fileobj, count, window=PUSH_MANY_WINDOW):
+        self.fileobj, self.window = fileobj, max(1, window)
+        self.blocks = {}  # block index: bytes
+        self.base = 0  # Index of first kept block
+        self.next = 0  # Index of next block to read from source
+        self.positions = [0] * count  # Index of next block of each reader, None if detached
+        self.eof = False
+        self.error = None
+        self.cond = Condition()
+
+    def _slowest(self):
+        positions = [pos for pos in self.positions if pos is not None]
+        return min(positions) if positions else None
+
+    def _trim(self):
+        slowest = self._slowest()
+        limit = self.next if slowest is None else slowest
+        while self.base < limit:
+            self.blocks.pop(self.base, None)
+            self.base += 1
+
+    def fill(self):
+        '''
+        Read source until end or all readers detached, run in its own thread
+        '''
+        try:
+            while 1:
+                with self.cond:
+                    while self._slowest() is not None and self.next - self._slowest() >= self.window:
+                        self.cond.wait()
+                    if self._slowest() is None:
+                        return
+                block = self.fileobj.read(SYNC_DATA_MAX)
+                with self.cond:
+                    if not block:
+                        self.eof = True
+                        return
+                    self.blocks[self.next] = block
+                    self.next += 1
+                    self.cond.notify_all()
+        except Exception as err:
+            with self.cond:
+                self.error = err
+        finally:
+            with self.cond:
+                self.eof = True
+                self.cond.notify_all()
+
+    def read(self, num):
+        '''
+        Next block of reader num, b'' at end of source
+        '''
+        with self.cond:
+            pos = self.positions[num]
+            while pos >= self.next and not self.eof:
+                self.cond.wait()
+            if self.error is not None:
+                raise self.error
+            if pos >= self.next:
+                return b''
+            block = self.blocks[pos]
+            self.positions[num] = pos + 1
+            self._trim()
+            self.cond.notify_all()
+            return block
+
+    def detach(self, num):
+        '''
+        Reader num is done or failed, source no longer wait for it
+        '''
+        with self.cond:
+            self.positions[num] = None
+            self._trim()
+            self.cond.notify_all()
+
+
+class _FanoutReader(object):
+    '''
+    File object of one reader of _FanoutBuffer, read() return one block whatever size is asked
+    '''
+    def __init__(self, buf, num):
+        self.buf, self.num = buf, num
+
+    def read(self, size=-1):
+        return self.buf.read(self.num)
+
+
+def push_many(src, dst, devices, adb=None, timeout=FILE_TRANSFORM_TIMEOUT, window=PUSH_MANY_WINDOW,
+              max_workers=FLEET_MAX_WORKERS, logger=None):
+    '''
+    Push one local file to many devices at the same time, the file is read only once for each max_workers devices
+    Every device is fed by its own push_stream (sync protocol if adb use_server_socket) from a shared buffer,
+    which read ahead of the slowest device by at most window blocks, so memory is bounded and fast devices wait
+    Devices more than max_workers are pushed in rounds, next round start after all devices of last round finish
+    Device failed is detached from the buffer, it does not stop others
+    Input: src(str), local file path / (file object opened as binary), read from current position to end,
+                     file object must be seekable if devices more than max_workers
+           dst(str), remote file path, or remote folder ending with '/' to keep file name of src
+           devices (list of str), SN/IP:Port
+           adb (AdbWrapper/AdbAuto), None for a new AdbAuto
+           timeout(int/float), for each device
+           window(int), max SYNC_DATA_MAX blocks read ahead of the slowest device
+           max_workers (int), max devices pushed at the same time
+    Output: FleetResults, result is bytes pushed, throughput of device is result / duration
+    '''
+    adb = adb if adb is not None else AdbAuto(logger=logger)
+    _logger = logger if logger else adb.logger
+    devices = list(OrderedDict.fromkeys(devices))
+    mode, mtime = SYNC_DEFAULT_MODE, None
+    if hasattr(src, 'read'):
+        fileobj, name = src, getattr(src, 'name', None)
+    else:
+        fileobj, name = open(src, 'rb'), src
+        file_stat = os.fstat(fileobj.fileno())
+        mode, mtime = file_stat.st_mode, int(file_stat.st_mtime)
+    if dst.endswith(u'/'):
+        if not isinstance(name, (type(u''), type(''))):
+            raise ValueError(u'dst must be file path if src has no name')
+        dst = posixpath.join(dst, os.path.basename(name))
+    _logger.info("push_many: %s -> %s, %d devices", name, dst, len(devices))
+    max_workers = max(1, max_workers)
+    results = FleetResults((device, None) for device in devices)
+    try:
+        start = None
+        if len(devices) > max_workers:
+            try:
+                start = fileobj.tell()
+            except (IOError, OSError, AttributeError):
+                raise ValueError(u'src must be seekable if devices more than max_workers')
+        for offset in range(0, len(devices), max_workers):
+            if offset:
+                fileobj.seek(start)
+            results.update(_push_round(adb, fileobj, dst, devices[offset:offset + max_workers], timeout, window,
+                                       mode, mtime, _logger))
+    finally:
+        if fileobj is not src:
+            fileobj.close()
+    for device, res in results.items():
+        if res.ok:
+            _logger.info("push_many: %s %d bytes in %.3fs, %.2f MB/s", device, res.result, res.duration,
+                         res.result / max(res.duration, 1e-6) / 1024 / 1024)
+    return results
+
+
+def _push_round(adb, fileobj, dst, devices, timeout, window, mode, mtime, logger):
+    '''
+    One round of push_many, read fileobj once for all devices pushed at the same time
+    Output: FleetResults
+    '''
+    buf = _FanoutBuffer(fileobj, len(devices), window)
+    index = dict((device, num) for num, device in enumerate(devices))
+
+    def push(device):
+        try:
+            return adb.push_stream(_FanoutReader(buf, index[device]), dst, device=device, timeout=timeout,
+                                   mode=mode, mtime=mtime)
+        finally:
+            buf.detach(index[device])
+
+    filler = Thread(target=buf.fill, name=u'adb-fleet-fanout')
+    filler.daemon = True
+    filler.start()
+    results = run_all(push, devices, max_workers=len(devices), logger=logger)
+    filler.join()
+    return results
+
+
+class AdbFleet(object):
+    '''
+    Group of devices, run any AdbWrapper/AdbAuto method on all of them concurrently
+    e.g. AdbFleet(['SN1', 'SN2']).map('install_auto', 'a.apk')
+    All devices share one adb (AdbAuto by default), the method is called with device=<device>
+    '''
+    def __init__(self, devices, adb=None, max_workers=FLEET_MAX_WORKERS, logger=None):
+        self.devices = list(devices)
+        self.adb = adb if adb is not None else AdbAuto(logger=logger)
+        self.logger = logger if logger else self.adb.logger
+        self.max_workers = max_workers
+
+    def map(self, method, *args, **kwargs):
+        '''
+        Input: method (str), name of AdbWrapper/AdbAuto method / (callable), called as method(*args, device=..., **kwargs)
+               args/kwargs, params of method except device
+        Output: FleetResults
+        '''
+        func = getattr(self.adb, method) if not callable(method) else method
+        self.logger.info("fleet: %s on %d devices", getattr(func, '__name__', method), len(self.devices))
+
+        def call(device):
+            _kwargs = dict(kwargs)
+            _kwargs['device'] = device
+            return func(*args, **_kwargs)
+        return run_all(call, self.devices, self.max_workers, self.logger)
+
+    def push_many(self, src, dst, timeout=FILE_TRANSFORM_TIMEOUT, window=PUSH_MANY_WINDOW):
+        '''
+        Push one local file to all devices, read it only once, see push_many
+        Output: FleetResults
+        '''
+        return push_many(src, dst, self.devices, adb=self.adb, timeout=timeout, window=window,
+                         max_workers=self.max_workers, logger=self.logger)
+
+    def __getattr__(self, name):
+        '''
+        fleet.shell_auto('id') is same as fleet.map('shell_auto', 'id')
+        '''
+        if name.startswith('_') or not callable(getattr(self.__dict__.get('adb'), name, None)):
+            raise AttributeError(name)
+        return lambda *args, **kwargs: self.map(name, *args, **kwargs)
@@ -0,0 +1,744 @@
+# -*- coding: utf-8 -*-
+import socket
+import select
+import struct
+import time
+import logging
+
+from .base_wrapper import BaseWrapperException
+from .base_wrapper import ignored
+from .base_wrapper import Thread, Condition, current_thread
+from .base_wrapper import _to_unicode, _to_utf8
+
+ADB_SERVER_HOST = u'127.0.0.1'  # adb server only listen on localhost by default
+ADB_SERVER_CONNECT_TIMEOUT = 3  # Default timeout for connect to adb server
+SOCKET_READ_SIZE = 65536  # Max bytes read from adb server socket once
+POOL_IDLE_TIMEOUT = 60  # Warm transport socket idle longer than this will be dropped
+TRACKER_RETRY_GAP = 1  # DeviceTracker reconnect gap after adb server stream lost
+
+# shell protocol v2 packet id
+SHELL_V2_STDIN = 0
+SHELL_V2_STDOUT = 1
+SHELL_V2_STDERR = 2
+SHELL_V2_EXIT = 3
+SHELL_V2_CLOSE_STDIN = 4
+SHELL_V2_WINDOW_SIZE_CHANGE = 5
+SHELL_V2_STDIN_MAX = 4096 - 5  # Max stdin packet payload, adbd of MAX_PAYLOAD 4K buffer one packet in 4K
+
+
+class AdbServerException(BaseWrapperException):
+    def __init__(self, msg=None):
+        super(AdbServerException, self).__init__(msg)
+        self.msg = msg
+
+class AdbServerUnavailable(AdbServerException):
+    '''Fail to connect adb server socket, adb server may not start'''
+    pass
+
+class AdbServerFail(AdbServerException):
+    '''adb server reply FAIL with reason'''
+    pass
+
+class AdbServerTimeout(AdbServerException):
+    def __init__(self, msg=None, data=b''):
+        super(AdbServerTimeout, self).__init__(msg)
+        self.data = data
+
+
+class AdbServerConnection(object):
+    '''
+    One socket to adb server (smart socket protocol)
+    request: 4 hex chars length + payload
+    reply: OKAY / FAIL + 4 hex chars length + reason
+    After a service request (shell:/exec:/...) accepted, the socket becomes
+    the service stream, it cannot be used for another request
+    '''
+    def __init__(self, host=ADB_SERVER_HOST, port=None, timeout=ADB_SERVER_CONNECT_TIMEOUT, logger=None):
+        self.logger = logger if logger else logging.getLogger('adb')
+        self.host, self.port = host, port
+        try:
+            self.sock = socket.create_connection((host, port), timeout)
+        except (socket.error, OSError) as err:
+            self.logger.error("adb server %s:%s connect fail: %s", host, port, err)
+            raise AdbServerUnavailable(u"{}".format(err))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.pooled = False  # Whether borrowed from AdbServerConnectionPool
+
+    def __del__(self):
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def settimeout(self, timeout):
+        '''
+        Input: timeout [int/float/None(infinite)] for every socket operation
+        '''
+        self.sock.settimeout(timeout)
+
+    def healthy(self):
+        '''
+        Check idle socket is still usable
+        Idle socket should never be readable, readable means closed by adb server
+        '''
+        if self.sock is None:
+            return False
+        try:
+            readable, _, _ = select.select([self.sock], [], [], 0)
+        except (select.error, socket.error, OSError, ValueError):
+            return False
+        return not readable
+
+    def close(self):
+        sock = getattr(self, 'sock', None)
+        if sock is not None:
+            with ignored(socket.error, OSError):
+                sock.close()
+            self.sock = None
+
+    def shutdown(self):
+        '''
+        Wake up send/read blocked in other thread, socket cannot be used after it
+        '''
+        sock = getattr(self, 'sock', None)
+        if sock is not None:
+            with ignored(socket.error, OSError):
+                sock.shutdown(socket.SHUT_RDWR)
+
+    def send(self, data):
+        try:
+            self.sock.sendall(data)
+        except socket.timeout:
+            raise AdbServerTimeout(u'send timeout')
+        except (socket.error, OSError) as err:
+            raise AdbServerException(u"{}".format(err))
+
+    def read(self, size=SOCKET_READ_SIZE):
+        '''
+        Read at most size bytes, return b'' once socket closed
+        '''
+        try:
+            return self.sock.recv(size)
+        except socket.timeout:
+            raise AdbServerTimeout(u'read timeout')
+        except (socket.error, OSError) as err:
+            raise AdbServerException(u"{}".format(err))
+
+    def read_exactly(self, size):
+        chunks = []
+        while size > 0:
+            chunk = self.read(min(size, SOCKET_READ_SIZE))
+            if not chunk:
+                raise AdbServerException(u'connection closed by adb server')
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b''.join(chunks)
+
+    def read_into(self, view):
+        '''
+        Fill whole view(memoryview) from socket, no extra copy
+        '''
+        offset, size = 0, len(view)
+        while offset < size:
+            try:
+                num = self.sock.recv_into(view[offset:], size - offset)
+            except socket.timeout:
+                raise AdbServerTimeout(u'read timeout')
+            except (socket.error, OSError) as err:
+                raise AdbServerException(u"{}".format(err))
+            if not num:
+                raise AdbServerException(u'connection closed by adb server')
+            offset += num
+
+    def read_all(self):
+        '''
+        Read until adb server close socket
+        If timeout, raise AdbServerTimeout with received data
+        '''
+        chunks = []
+        while 1:
+            try:
+                chunk = self.read()
+            except AdbServerTimeout as err:
+                err.data = b''.join(chunks)
+                raise
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return b''.join(chunks)
+
+    def read_hex_string(self):
+        '''
+        Read 4 hex chars length + payload
+        '''
+        length = int(self.read_exactly(4), 16)
+        return self.read_exactly(length)
+
+    def request(self, service):
+        '''
+        Send service request, check OKAY/FAIL
+        Input: service(str), such as host:version / shell:ls
+        Output: None
+        Raise AdbServerFail with reason if reply FAIL
+        '''
+        _service = _to_utf8(service)
+        self.logger.debug("adb server request: %r", _service)
+        self.send(u'{:04x}'.format(len(_service)).encode('ascii') + _service)
+        status = self.read_exactly(4)
+        if status == b'OKAY':
+            return
+        elif status == b'FAIL':
+            reason = _to_unicode(self.read_hex_string())
+            self.logger.error("adb server request %r fail: %s", _service, reason)
+            raise AdbServerFail(reason)
+        else:
+            raise AdbServerException(u'Invalid adb server status: {!r}'.format(status))
+
+
+class AdbServerConnectionPool(object):
+    '''
+    Keep pre-negotiated host:transport:<serial> sockets warm for each device
+    One transport socket can only run one service, so every acquired socket
+    is replaced by a background warmer thread (one thread for the whole pool)
+    Sockets closed by adb server (device drop) are found by health check and dropped
+    Device not acquired for idle_timeout is not warmed any more, its sockets are closed
+    '''
+    def __init__(self, client, size=2, idle_timeout=POOL_IDLE_TIMEOUT):
+        self.client = client
+        self.logger = client.logger
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self._idle = {}  # serial: [(AdbServerConnection, create_time), ...]
+        self._acquired = {}  # serial: last acquire time, devices to keep warm
+        self._cond = Condition()
+        self._closed = False
+        self._thread = None
+
+    def acquire(self, serial, timeout=None):
+        '''
+        Borrow a transport socket of serial, it will not come back to pool
+        Output: AdbServerConnection, ready for one device service request
+        '''
+        conn = None
+        with self._cond:
+            self._acquired[serial] = time.time()
+            idle = self._idle.get(serial, [])
+            while idle:
+                _conn, create_time = idle.pop()
+                if time.time() - create_time < self.idle_timeout and _conn.healthy():
+                    conn = _conn
+                    break
+                self.logger.debug("pool: drop stale transport socket of %s", serial)
+                _conn.close()
+            self._cond.notify()
+            if self._thread is None and not self._closed:
+                self._thread = Thread(target=self._warm, name='adb_wrapper-AdbServerConnectionPool')
+                self._thread.daemon = True
+                self._thread.start()
+        if conn is None:
+            return self.client.new_transport(serial, timeout)
+        conn.pooled = True
+        conn.settimeout(timeout)
+        return conn
+
+    def evict(self, serial=None):
+        '''
+        Close warm sockets of serial (None for all devices) and stop refill it
+        Should be called once device drop
+        '''
+        with self._cond:
+            serials = list(self._idle) if serial is None else [serial]
+            for _serial in serials:
+                self._drop(_serial)
+        self.logger.info("pool: evict %s", u'all' if serial is None else serial)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self.evict()
+
+    def _drop(self, serial):
+        '''
+        Forget serial and close its warm sockets, hold self._cond when call it
+        '''
+        self._acquired.pop(serial, None)
+        for conn, _ in self._idle.pop(serial, []):
+            conn.close()
+
+    def _warm(self):
+        while 1:
+            with self._cond:
+                serial = None
+                while serial is None:
+                    if self._closed:
+                        return
+                    now = time.time()
+                    for _serial, acquire_time in list(self._acquired.items()):
+                        if now - acquire_time >= self.idle_timeout:
+                            self.logger.debug("pool: %s idle, stop warming it", _serial)
+                            self._drop(_serial)
+                        elif serial is None and len(self._idle.get(_serial, [])) < self.size:
+                            serial = _serial
+                    if serial is None:
+                        self._cond.wait(self.idle_timeout)
+            try:
+                conn = self.client.new_transport(serial)
+            except AdbServerException as err:
+                self.logger.warning("pool: fail to warm transport socket of %s: %s", serial, err.msg)
+                self.evict(serial)
+                continue
+            with self._cond:
+                if serial in self._acquired and not self._closed:
+                    self._idle.setdefault(serial, []).append((conn, time.time()))
+                    conn = None
+            if conn is not None:
+                conn.close()
+
+
+class DeviceTracker(object):
+    '''
+    Live device table kept by adb server host:track-devices stream (one background thread)
+    adb server pushes whole device list once connected and every time any device state changes
+    If stream lost (adb server restart), table is not ready until reconnected
+    Callback: func(serial, old_state, new_state), state None means not in device list
+              called from tracker thread, should not block
+    Pooled sockets of device leaving device state are evicted before callbacks
+    '''
+    def __init__(self, client, retry_gap=TRACKER_RETRY_GAP):
+        self.client = client
+        self.logger = client.logger
+        self.retry_gap = retry_gap
+        self._devices = {}  # serial: state
+        self._ready = False
+        self._cond = Condition()
+        self._callbacks = []
+        self._conn = None
+        self._stopped = False
+        self._thread = None
+
+    def start(self):
+        with self._cond:
+            if self._thread is None:
+                self._stopped = False
+                self._thread = Thread(target=self._track, name='adb_wrapper-DeviceTracker')
+                self._thread.daemon = True
+                self._thread.start()
+        return self
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._ready = False
+            conn, thread = self._conn, self._thread
+            self._thread = None
+            self._cond.notify_all()
+        if conn is not None:
+            # Wake up blocking read of tracker thread
+            with ignored(socket.error, OSError, AttributeError):
+                conn.sock.shutdown(socket.SHUT_RDWR)
+        if thread is not None and thread is not current_thread():
+            thread.join()
+
+    @property
+    def ready(self):
+        '''
+        True if table is in sync with adb server
+        '''
+        return self._ready
+
+    def add_callback(self, func):
+        with self._cond:
+            self._callbacks.append(func)
+
+    def remove_callback(self, func):
+        with self._cond:
+            with ignored(ValueError):
+                self._callbacks.remove(func)
+
+    def devices(self):
+        '''
+        Output: {serial: state} copy of device table
+        '''
+        with self._cond:
+            return dict(self._devices)
+
+    def state(self, serial):
+        '''
+        Output: state(str) such as device/offline/unauthorized, None if not in device list
+        '''
+        with self._cond:
+            return self._devices.get(serial)
+
+    def wait_for(self, predicate, timeout=None):
+        '''
+        Block until predicate(device table) is True
+        Input: predicate (function), take {serial: state}
+               timeout [int/float/None(infinite)]
+        Output: True / False [Timeout or tracker stopped]
+        '''
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while not (self._ready and predicate(self._devices)):
+                if self._stopped:
+                    return False
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+    def wait_for_state(self, serial, state=u'device', timeout=None):
+        '''
+        Block until serial in state, state None means serial gone
+        Output: True / False [Timeout]
+        '''
+        return self.wait_for(lambda devices: devices.get(serial) == state, timeout)
+
+    def _track(self):
+        while not self._stopped:
+            try:
+                conn = self.client.connection()
+            except AdbServerUnavailable:
+                self._update(None)
+                self._retry_wait()
+                continue
+            with self._cond:
+                if self._stopped:
+                    conn.close()
+                    return
+                self._conn = conn
+            try:
+                conn.settimeout(None)
+                conn.request(u'host:track-devices')
+                while 1:
+                    self._update(_to_unicode(conn.read_hex_string()))
+            except AdbServerException as err:
+                if not self._stopped:
+                    self.logger.warning("tracker: track-devices stream lost: %s", err.msg)
+            except ValueError as err:
+                self.logger.error("tracker: invalid track-devices reply: %s", err)
+            finally:
+                conn.close()
+                with self._cond:
+                    self._conn = None
+            self._update(None)
+            self._retry_wait()
+
+    def _retry_wait(self):
+        with self._cond:
+            if not self._stopped:
+                self._cond.wait(self.retry_gap)
+
+    def _update(self, text):
+        '''
+        Apply device list text from adb server, None means stream lost (table not ready)
+        '''
+        changes = []
+        with self._cond:
+            if text is None:
+                self._ready = False
+                self._cond.notify_all()
+                return
+            devices = {}
+            for line in text.splitlines():
+                serial, _, state = line.partition(u'\t')
+                if serial:
+                    devices[serial] = state.strip()
+            for serial in set(self._devices) | set(devices):
+                old_state, new_state = self._devices.get(serial), devices.get(serial)
+                if old_state != new_state:
+                    changes.append((serial, old_state, new_state))
+            self._devices = devices
+            self._ready = True
+            callbacks = list(self._callbacks)
+        for serial, old_state, new_state in changes:
+            self.logger.info("tracker: %s %s -> %s", serial, old_state, new_state)
+            if old_state == u'device':
+                self.client.evict(serial)
+            for func in callbacks:
+                try:
+                    func(serial, old_state, new_state)
+                except Exception as err:
+                    self.logger.error("tracker: callback %r fail: %r", func, err)
+        # Wake up waiters after callbacks, so state reset by callbacks is done once wait_for return
+        with self._cond:
+            self._cond.notify_all()
+
+
+class ShellV2Stdin(object):
+    '''
+    Write only file object, send data as shell protocol v2 stdin packets
+    close() tell remote command its stdin is closed, connection is still open for output
+    '''
+    def __init__(self, conn):
+        self.conn = conn
+        self.closed = False
+
+    def write(self, data):
+        data = memoryview(data)
+        for offset in range(0, len(data), SHELL_V2_STDIN_MAX):
+            chunk = data[offset:offset + SHELL_V2_STDIN_MAX]
+            self.conn.send(struct.pack('<BI', SHELL_V2_STDIN, len(chunk)) + chunk.tobytes())
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.conn.send(struct.pack('<BI', SHELL_V2_CLOSE_STDIN, 0))
+
+
+class AdbServerClient(object):
+    '''
+    Pure Python client for adb server smart socket protocol
+    It talks to adb server (default localhost:5037) directly without spawning adb
+    Every host method open a new socket
+    Device services borrow transport socket from pool if pool_size > 0
+    '''
+    def __init__(self, host=ADB_SERVER_HOST, port=5037, timeout=ADB_SERVER_CONNECT_TIMEOUT,
+                 logger=None, pool_size=0):
+        self.logger = logger if logger else logging.getLogger('adb')
+        self.host, self.port, self.timeout = host, port, timeout
+        self.pool = AdbServerConnectionPool(self, pool_size) if pool_size > 0 else None
+        self._features = {}  # serial: features(set), cleared by evict
+
+    def connection(self):
+        '''
+        Output: AdbServerConnection (new socket to adb server)
+        '''
+        return AdbServerConnection(self.host, self.port, self.timeout, self.logger)
+
+    def _host_request(self, service):
+        '''
+        Run host service which reply OKAY + hex string
+        Output: reply(bytes)
+        '''
+        with self.connection() as conn:
+            conn.request(service)
+            return conn.read_hex_string()
+
+    def version(self):
+        '''
+        Get adb server internal version
+        Output: version(int), such as 41
+        '''
+        return int(self._host_request(u'host:version'), 16)
+
+    def devices(self):
+        '''
+        Get device list text from host:devices
+        Output: devices text, each line as "serial\\tstate"(str)
+        '''
+        return _to_unicode(self._host_request(u'host:devices'))
+
+    def features(self, serial):
+        '''
+        Get features supported by both adb server and device
+        Output: features(set of str)
+        '''
+        reply = _to_unicode(self._host_request(u'host-serial:{}:features'.format(serial)))
+        return set(reply.split(u',')) if reply else set()
+
+    def has_feature(self, serial, feature):
+        '''
+        Check feature (such as shell_v2) supported, features are queried once for each device
+        Output: bool
+        '''
+        features = self._features.get(serial)
+        if features is None:
+            features = self._features[serial] = self.features(serial)
+        return feature in features
+
+    def connect(self, address):
+        '''
+        adb connect by host:connect
+        Output: reply message(str), same as adb connect stdout
+        '''
+        return _to_unicode(self._host_request(u'host:connect:{}'.format(address)))
+
+    def disconnect(self, address=None):
+        '''
+        adb disconnect by host:disconnect, address None will disconnect all
+        Output: reply message(str)
+        '''
+        return _to_unicode(self._host_request(u'host:disconnect:{}'.format(address if address else u'')))
+
+    def new_transport(self, serial, timeout=None):
+        '''
+        Open a new socket and switch it to target device
+        Output: AdbServerConnection, ready for one device service request
+        '''
+        conn = self.connection()
+        try:
+            if serial:
+                conn.request(u'host:transport:{}'.format(serial))
+            else:
+                conn.request(u'host:transport-any')
+        except AdbServerFail:
+            conn.close()
+            # Device drop, warm sockets of it are useless
+            if serial:
+                self.evict(serial)
+            raise
+        except Exception:
+            conn.close()
+            raise
+        conn.settimeout(timeout)
+        return conn
+
+    def transport(self, serial, timeout=None):
+        '''
+        Get a socket switched to target device, from pool if enabled
+        Output: AdbServerConnection, ready for one device service request
+        '''
+        if self.pool is not None and serial:
+            return self.pool.acquire(serial, timeout)
+        return self.new_transport(serial, timeout)
+
+    def evict(self, serial=None):
+        '''
+        Drop pooled sockets of serial (None for all), call it once device drop
+        '''
+        if serial is None:
+            self._features.clear()
+        else:
+            self._features.pop(serial, None)
+        if self.pool is not None:
+            self.pool.evict(serial)
+
+    def open_service(self, serial, service, timeout=None):
+        '''
+        Request device service, retry once by new socket if pooled socket is broken
+        Output: AdbServerConnection, the service stream
+        '''
+        conn = self.transport(serial, timeout)
+        try:
+            conn.request(service)
+        except AdbServerFail:
+            conn.close()
+            raise
+        except AdbServerException:
+            conn.close()
+            if not conn.pooled:
+                raise
+            self.logger.warning("pooled transport socket of %s broken, retry by new socket", serial)
+            conn = self.new_transport(serial, timeout)
+            try:
+                conn.request(service)
+            except Exception:
+                conn.close()
+                raise
+        return conn
+
+    def service(self, serial, service, timeout=None):
+        '''
+        Run device service, read all output until socket closed
+        Input: serial(str)
+               service(str), such as shell:ls / exec:screencap -p / root:
+               timeout [int/float/None(infinite)]
+        Output: output(bytes)
+        '''
+        with self.open_service(serial, service, timeout) as conn:
+            return conn.read_all()
+
+    def shell(self, serial, cmd, timeout=None):
+        '''
+        adb shell by shell: service, stdout/stderr are mixed
+        Output: output(bytes)
+        '''
+        return self.service(serial, u'shell:{}'.format(_to_unicode(cmd)), timeout)
+
+    def shell_v2(self, serial, cmd, timeout=None, stdin=None):
+        '''
+        adb shell by shell protocol v2 (shell,v2,raw:), need device feature shell_v2
+        Packet: 1 byte id + uint32 little endian length + payload
+        Input: stdin(function), called as stdin(fileobj) in a writer thread while output is read, data written
+                                to fileobj is sent to stdin of cmd, then stdin of cmd is closed
+        Output: stdout(bytes)
+                stderr(bytes)
+                exit_code(int)
+        If timeout, raise AdbServerTimeout with received stdout
+        '''
+        stdout, stderr, errors = [], [], []
+        with self.open_service(serial, u'shell,v2,raw:{}'.format(_to_unicode(cmd)), timeout) as conn:
+
+            def feed():
+                try:
+                    writer = ShellV2Stdin(conn)
+                    stdin(writer)
+                    writer.close()
+                except AdbServerTimeout as err:
+                    errors.append(err)
+                    conn.shutdown()
+                except AdbServerException as err:
+                    # Command may exit before read all stdin, its output and exit code tell why
+                    self.logger.warning("shell v2: stdin closed by remote - %s", err.msg)
+                except Exception as err:
+                    # stdin of cmd is never closed, stop reading output
+                    errors.append(err)
+                    conn.shutdown()
+
+            feeder = None
+            if stdin is not None:
+                # Output is read at the same time, or both ends block once output fill socket buffers
+                feeder = Thread(target=feed, name=u'adb-shell-v2-stdin')
+                feeder.daemon = True
+                feeder.start()
+            try:
+                while 1:
+                    try:
+                        packet_id, length = struct.unpack('<BI', conn.read_exactly(5))
+                        payload = conn.read_exactly(length)
+                    except AdbServerException as err:
+                        err = errors[0] if errors else err
+                        if isinstance(err, AdbServerTimeout):
+                            err.data = b''.join(stdout)
+                        raise err
+                    if packet_id == SHELL_V2_STDOUT:
+                        stdout.append(payload)
+                    elif packet_id == SHELL_V2_STDERR:
+                        stderr.append(payload)
+                    elif packet_id == SHELL_V2_EXIT:
+                        return b''.join(stdout), b''.join(stderr), bytearray(payload)[0]
+                    else:
+                        self.logger.debug("shell v2: ignore packet %d", packet_id)
+            finally:
+                if feeder is not None:
+                    if feeder.is_alive():
+                        # Command exit before read all stdin, writer may block on send
+                        conn.shutdown()
+                    feeder.join()
+
+    def exec_out(self, serial, cmd, timeout=None):
+        '''
+        adb exec-out by exec: service, output is raw (no pty)
+        Output: output(bytes)
+        '''
+        return self.service(serial, u'exec:{}'.format(_to_unicode(cmd)), timeout)
+
+    def reboot(self, serial, mode=None, timeout=None):
+        '''
+        adb reboot by reboot: service
+        Output: output(bytes)
+        '''
+        return self.service(serial, u'reboot:{}'.format(mode if mode else u''), timeout)
+
+    def root(self, serial, timeout=None):
+        '''
+        adb root by root: service
+        Output: output(bytes), such as "restarting adbd as root"
+        '''
+        return self.service(serial, u'root:', timeout)
+
+    def unroot(self, serial, timeout=None):
+        '''
+        adb unroot by unroot: service
+        Output: output(bytes)
+        '''
+        return self.service(serial, u'unroot:', timeout)
@@ -0,0 +1,400 @@
+# -*- coding: utf-8 -*-
+import os
+import stat
+import struct
+import time
+import posixpath
+from io import open
+
+from .base_wrapper import _to_unicode, _to_utf8
+from .base_wrapper import Thread
+from .adb_server import AdbServerException, AdbServerTimeout
+
+SYNC_DATA_MAX = 64 * 1024  # Max DATA packet payload of adb sync protocol
+SYNC_DEFAULT_MODE = 0o100644  # Remote file mode if local mode is not available
+SYNC_FILE_COST = 64 * 1024  # Bytes one file cost besides its data (round trips), for balance of streams
+SYNC_LINK_DEPTH = 8  # Max symlinks to folder followed in one path of sync_pull, stop symlink loop
+
+
+class AdbSyncFail(AdbServerException):
+    '''sync request FAIL on device, msg is reason from adbd'''
+    pass
+
+
+class FileTransfer(object):
+    '''
+    One file transferred by sync protocol
+    '''
+    __slots__ = ('src', 'dst', 'size', 'duration')
+
+    def __init__(self, src, dst, size, duration):
+        self.src, self.dst, self.size, self.duration = src, dst, size, duration
+
+    @property
+    def throughput(self):
+        '''
+        Output: bytes per second (float)
+        '''
+        return self.size / self.duration if self.duration > 0 else float(self.size)
+
+    def __repr__(self):
+        return u'FileTransfer({!r} -> {!r}, {} bytes, {:.3f}s)'.format(self.src, self.dst, self.size, self.duration)
+
+
+class TransferResult(list):
+    '''
+    List of destination paths (same as what pull returns before)
+    with per-file FileTransfer records in files
+    '''
+    def __init__(self):
+        super(TransferResult, self).__init__()
+        self.files = []
+        self.duration = 0.0
+
+    def add(self, transfer):
+        self.files.append(transfer)
+        self.append(transfer.dst)
+
+    @property
+    def total_bytes(self):
+        return sum(transfer.size for transfer in self.files)
+
+    @property
+    def throughput(self):
+        '''
+        Output: bytes per second (float) for the whole transfer
+        '''
+        return self.total_bytes / self.duration if self.duration > 0 else float(self.total_bytes)
+
+
+class AdbSyncConnection(object):
+    '''
+    adb sync service (sync:) on one transport socket
+    Packet: 4 bytes id + uint32 little endian length/argument + payload
+    Support STAT / LIST / SEND / RECV, file data is streamed in SYNC_DATA_MAX chunks
+    '''
+    def __init__(self, client, serial, timeout=None):
+        self.logger = client.logger
+        self.client = client
+        self.serial = serial
+        self.deadline = None if timeout is None else time.time() + timeout
+        self.conn = client.open_service(serial, u'sync:', timeout)
+        self._buffer = bytearray(SYNC_DATA_MAX)
+        self._view = memoryview(self._buffer)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self.conn is not None:
+            try:
+                self.conn.send(b'QUIT' + struct.pack('<I', 0))
+            except AdbServerException:
+                pass
+            self.conn.close()
+            self.conn = None
+
+    def _check_deadline(self):
+        if self.deadline is not None and time.time() > self.deadline:
+            raise AdbServerTimeout(u'sync timeout')
+
+    def _send_request(self, sync_id, path):
+        _path = _to_utf8(path)
+        self.conn.send(sync_id + struct.pack('<I', len(_path)) + _path)
+
+    def _read_header(self):
+        header = self.conn.read_exactly(8)
+        return header[:4], struct.unpack('<I', header[4:])[0]
+
+    def _read_fail(self, length):
+        reason = _to_unicode(self.conn.read_exactly(length))
+        self.logger.error("sync fail: %s", reason)
+        raise AdbSyncFail(reason)
+
+    def stat(self, path):
+        '''
+        Input: path(str), remote path
+        Output: (mode, size, mtime), mode == 0 means no such file
+        '''
+        self._send_request(b'STAT', path)
+        data = self.conn.read_exactly(16)
+        if data[:4] != b'STAT':
+            raise AdbServerException(u'Invalid STAT reply: {!r}'.format(data[:4]))
+        return struct.unpack('<III', data[4:])
+
+    def listdir(self, path):
+        '''
+        Input: path(str), remote folder path
+        Output: generator of (name, mode, size, mtime), without . and ..
+        '''
+        self._send_request(b'LIST', path)
+        while 1:
+            data = self.conn.read_exactly(20)
+            sync_id = data[:4]
+            if sync_id == b'DONE':
+                return
+            if sync_id != b'DENT':
+                raise AdbServerException(u'Invalid LIST reply: {!r}'.format(sync_id))
+            mode, size, mtime, namelen = struct.unpack('<IIII', data[4:])
+            name = _to_unicode(self.conn.read_exactly(namelen))
+            if name in (u'.', u'..'):
+                continue
+            yield name, mode, size, mtime
+
+    def send(self, fileobj, remote_path, mode=SYNC_DEFAULT_MODE, mtime=None):
+        '''
+        Stream fileobj to remote_path
+        Input: fileobj(file object opened as binary)
+               remote_path(str)
+               mode(int), remote file mode
+               mtime(int), remote file mtime, None for now
+        Output: bytes sent(int)
+        '''
+        self._send_request(b'SEND', u'{},{}'.format(_to_unicode(remote_path), mode))
+        total = 0
+        # File object without readinto (such as some wrapper streams) is read by read()
+        readinto = getattr(fileobj, 'readinto', None)
+        while 1:
+            self._check_deadline()
+            if readinto is not None:
+                num = readinto(self._buffer)
+                data = self._view[:num] if num else None
+            else:
+                data = fileobj.read(SYNC_DATA_MAX)
+                num = len(data)
+            if not num:
+                break
+            self.conn.send(b'DATA' + struct.pack('<I', num))
+            self.conn.send(data)
+            total += num
+        self.conn.send(b'DONE' + struct.pack('<I', int(time.time() if mtime is None else mtime)))
+        sync_id, length = self._read_header()
+        if sync_id == b'FAIL':
+            self._read_fail(length)
+        elif sync_id != b'OKAY':
+            raise AdbServerException(u'Invalid SEND reply: {!r}'.format(sync_id))
+        return total
+
+    def recv(self, remote_path, fileobj):
+        '''
+        Stream remote_path into fileobj
+        Input: remote_path(str)
+               fileobj(file object opened as binary)
+        Output: bytes received(int)
+        '''
+        self._send_request(b'RECV', remote_path)
+        total = 0
+        while 1:
+            self._check_deadline()
+            sync_id, length = self._read_header()
+            if sync_id == b'DONE':
+                return total
+            elif sync_id == b'FAIL':
+                self._read_fail(length)
+            elif sync_id != b'DATA' or length > SYNC_DATA_MAX:
+                raise AdbServerException(u'Invalid RECV reply: {!r}'.format(sync_id))
+            self.conn.read_into(self._view[:length])
+            fileobj.write(self._view[:length])
+            total += length
+
+
+def sync_push(sync, src, dst, logger, streams=1):
+    '''
+    Same path rule as adb push
+    file -> dst, or dst/basename(src) if dst is remote folder
+    folder -> dst/basename(src)/... if dst is remote folder, else dst/...
+    list of file/folder -> dst/basename(item)..., dst must be remote folder
+    Sync protocol can only create folders of files sent, empty local folders are not created on remote
+    Input: sync(AdbSyncConnection)
+           src(str / list of str), local file/folder
+           dst(str), remote file/folder
+           streams(int), files are sent by this number of sync connections at the same time
+    Output: TransferResult
+    '''
+    start_time = time.time()
+    result = _transfer_pairs(sync, sync_push_plan(sync, src, dst), sync_push_file, logger, streams)
+    result.duration = time.time() - start_time
+    return result
+
+
+def sync_push_plan(sync, src, dst):
+    '''
+    Output: list of (local file, remote file, size) of sync_push
+    '''
+    srcs = src if isinstance(src, (list, tuple)) else [src]
+    for item in srcs:
+        if not os.path.exists(item):
+            raise AdbSyncFail(u'{}: No such file or directory'.format(item))
+    dst_mode = sync.stat(dst)[0]
+    if isinstance(src, (list, tuple)) and not stat.S_ISDIR(dst_mode):
+        raise AdbSyncFail(u'target \'{}\' is not a directory'.format(dst))
+    pairs = []
+    for item in srcs:
+        pairs.extend(_push_pairs(item, dst, stat.S_ISDIR(dst_mode)))
+    return [(local_path, remote_path, os.path.getsize(local_path)) for local_path, remote_path in pairs]
+
+
+def _push_pairs(src, dst, dst_isdir):
+    '''
+    Output: list of (local file, remote file) of one push source
+    '''
+    if not os.path.isdir(src):
+        return [(src, posixpath.join(dst, os.path.basename(src)) if dst_isdir else dst)]
+    if dst_isdir:
+        dst = posixpath.join(dst, os.path.basename(os.path.normpath(src)))
+    pairs = []
+    for root, _, files in os.walk(src):
+        rel = os.path.relpath(root, src)
+        remote_root = dst if rel == os.curdir else posixpath.join(dst, *rel.split(os.sep))
+        pairs.extend((os.path.join(root, name), posixpath.join(remote_root, name)) for name in sorted(files))
+    return pairs
+
+
+def _balance(pairs, streams):
+    '''
+    Split pairs into streams buckets with nearly same cost (size + SYNC_FILE_COST), biggest file first
+    Output: list of list of (index, pair)
+    '''
+    buckets = [[] for _ in range(streams)]
+    costs = [0] * streams
+    for index, pair in sorted(enumerate(pairs), key=lambda item: -item[1][2]):
+        num = costs.index(min(costs))
+        buckets[num].append((index, pair))
+        costs[num] += pair[2] + SYNC_FILE_COST
+    return [bucket for bucket in buckets if bucket]
+
+
+def _transfer_pairs(sync, pairs, file_func, logger, streams=1):
+    '''
+    Call file_func(sync, src, dst, logger) for each (src, dst, size) in pairs
+    If streams > 1, pairs are split by _balance and run on extra sync connections of same device at the same time
+    First error is raised after all streams stop, output keeps order of pairs
+    Output: TransferResult
+    '''
+    result = TransferResult()
+    if streams <= 1 or len(pairs) <= 1:
+        for src, dst, _ in pairs:
+            result.add(file_func(sync, src, dst, logger))
+        return result
+    transfers = [None] * len(pairs)
+    errors = []
+
+    def worker(bucket, conn):
+        try:
+            if conn is None:
+                timeout = None if sync.deadline is None else max(sync.deadline - time.time(), 0.001)
+                conn = AdbSyncConnection(sync.client, sync.serial, timeout)
+            try:
+                for index, (src, dst, _) in bucket:
+                    if errors:
+                        return
+                    transfers[index] = file_func(conn, src, dst, logger)
+            finally:
+                if conn is not sync:
+                    conn.close()
+        except Exception as err:
+            errors.append(err)
+
+    buckets = _balance(pairs, streams)
+    logger.info("sync: %d files by %d streams", len(pairs), len(buckets))
+    threads = [Thread(target=worker, args=(bucket, sync if num == 0 else None), name=u'adb-sync-{}'.format(num))
+               for num, bucket in enumerate(buckets)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    for transfer in transfers:
+        result.add(transfer)
+    return result
+
+
+def sync_push_file(sync, local_path, remote_path, logger):
+    '''
+    Push one local file by SEND
+    Output: FileTransfer
+    '''
+    file_stat = os.stat(local_path)
+    start_time = time.time()
+    with open(local_path, 'rb') as fileobj:
+        size = sync.send(fileobj, remote_path, file_stat.st_mode, int(file_stat.st_mtime))
+    transfer = FileTransfer(local_path, remote_path, size, time.time() - start_time)
+    logger.info("push: %s -> %s (%d bytes, %.0f B/s)", local_path, remote_path, size, transfer.throughput)
+    return transfer
+
+
+def sync_pull(sync, src, dst, logger, streams=1):
+    '''
+    Same path rule as adb pull
+    file -> dst, or dst/basename(src) if dst is local folder
+    folder -> dst/basename(src)/... if dst is local folder, else dst/...
+    Input: sync(AdbSyncConnection)
+           src(str), remote file/folder
+           dst(str), local file/folder
+           streams(int), files are received by this number of sync connections at the same time
+    Output: TransferResult, item is local abspath
+    '''
+    start_time = time.time()
+    result = _transfer_pairs(sync, sync_pull_plan(sync, src, dst), sync_pull_file, logger, streams)
+    result.duration = time.time() - start_time
+    return result
+
+
+def sync_pull_plan(sync, src, dst):
+    '''
+    Local folders are created while listing remote folders
+    LIST give lstat mode, symlink is checked by STAT of link + '/' (follow link): link to folder is pulled as
+    folder (at most SYNC_LINK_DEPTH links in one path), other link is pulled as file by RECV (follow link)
+    Output: list of (remote file, local file, size) of sync_pull
+    '''
+    src_mode, src_size, _ = sync.stat(src)
+    if src_mode == 0:
+        raise AdbSyncFail(u'remote object \'{}\' does not exist'.format(src))
+    if not stat.S_ISDIR(src_mode):
+        if os.path.isdir(dst):
+            dst = os.path.join(dst, posixpath.basename(src))
+        return [(src, dst, src_size)]
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, posixpath.basename(posixpath.normpath(src)))
+    pairs = []
+    folders = [(src, dst, 0)]
+    while folders:
+        remote_root, local_root, links = folders.pop(0)
+        if not os.path.isdir(local_root):
+            os.makedirs(local_root)
+        for name, mode, size, _ in sorted(sync.listdir(remote_root)):
+            remote_path, local_path = posixpath.join(remote_root, name), os.path.join(local_root, name)
+            if stat.S_ISDIR(mode):
+                folders.append((remote_path, local_path, links))
+            elif stat.S_ISLNK(mode) and stat.S_ISDIR(sync.stat(remote_path + u'/')[0]):
+                if links < SYNC_LINK_DEPTH:
+                    folders.append((remote_path, local_path, links + 1))
+            elif stat.S_ISREG(mode) or stat.S_ISLNK(mode):
+                pairs.append((remote_path, local_path, size))
+    return pairs
+
+
+def sync_pull_file(sync, remote_path, local_path, logger):
+    '''
+    Pull one remote file by RECV, local file will be removed if fail
+    Output: FileTransfer, dst is local abspath
+    '''
+    local_path = os.path.abspath(local_path)
+    start_time = time.time()
+    try:
+        with open(local_path, 'wb') as fileobj:
+            size = sync.recv(remote_path, fileobj)
+    except AdbServerException:
+        try:
+            os.remove(local_path)
+        except OSError:
+            pass
+        raise
+    transfer = FileTransfer(remote_path, local_path, size, time.time() - start_time)
+    logger.info("pull: %s -> %s (%d bytes, %.0f B/s)", remote_path, local_path, size, transfer.throughput)
+    return transfer
@@ -5,13 +5,20 @@ import time
 import re
 import posixpath
 import subprocess
+import errno
+import uuid
+import tarfile
+from io import BytesIO
 
-from .base_wrapper import Queue, Empty, Thread, Event
+from .base_wrapper import Queue, Empty, Thread, Event, Lock, RLock, Condition
 from .base_wrapper import shlex
 from .base_wrapper import BaseWrapper
 from .base_wrapper import ignored
 from .base_wrapper import IS_PY2
 from .base_wrapper import _enqueue_output
+from .base_wrapper import codecs
+from .base_wrapper import OUT_CODING, OUT_ERROR_HANDLING
+from .base_wrapper import IOReactor, SELECTABLE_PIPE, watch_pipe
 from .base_wrapper import _to_unicode, _to_utf8
 from .base_wrapper import ON_POSIX
 from .base_wrapper import FILE_TYPES
@@ -20,6 +27,13 @@ from .base_wrapper import FILE_TRANSFORM_TIMEOUT, BUGREPORT_TIMEOUT
 from .base_wrapper import _device_checkor
 from .base_wrapper import PERMISSION_DENY, TIMEOUT, DEVICE_OFFLINE, NOFILEORFOLDER, READONLY, SHELL_FAILED
 from .base_wrapper import SubprocessException, NoDeviceException
+from .base_wrapper import COMMON_BLOCKING_TIMEOUT
+from .base_wrapper import _decode_output, _iter_lines
+from .adb_server import AdbServerClient, DeviceTracker
+from .adb_server import AdbServerException, AdbServerUnavailable, AdbServerFail, AdbServerTimeout
+from .adb_sync import AdbSyncConnection, AdbSyncFail
+from .adb_sync import SYNC_DATA_MAX, SYNC_DEFAULT_MODE
+from .adb_sync import sync_push, sync_pull
 
 THIRDADB = ('tadb.exe', 'ShuameDaemon.exe', 'shuame_helper.exe',
             'wpscloudlaunch.exe', 'AndroidServer.exe', 'Alipaybsm.exe',
@@ -27,6 +41,46 @@ THIRDADB = ('tadb.exe', 'ShuameDaemon.exe', 'shuame_helper.exe',
 ADBGAP = 0.25  # Default blocking command check gap for command terminate
 ADBIP_PORT = int(os.getenv('ADBPORT', '5555'))  # Default adb network device port, should keep align with adb
 ADB_SERVER_PORT = 5037  # Default adb server local port
+ADB_SERVER_POOL_SIZE = 2  # Default warm transport sockets for each device (only for use_server_socket)
+SHELL_SESSION_TIMEOUT = 10  # Default timeout for persistent shell session start
+SHELL_BATCH_SCRIPT_MAX = 3072  # Max script size of one shell_batch round trip, adb service payload may be 4K only
+SHELL_BATCH_CMD_OVERHEAD = 140  # Wrapper size of each command in shell_batch script
+TAR_BUFSIZE = 64 * 1024  # Block size of push_tar/pull_tar stream
+# Strip leading / and refuse member outside target folder when extract, on Python with extraction filter
+TAR_EXTRACT_OPTIONS = {'filter': 'tar'} if hasattr(tarfile, 'tar_filter') else {}
+
+
+def _shell_quote(string):
+    '''
+    Quote string as one argument of remote shell
+    '''
+    return u"'{}'".format(_to_unicode(string).replace(u"'", u"'\\''"))
+
+
+class _ChunkReader(object):
+    '''
+    Read only file object over generator of chunks(bytes), for tarfile stream mode
+    '''
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._buffer = bytearray()
+        self.total = 0  # bytes got from chunks
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+            self.total += len(chunk)
+        if size < 0 or size > len(self._buffer):
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def close(self):
+        self._chunks.close()
 
 
 class AdbFailException(SubprocessException):
@@ -54,18 +108,37 @@ class AdbShell(object):
         self.logger = logger
         self.p = process
         self.stdout_q = Queue()
+        self.stderr_q = Queue()
+        if SELECTABLE_PIPE:
+            # Pipes are read by process-wide IOReactor, no thread for each shell
+            self._reactor = IOReactor.instance()
+            self._opening = set()
+            for pipe, queue in ((self.p.stdout, self.stdout_q), (self.p.stderr, self.stderr_q)):
+                self._opening.add(pipe.fileno())
+                self._reactor.register(pipe, self._reactor_callback(pipe.fileno(), queue))
+            self.stdout_t = self.stderr_t = None
+            return
         self.stdout_stop = Event()
         self.stdout_t = Thread(target=_enqueue_output,
                                args=(self.p.stdout, self.stdout_q, self.stdout_stop, self.logger))
         self.stdout_t.daemon = True
         self.stdout_t.start()
-        self.stderr_q = Queue()
         self.stderr_stop = Event()
         self.stderr_t = Thread(target=_enqueue_output,
                                args=(self.p.stderr, self.stderr_q, self.stderr_stop, self.logger))
         self.stderr_t.daemon = True
         self.stderr_t.start()
 
+    def _reactor_callback(self, fd, queue):
+        decoder = codecs.getincrementaldecoder(OUT_CODING)(OUT_ERROR_HANDLING)
+
+        def callback(chunk):
+            if chunk:
+                queue.put(decoder.decode(chunk))
+            else:
+                self._opening.discard(fd)
+        return callback
+
     def __del__(self):
         self.kill()
 
@@ -90,12 +163,12 @@ class AdbShell(object):
         out = ''
         while 1:
             try:
-                out = q.get_nowait()
-                self.logger.debug("out: {!r}".format(out))
+                _out = q.get_nowait()
+                self.logger.debug("out: {!r}".format(_out))
             except Empty:
                 break
             else:
-                out += out
+                out += _out
         return out
 
     def read_stdout(self):
@@ -118,6 +191,7 @@ class AdbShell(object):
         '''
         self.logger.info("AdbShell Write: {!r}".format(cmd))
         self.p.stdin.write(_to_utf8(cmd))
+        self.p.stdin.flush()
 
     def kill(self):
         self.p.poll()
@@ -125,6 +199,11 @@ class AdbShell(object):
             with ignored(OSError):
                 self.p.kill()
             self.p.wait()
+        if SELECTABLE_PIPE:
+            for fd in list(self._opening):
+                self._reactor.unregister(fd)
+            self._opening.clear()
+            return
         if self.stdout_t.isAlive():
             self.stdout_stop.set()
             self.stdout_t.join()
@@ -133,6 +212,144 @@ class AdbShell(object):
             self.stderr_t.join()
 
 
+class AdbShellSession(object):
+    '''
+    Persistent adb shell process of one device, run many commands one by one on it
+    Every command is wrapped so its output is framed by unique sentinel lines:
+        stdout: <output><token>:<exit code>
+        stderr: <output><token>:e
+    Legacy adb (without shell protocol) run remote shell in pty, stdout/stderr are mixed
+    and input is echoed, so echo/prompt are turned off when session start
+    It should be created by AdbWrapper.shell_session
+    '''
+    def __init__(self, process, device, logger, nodevice_matcher, timeout=SHELL_SESSION_TIMEOUT):
+        self.p = process
+        self.device = device
+        self.logger = logger
+        self._nodevice_matcher = nodevice_matcher
+        self._lock = Lock()  # One command on the session at a time
+        self._cond = Condition()
+        self._buffers = {u'stdout': bytearray(), u'stderr': bytearray()}
+        self._closed = set()
+        self._unwatch = [watch_pipe(self.p.stdout, self._callback(u'stdout')),
+                         watch_pipe(self.p.stderr, self._callback(u'stderr'))]
+        self.run(u'stty -echo 2>/dev/null; PS1=; PS2=', timeout)
+
+    def _callback(self, name):
+        def callback(chunk):
+            with self._cond:
+                if chunk:
+                    self._buffers[name] += chunk
+                else:
+                    self._closed.add(name)
+                self._cond.notify_all()
+        return callback
+
+    def __del__(self):
+        self.close()
+
+    def isalive(self):
+        '''
+        Output: True if session can accept command
+        '''
+        return self.p.poll() is None and not self._closed
+
+    def _frame(self, cmd, token):
+        # Split token by quote, so echoed command line never match sentinel
+        head, tail = token[:16], token[16:]
+        return (u"{{ {cmd}\n}} </dev/null; __adb_wrapper_rc=$?; "
+                u"echo '{head}''{tail}:e' >&2; echo '{head}''{tail}:'$__adb_wrapper_rc\n"
+                ).format(cmd=cmd, head=head, tail=tail)
+
+    def run(self, cmd, timeout=None):
+        '''
+        Run cmd on session and wait its sentinel
+        Session will be closed if timeout/device lost/session exit, next command need new session
+        Input: cmd (str/unicode/list)
+               timeout [int/float/None(infinite)]
+        Output: stdout(str)
+                stderr(str)
+                exit_code(int)
+        '''
+        if isinstance(cmd, (list, tuple)):
+            cmd = u' '.join(_to_unicode(c) for c in cmd)
+        token = uuid.uuid4().hex
+        end_re = re.compile(token.encode('ascii') + b':(\\d+)\r?\n')
+        err_re = re.compile(token.encode('ascii') + b':e\r?\n')
+        with self._lock:
+            self.logger.debug("shell session %s: %r", self.device, cmd)
+            try:
+                self.p.stdin.write(_to_utf8(self._frame(_to_unicode(cmd), token)))
+                self.p.stdin.flush()
+            except (IOError, OSError, ValueError) as err:
+                self.logger.error("shell session %s: write fail %r", self.device, err)
+                self.close()
+                raise AdbFailException(SHELL_FAILED, u'', u'')
+            deadline = None if timeout is None else time.time() + timeout
+            error = None
+            nodevice_matcher = self._nodevice_matcher()
+            # Only new data (with a sentinel long overlap) is scanned on every wake up
+            out_pos = err_pos = nodevice_pos = 0
+            overlap = len(token) + 16
+            with self._cond:
+                stdout, stderr = self._buffers[u'stdout'], self._buffers[u'stderr']
+                while 1:
+                    out_m = end_re.search(stdout, out_pos)
+                    err_m = err_re.search(stderr, err_pos)
+                    out_pos = out_m.start() if out_m else max(len(stdout) - overlap, 0)
+                    err_pos = err_m.start() if err_m else max(len(stderr) - overlap, 0)
+                    mixed = False
+                    if out_m and err_m is None:
+                        # stderr sentinel is in stdout if they are mixed (pty)
+                        err_m = err_re.search(stdout, 0, out_m.start())
+                        mixed = err_m is not None
+                    if out_m and err_m:
+                        break
+                    nodevice = nodevice_matcher.feed(stderr[nodevice_pos:])
+                    nodevice_pos = len(stderr)
+                    if nodevice:
+                        error = AdbNoDevice()
+                    elif u'stdout' in self._closed:
+                        error = AdbFailException(SHELL_FAILED, _decode_output(bytes(stdout), self.logger),
+                                                 _decode_output(bytes(stderr), self.logger))
+                    elif deadline is not None and time.time() >= deadline:
+                        error = AdbTimeout(TIMEOUT, _decode_output(bytes(stdout), self.logger),
+                                           _decode_output(bytes(stderr), self.logger))
+                    if error is not None:
+                        break
+                    self._cond.wait(None if deadline is None else max(deadline - time.time(), 0))
+                if error is None:
+                    if mixed:
+                        stdout_b = bytes(stdout[:err_m.start()] + stdout[err_m.end():out_m.start()])
+                        stderr_b = b''
+                    else:
+                        stdout_b = bytes(stdout[:out_m.start()])
+                        stderr_b = bytes(stderr[:err_m.start()])
+                        del stderr[:err_m.end()]
+                    exit_code = int(out_m.group(1))
+                    del stdout[:out_m.end()]
+            if error is not None:
+                # Close out of condition, reactor callback may wait for it
+                self.logger.error("shell session %s: %r fail - %r", self.device, cmd, error)
+                self.close()
+                raise error
+        stdout_str = _decode_output(stdout_b, self.logger).replace(u'\r\n', u'\n')
+        stderr_str = _decode_output(stderr_b, self.logger).replace(u'\r\n', u'\n')
+        return stdout_str.strip(), stderr_str.strip(), exit_code
+
+    def close(self):
+        for unwatch in self._unwatch:
+            unwatch()
+        self._unwatch = []
+        self._closed.update((u'stdout', u'stderr'))
+        with ignored(IOError, OSError, ValueError):
+            self.p.stdin.close()
+        if self.p.poll() is None:
+            with ignored(OSError):
+                self.p.kill()
+            self.p.wait()
+
+
 class AdbLogcat(object):
     '''
     AdbLogcat, offer easy handle for adb logcat process
@@ -213,21 +430,111 @@ class AdbWrapper(BaseWrapper):
 
     thirdbinary_p = THIRDADB
     _binaryname = u'adb'
-    nodevice_re_list = [u'waiting for device', u'error: device \s+ not found']
+    nodevice_re_list = [u'waiting for device', u'error: device \\S* ?not found']
     devices_re = re.compile(r'([0-9a-zA-Z_:.-]*)\s*(device|unauthorized|offline|sideload)')
     adb_error_re = re.compile(r'error: (.*)')
     pm_failure_re = re.compile(r'Failure \[(.*)\]')
     pull_pattern = re.compile(r'pull: .* -> (.*)')
 
-    def __init__(self, adb_file=None, logger=None, adb_server_port=ADB_SERVER_PORT):
+    def __init__(self, adb_file=None, logger=None, adb_server_port=ADB_SERVER_PORT, use_server_socket=False,
+                 server_pool_size=ADB_SERVER_POOL_SIZE, track_devices=False):
         super(AdbWrapper, self).__init__(adb_file, logger)
         self._adb_server_port = adb_server_port
-        self.logger.info("AdbWrapper: init complete")
+        self._server = AdbServerClient(port=adb_server_port, logger=self.logger, pool_size=server_pool_size)
+        self.use_server_socket = use_server_socket
+        self._shell_sessions = {}  # device: AdbShellSession
+        self._shell_sessions_lock = Lock()
+        self._features = {}  # device: features(set) got by adb binary
+        self._tracker = None
+        if track_devices:
+            self.track_devices()
+        self.logger.info("AdbWrapper: init complete (server socket: %s)", use_server_socket)
 
     @property
     def adb_server_port(self):
         return self._adb_server_port
 
+    @property
+    def server(self):
+        '''
+        AdbServerClient talk to adb server on adb_server_port directly
+        '''
+        return self._server
+
+    @property
+    def tracker(self):
+        '''
+        DeviceTracker started by track_devices / None
+        '''
+        return self._tracker
+
+    def track_devices(self):
+        '''
+        Start live device table by adb server host:track-devices
+        While it is in sync, devices/wait_for_device read the table without spawning adb,
+        and state of device is reset once it leaves "device" state
+        Output: DeviceTracker
+        '''
+        if self._tracker is None:
+            self._tracker = DeviceTracker(self._server)
+            self._tracker.add_callback(self._device_state_changed)
+            self._tracker.start()
+        return self._tracker
+
+    def track_devices_stop(self):
+        if self._tracker is not None:
+            self._tracker.stop()
+            self._tracker = None
+
+    def _device_state_changed(self, serial, old_state, new_state):
+        '''
+        DeviceTracker callback, pooled sockets of serial are already evicted by tracker
+        '''
+        if old_state == u'device':
+            self._device_reset(serial)
+
+    def _tracked_devices(self):
+        '''
+        Output: {serial: state} from DeviceTracker if it is in sync / None
+        '''
+        tracker = self._tracker
+        if tracker is not None and tracker.ready:
+            return tracker.devices()
+        return None
+
+    def _command_auto(self, cmdlist, timeout=COMMON_BLOCKING_TIMEOUT, server_request=None, raw=False):
+        '''
+        Run adb command by adb server socket if use_server_socket, else by adb binary
+        Input: cmdlist(list), for adb binary
+               timeout(int/float/None(infinite))
+               server_request(function), server_request(timeout) -> stdout(bytes/str)
+               raw(bool), stdout as memoryview of bytes without decode, server_request must return bytes
+        Output: stdout(str) / stderr(str), same as _command_blocking
+        If adb server not reachable, fall back to adb binary (it will start adb server)
+        adb server FAIL reason will be returned as stderr "error: reason"
+        '''
+        if self.use_server_socket and server_request is not None:
+            try:
+                stdout = server_request(timeout)
+            except AdbServerUnavailable:
+                self.logger.warning("adb server socket unavailable, fall back to adb binary")
+            except AdbServerFail as err:
+                stderr = u'error: {}'.format(err.msg)
+                if self._nodevice_check(stderr):
+                    raise NoDeviceException
+                return u'', stderr
+            except AdbServerTimeout as err:
+                raise SubprocessException(TIMEOUT, memoryview(err.data) if raw else _decode_output(err.data, self.logger), u'')
+            except AdbServerException as err:
+                raise SubprocessException(err.msg, u'', u'')
+            else:
+                if raw:
+                    return memoryview(stdout), u''
+                if isinstance(stdout, bytes):
+                    stdout = _decode_output(stdout, self.logger)
+                return stdout.strip(), u''
+        return self._command_blocking(cmdlist, timeout, raw)
+
     # TODO: define wrong command if command_blocking
 
     def _adbcommand_unblocking(self, cmdlist, stdin=subprocess.PIPE,
@@ -245,7 +552,7 @@ class AdbWrapper(BaseWrapper):
         reason = ''
         try:
             p = subprocess.Popen(_cmdlist, stdin=stdin, stdout=stdout, stderr=stderr,
-                                 bufsize=1, close_fds=ON_POSIX)
+                                 bufsize=0, close_fds=ON_POSIX)
         except (OSError, ValueError) as e:
             self.logger.error("Run adb command Exception")
             self.logger.error("Exception: {!r}".format(e))
@@ -273,6 +580,57 @@ class AdbWrapper(BaseWrapper):
             self.subproc_list.append(p)
         return ret, p
 
+    def _server_error(self, err):
+        '''
+        Translate AdbServerException (except AdbServerUnavailable) to exception of adb binary command
+        Input: err(AdbServerException)
+        Output: AdbNoDevice / AdbTimeout / AdbFailException
+        '''
+        if isinstance(err, AdbServerFail):
+            if self._nodevice_check(u'error: {}'.format(err.msg)):
+                return AdbNoDevice(err.msg, u'', err.msg)
+            return AdbFailException(err.msg, u'', err.msg)
+        elif isinstance(err, AdbServerTimeout):
+            return AdbTimeout(TIMEOUT, _decode_output(err.data, self.logger), err.msg)
+        return AdbFailException(err.msg, u'', err.msg)
+
+    def _sync_transfer(self, func, src, dst, device, timeout, streams=1):
+        '''
+        Run sync_push/sync_pull by adb server sync protocol, by streams sync connections at the same time
+        Output: TransferResult
+        '''
+        return self._sync_run(lambda sync: func(sync, src, dst, self.logger, streams=streams), device, timeout)
+
+    def _sync_run(self, func, device, timeout):
+        '''
+        Call func(sync) on a new AdbSyncConnection of device
+        Raise same exceptions as adb binary push/pull
+        AdbServerUnavailable is raised to let caller fall back to adb binary
+        Output: return of func
+        '''
+        try:
+            with AdbSyncConnection(self._server, device, timeout) as sync:
+                return func(sync)
+        except AdbServerUnavailable:
+            raise
+        except AdbSyncFail as err:
+            if u'Permission denied' in err.msg:
+                reason = PERMISSION_DENY
+            elif u'Read-only file system' in err.msg:
+                reason = READONLY
+            elif u'No such file or directory' in err.msg or u'does not exist' in err.msg:
+                reason = NOFILEORFOLDER
+            else:
+                reason = err.msg
+            self.logger.error("sync: %s", err.msg)
+            raise AdbFailException(reason, u'', err.msg)
+        except AdbServerException as err:
+            raise self._server_error(err)
+        except (IOError, OSError) as err:
+            self.logger.error("sync: local file error - %s", err)
+            reason = PERMISSION_DENY if err.errno == errno.EACCES else u'{}'.format(err)
+            raise AdbFailException(reason, u'', u'{}'.format(err))
+
     def _set_binary_version(self):
         '''
         Get adb tool version
@@ -310,6 +668,12 @@ class AdbWrapper(BaseWrapper):
                 raise AdbTimeout(err.msg, err.stdout, err.stderr)
             else:
                 raise
+        return self._start_server_parse(stdout, stderr)
+
+    def _start_server_parse(self, stdout, stderr):
+        '''
+        Check output of adb start-server, shared with AsyncAdbWrapper
+        '''
         if u'daemon started successfully' in stdout:
             self.logger.info("start-server: success")
         elif stdout == u'' and stderr == u'':
@@ -345,6 +709,12 @@ class AdbWrapper(BaseWrapper):
                 raise AdbTimeout(err.msg, err.stdout, err.stderr)
             else:
                 raise
+        return self._kill_server_parse(stdout, stderr)
+
+    def _kill_server_parse(self, stdout, stderr):
+        '''
+        Check output of adb kill-server, shared with AsyncAdbWrapper
+        '''
         if stdout == u'' and stderr == u'':
             self.logger.info("kill-server: success")
         elif u'server not running' in stdout or u'server not running' in stderr:
@@ -373,9 +743,13 @@ class AdbWrapper(BaseWrapper):
         }
         '''
         self.logger.info("devices: start")
+        devices = self._tracked_devices()
+        if devices is not None:
+            self.logger.info("devices: from track-devices - %s", devices)
+            return devices
         cmdlist = ['devices']
         try:
-            stdout, stderr = self._command_blocking(cmdlist)
+            stdout, stderr = self._command_auto(cmdlist, server_request=lambda _: self._server.devices())
         except NoDeviceException:
             raise AdbNoDevice
         except SubprocessException as err:
@@ -383,6 +757,12 @@ class AdbWrapper(BaseWrapper):
                 raise AdbTimeout(err.msg, err.stdout, err.stderr)
             else:
                 raise
+        return self._devices_parse(stdout, stderr)
+
+    def _devices_parse(self, stdout, stderr):
+        '''
+        Check output of adb devices, shared with AsyncAdbWrapper
+        '''
         if u'error: ' in stderr:
             error = self.adb_error_re.search(stderr).group(1)
             self.logger.error("devices: error. %s", error)
@@ -409,10 +789,9 @@ class AdbWrapper(BaseWrapper):
         '''
         self.logger.info("connect: start")
         self.logger.info("connect: target - %s", device)
-        device_pattern = re.compile(r'connected to ({device}.*)'.format(device=device))
         cmdlist = ['connect', device]
         try:
-            stdout, stderr = self._command_blocking(cmdlist)
+            stdout, stderr = self._command_auto(cmdlist, server_request=lambda _: self._server.connect(device))
         except NoDeviceException:
             raise AdbNoDevice
         except SubprocessException as err:
@@ -420,6 +799,17 @@ class AdbWrapper(BaseWrapper):
                 raise AdbTimeout(err.msg, err.stdout, err.stderr)
             else:
                 raise
+        devicename, retry_device = self._connect_parse(device, stdout, stderr)
+        if retry_device:
+            return self.connect(retry_device)
+        return devicename
+
+    def _connect_parse(self, device, stdout, stderr):
+        '''
+        Check output of adb connect, shared with AsyncAdbWrapper
+        Output: devicename(str) / retry_device(str), connect again with retry_device if it is not None
+        '''
+        device_pattern = re.compile(r'connected to ({device}.*)'.format(device=device))
         if u'already connected to ' in stdout:
             devicename = device_pattern.search(stdout).group(1).rstrip()
             self.logger.warning("connect: already connected {device}".format(device=devicename))
@@ -432,10 +822,10 @@ class AdbWrapper(BaseWrapper):
             if u':' in device:
                 self.logger.info("Try adb connect again without default port %d" % ADBIP_PORT)
                 ip = device.split(u':')[0]
-                return self.connect(ip)
+                return None, ip
             raise AdbConnectFail("Connect empty host name/Name or service not known", stdout, stderr)
         elif u'missing port in specification' in stdout:
-            return self.connect(device+u':'+str(ADBIP_PORT))
+            return None, device+u':'+str(ADBIP_PORT)
         elif u'error: ' in stderr:
             error = self.adb_error_re.search(stderr).group(1)
             self.logger.error("connect: error. %s", error)
@@ -448,7 +838,7 @@ class AdbWrapper(BaseWrapper):
             self.logger.error("stdout: {!r}".format(stdout))
             self.logger.error("stderr: {!r}".format(stderr))
             raise AdbFailException(u'unknown reason', stdout, stderr)
-        return devicename
+        return devicename, None
 
     @_device_checkor
     def disconnect(self, device=None):
@@ -459,6 +849,7 @@ class AdbWrapper(BaseWrapper):
         PS: USB adb device cannot disconnect
         '''
         self.logger.info("disconnect: start")
+        self._device_reset(device)
         if not device:
             self.logger.warning("disconnect: no target device, will disconnect all")
             cmdlist = ['disconnect']
@@ -466,7 +857,7 @@ class AdbWrapper(BaseWrapper):
             self.logger.info("disconnect: target - %s", device)
             cmdlist = ['disconnect', device]
         try:
-            stdout, stderr = self._command_blocking(cmdlist)
+            stdout, stderr = self._command_auto(cmdlist, server_request=lambda _: self._server.disconnect(device))
         except NoDeviceException:
             raise AdbNoDevice
         except SubprocessException as err:
@@ -474,9 +865,15 @@ class AdbWrapper(BaseWrapper):
                 raise AdbTimeout(err.msg, err.stdout, err.stderr)
             else:
                 raise
-        if u'No such device ' in stdout:
+        return self._disconnect_parse(device, stdout, stderr)
+
+    def _disconnect_parse(self, device, stdout, stderr):
+        '''
+        Check output of adb disconnect, shared with AsyncAdbWrapper
+        '''
+        if u'No such device ' in stdout or u'no such device ' in stdout:
             self.logger.warning("disconnect: No such device - %s", device)
-        elif stdout.strip() == u'' and stderr == u'':
+        elif (stdout.strip() == u'' or stdout.startswith(u'disconnected')) and stderr == u'':
             self.logger.info("disconnect: success - %s", device)
         elif u'error: ' in stderr:
             error = self.adb_error_re.search(stderr).group(1)
@@ -494,52 +891,70 @@ class AdbWrapper(BaseWrapper):
         Try get adb bugreport
         Input: device [SN(for USB device) / IP:Port(for network device)](str) / None(for self._device)]
                filename [Write bugreport into file]
-        Output: bugreport(bugreport str and filename=None /
+        Output: bugreport(bugreport bytes and filename=None /
                           full filepath filename!=None
+        Output is kept as bytes from adb to file, no decode/encode
         '''
         self.logger.info("bugreport: start")
         self.logger.info("bugreport: target - %s", device)
         cmdlist = ['-s', device, 'bugreport']
         try:
-            stdout, stderr = self._command_blocking(cmdlist=cmdlist, timeout=timeout)
+            stdout, stderr = self._command_blocking(cmdlist=cmdlist, timeout=timeout, raw=True)
         except NoDeviceException:
             raise AdbNoDevice
         except SubprocessException as err:
             if err.msg == TIMEOUT:
                 self.logger.warning("bugreport timeout")
+                stdout, stderr = err.stdout, err.stderr
             else:
                 raise
+        return self._bugreport_save(filename, stdout, stderr)
+
+    def _bugreport_save(self, filename, stdout, stderr):
+        '''
+        Check output of adb bugreport and save it, shared with AsyncAdbWrapper
+        '''
         if u'error: ' in stderr:
             error = self.adb_error_re.search(stderr).group(1)
             self.logger.error("bugreport: error. %s", error)
             raise AdbFailException(error, stdout, stderr)
         if sys.platform == 'win32':
-            bugreport_str = stdout.replace(u'\r\r\n', u'\r\n').encode(ADB_ENC)
+            bugreport_str = stdout.tobytes().replace(b'\r\r\n', b'\r\n')
         else:
-            bugreport_str = stdout.encode(ADB_ENC)
+            bugreport_str = stdout
         if filename:
             with open(filename, 'ab') as f:
                 f.write(bugreport_str)
                 self.logger.info("bugreport: Write to file success - {}".format(os.path.abspath(filename)))
                 return os.path.abspath(filename)
         else:
-            return bugreport_str
+            return bytes(bugreport_str)
 
     @_device_checkor
-    def push(self, src, dst, device=None, timeout=FILE_TRANSFORM_TIMEOUT):
+    def push(self, src, dst, device=None, timeout=FILE_TRANSFORM_TIMEOUT, streams=1):
         '''
         Try adb push src to dst
         Input: device [SN(for USB device) / IP:Port(for network device)](str) / None(for self._device)]
                src/dst[can be file/folder absolute/relative path](str)
+                      src can be list of file/folder, then dst must be existed remote folder
                timeout(int/float)
+               streams(int), use_server_socket only, files are sent by this number of sync connections
+                             at the same time, for folder of many small files
+               use_server_socket: empty folders in src are not created on remote
                Support all adb push support method
-        Output: None
+        Output: None (adb binary) /
+                TransferResult (use_server_socket, remote paths with per-file bytes/throughput)
         User should know file path after push
         From push command, cannot judgement dst is folder or file
         '''
         self.logger.info("push: start")
         self.logger.info("push: target - %s", device)
-        cmdlist = ['-s', device, 'push', src, dst]
+        if self.use_server_socket:
+            try:
+                return self._sync_transfer(sync_push, src, dst, device, timeout, streams)
+            except AdbServerUnavailable:
+                self.logger.warning("adb server socket unavailable, fall back to adb binary")
+        cmdlist = ['-s', device, 'push'] + (list(src) if isinstance(src, (list, tuple)) else [src]) + [dst]
         try:
             stdout, stderr = self._command_blocking(cmdlist=cmdlist, timeout=timeout)
         except NoDeviceException:
@@ -549,6 +964,12 @@ class AdbWrapper(BaseWrapper):
                 raise AdbTimeout(err.msg, err.stdout, err.stderr)
             else:
                 raise
+        return self._push_parse(stdout, stderr)
+
+    def _push_parse(self, stdout, stderr):
+        '''
+        Check output of adb push, shared with AsyncAdbWrapper
+        '''
         if u'Permission denied' in stderr or u'Permission denied' in stdout:
             self.logger.error("push: Permission denied")
             raise AdbFailException(PERMISSION_DENY, stdout, stderr)
@@ -578,17 +999,24 @@ class AdbWrapper(BaseWrapper):
             raise AdbFailException(u'unknown reason', stdout, stderr)
 
     @_device_checkor
-    def pull(self, src, dst, device=None, timeout=FILE_TRANSFORM_TIMEOUT):
+    def pull(self, src, dst, device=None, timeout=FILE_TRANSFORM_TIMEOUT, streams=1):
         '''
         Try adb pull src to dst
         Input: device [SN(for USB device) / IP:Port(for network device)](str) / None(for self._device)]
                src/dst[can be file/folder absolute/relative path](str)
                timeout(int/float)
                Support all adb pull support method
-        Output: filelist
+               streams(int), use_server_socket only, files are received by this number of sync connections
+                             at the same time, for folder of many small files
+        Output: filelist (TransferResult with per-file bytes/throughput if use_server_socket)
         '''
         self.logger.info("pull: start")
         self.logger.info("pull: target - %s", device)
+        if self.use_server_socket:
+            try:
+                return self._sync_transfer(sync_pull, src, dst, device, timeout, streams)
+            except AdbServerUnavailable:
+                self.logger.warning("adb server socket unavailable, fall back to adb binary")
         cmdlist = ['-s', device, 'pull', src, dst]
         try:
             stdout, stderr = self._command_blocking(cmdlist=cmdlist, timeout=timeout)
@@ -599,6 +1027,12 @@ class AdbWrapper(BaseWrapper):
                 raise AdbTimeout(err.msg, err.stdout, err.stderr)
             else:
                 raise
+        return self._pull_parse(src, dst, stdout, stderr)
+
+    def _pull_parse(self, src, dst, stdout, stderr):
+        '''
+        Check output of adb pull, shared with AsyncAdbWrapper
+        '''
         if u'Permission denied' in stderr or u'Permission denied' in stdout:
             self.logger.error("pull: Permission denied")
             raise AdbFailException(PERMISSION_DENY, stdout, stderr)
@@ -636,6 +1070,240 @@ class AdbWrapper(BaseWrapper):
                 dstlist = [os.path.abspath(dst)]
         return dstlist
 
+    @_device_checkor
+    def push_tar(self, src, dst, device=None, timeout=FILE_TRANSFORM_TIMEOUT, compress=False):
+        '''
+        Push local file/folder as one tar stream, tar on device extract it into dst (dst/basename(src))
+        Archive is built while sending, no temp file, much faster than push for folder of many small files
+        By shell protocol v2 stdin (adb server socket if use_server_socket, else adb shell) if device support it
+        Note: Legacy device without shell_v2 is fed by adb exec-in, which return no output, tar error is not known
+        Input: device [SN(for USB device) / IP:Port(for network device)](str) / None(for self._device)]
+               src(str), local file/folder
+               dst(str), remote folder, created if not exist
+               timeout(int/float)
+               compress(bool), gzip the stream, for slow link (tar on device need support -z)
+        Output: remote paths of files(list)
+        '''
+        self.logger.info("push_tar: %s -> %s, target - %s", src, dst, device)
+        if not os.path.exists(src):
+            self.logger.error("push_tar: %s not exist", src)
+            raise AdbFailException(NOFILEORFOLDER, u'', u'{}: No such file or directory'.format(src))
+        remote_files = []
+
+        def collect(info):
+            if info.isfile():
+                remote_files.append(posixpath.join(_to_unicode(dst), _to_unicode(info.name)))
+            return info
+
+        def write_tar(fileobj):
+            with tarfile.open(fileobj=fileobj, mode='w|gz' if compress else 'w|', bufsize=TAR_BUFSIZE) as tar:
+                tar.add(src, arcname=os.path.basename(os.path.normpath(src)), filter=collect)
+
+        cmd = u'mkdir -p {0} && tar -x{1}f - -C {0}'.format(_shell_quote(dst), u'z' if compress else u'')
+        self._shell_stdin(cmd, device, timeout, write_tar, u'push_tar')
+        self.logger.info("push_tar: success, %d files", len(remote_files))
+        return remote_files
+
+    @_device_checkor
+    def pull_tar(self, src, dst, device=None, timeout=FILE_TRANSFORM_TIMEOUT, compress=False):
+        '''
+        Pull remote file/folder as one tar stream (tar on device by exec-out), extracted into dst (dst/basename(src))
+        Archive is extracted while receiving, no temp file, much faster than pull for folder of many small files
+        Entries tar cannot read on device (permission) are just not in stream, device files/fifos are skipped
+        Input: device [SN(for USB device) / IP:Port(for network device)](str) / None(for self._device)]
+               src(str), remote file/folder
+               dst(str), local folder, created if not exist
+               timeout(int/float)
+               compress(bool), gzip the stream, for slow link (tar on device need support -z)
+        Output: local abspaths of files(list)
+        '''
+        self.logger.info("pull_tar: %s -> %s, target - %s", src, dst, device)
+        parent, name = posixpath.split(_to_unicode(src).rstrip(u'/'))
+        if not name:
+            parent, name = u'/', u'.'
+        cmd = u'tar -c{}f - -C {} {} 2>/dev/null'.format(u'z' if compress else u'', _shell_quote(parent or u'/'),
+                                                         _shell_quote(name))
+        if not os.path.isdir(dst):
+            os.makedirs(dst)
+        reader = _ChunkReader(self._shell_chunks(cmd, device, timeout, service=u'exec'))
+        local_files = []
+        members = 0
+        try:
+            with tarfile.open(fileobj=reader, mode='r|gz' if compress else 'r|', bufsize=TAR_BUFSIZE) as tar:
+                for member in tar:
+                    members += 1
+                    if not (member.isdir() or member.isfile() or member.issym() or member.islnk()):
+                        continue
+                    if member.name.startswith(u'/') or u'..' in member.name.split(u'/'):
+                        self.logger.warning("pull_tar: skip unsafe path %s", member.name)
+                        continue
+                    tar.extract(member, dst, **TAR_EXTRACT_OPTIONS)
+                    if member.isfile():
+                        local_files.append(os.path.abspath(os.path.join(dst, *member.name.split(u'/'))))
+        except tarfile.TarError as err:
+            # Nothing received means tar found nothing to archive
+            reason = NOFILEORFOLDER if reader.total == 0 else u'{}'.format(err)
+            self.logger.error("pull_tar: fail - %s", err)
+            raise AdbFailException(reason, u'', u'{}'.format(err))
+        finally:
+            reader.close()
+        if not members:
+            # src itself is always in archive if it exist
+            self.logger.error("pull_tar: %s not exist", src)
+            raise AdbFailException(NOFILEORFOLDER, u'', u'{}: No such file or directory'.format(src))
+        self.logger.info("pull_tar: success, %d files", len(local_files))
+        return local_files
+
+    @_device_checkor
+    def push_stream(self, fileobj, dst, device=None, timeout=FILE_TRANSFORM_TIMEOUT, mode=SYNC_DEFAULT_MODE,
+                    mtime=None):
+        '''
+        Push content of file object to remote file, read in SYNC_DATA_MAX blocks, no local file needed
+        By sync protocol if use_server_socket, else by cat on device fed by stdin (mode/mtime not set)
+        Input: device [SN(for USB device) / IP:Port(for network device)](str) / None(for self._device)]
+               fileobj(file object opened as binary, io.BytesIO, ...), read from current position to end
+               dst(str), remote file path, its folder is created if not exist
+               timeout(int/float)
+               mode(int), remote file mode
+               mtime(int), remote file mtime, None for now
+        Output: bytes pushed(int)
+        '''
+        self.logger.info("push_stream: -> %s, target - %s", dst, device)
+        if self.use_server_socket:
+            try:
+                size = self._sync_run(lambda sync: sync.send(fileobj, dst, mode, mtime), device, timeout)
+                self.logger.info("push_stream: success, %d bytes", size)
+                return size
+            except AdbServerUnavailable:
+                self.logger.warning("adb server socket unavailable, fall back to adb binary")
+        sizes = []
+
+        def copy(stdin):
+            size = 0
+            for block in iter(lambda: fileobj.read(SYNC_DATA_MAX), b''):
+                stdin.write(block)
+                size += len(block)
+            sizes.append(size)
+
+        cmd = u'mkdir -p {} && cat > {}'.format(_shell_quote(posixpath.dirname(_to_unicode(dst)) or u'/'),
+                                                _shell_quote(dst))
+        self._shell_stdin(cmd, device, timeout, copy, u'push_stream')
+        self.logger.info("push_stream: success, %d bytes", sizes[0])
+        return sizes[0]
+
+    def push_bytes(self, data, dst, device=None, timeout=FILE_TRANSFORM_TIMEOUT, mode=SYNC_DEFAULT_MODE,
+                   mtime=None):
+        '''
+        Push bytes to remote file, same as push_stream
+        Input: data(bytes)
+        Output: bytes pushed(int)
+        '''
+        return self.push_stream(BytesIO(data), dst, device=device, timeout=timeout, mode=mode, mtime=mtime)
+
+    @_device_checkor
+    def pull_stream(self, src, fileobj, device=None, timeout=FILE_TRANSFORM_TIMEOUT):
+        '''
+        Pull remote file into file object, written block by block as they arrive, no local file needed
+        By sync protocol if use_server_socket, else by cat on device through exec-out
+        If pull fail in the middle, data already written to fileobj is not rolled back
+        Input: device [SN(for USB device) / IP:Port(for network device)](str) / None(for self._device)]
+               src(str), remote file path
+               fileobj(file object opened as binary, io.BytesIO, ...)
+               timeout(int/float)
+        Output: bytes pulled(int)
+        '''
+        self.logger.info("pull_stream: %s, target - %s", src, device)
+        if self.use_server_socket:
+            try:
+                size = self._sync_run(lambda sync: sync.recv(src, fileobj), device, timeout)
+                self.logger.info("pull_stream: success, %d bytes", size)
+                return size
+            except AdbServerUnavailable:
+                self.logger.warning("adb server socket unavailable, fall back to adb binary")
+        # exec-out mix stderr into data, so failure is told by a unique tail instead of error message
+        token = uuid.uuid4().hex
+        cmd = u"if [ -e {0} ]; then cat {0} 2>/dev/null || printf '\\n{1}:P'; else printf '\\n{1}:N'; fi".format(
+            _shell_quote(src), token)
+        token = u'\n{}:'.format(token).encode('ascii')
+        tail_size = len(token) + 1
+        tail = b''
+        size = 0
+        chunks = self._shell_chunks(cmd, device, timeout, service=u'exec')
+        try:
+            for chunk in chunks:
+                # Hold last tail_size bytes back until end, they may be failure token
+                data = tail + bytes(chunk)
+                tail = data[-tail_size:]
+                if len(data) > tail_size:
+                    fileobj.write(data[:-tail_size])
+                    size += len(data) - tail_size
+        finally:
+            chunks.close()
+        if tail[:-1] == token:
+            reason = NOFILEORFOLDER if tail[-1:] == b'N' else PERMISSION_DENY
+            self.logger.error("pull_stream: fail - %s", reason)
+            raise AdbFailException(reason, u'', u'cat {}: {}'.format(src, reason))
+        fileobj.write(tail)
+        size += len(tail)
+        self.logger.info("pull_stream: success, %d bytes", size)
+        return size
+
+    def pull_bytes(self, src, device=None, timeout=FILE_TRANSFORM_TIMEOUT):
+        '''
+        Pull remote file into memory, same as pull_stream
+        Output: content(bytes)
+        '''
+        buf = BytesIO()
+        self.pull_stream(src, buf, device=device, timeout=timeout)
+        return buf.getvalue()
+
+    def _shell_stdin(self, cmd, device, timeout, stdin, name):
+        '''
+        Run cmd on device, feed its stdin by stdin(fileobj), raise if cmd fail
+        By shell protocol v2 (adb server socket if use_server_socket, else adb shell) if device support it
+        Legacy device is fed by adb exec-in, which return no output, so error of cmd is not known
+        Input: stdin(function), same as AdbServerClient.shell_v2
+               name(str), caller name for log
+        Output: stdout(str)
+                stderr(str)
+        '''
+        ret = self._server_shell_v2(cmd, device, timeout, stdin=stdin)
+        if ret is not None:
+            stdout, stderr, exit_code = ret
+        else:
+            shell_v2 = self._has_feature(device, u'shell_v2')
+            token = uuid.uuid4().hex
+            # adb shell pass end of stdin only by shell protocol v2
+            command, remote_cmd = ('shell', self._status_cmd(cmd, token)) if shell_v2 else ('exec-in', cmd)
+            try:
+                stdout, stderr = self._command_blocking(['-s', device, command,
+                                                         _to_utf8(remote_cmd) if IS_PY2 else remote_cmd],
+                                                        timeout=timeout, stdin=stdin)
+            except NoDeviceException:
+                raise AdbNoDevice
+            except SubprocessException as err:
+                if err.msg == TIMEOUT:
+                    raise AdbTimeout(err.msg, err.stdout, err.stderr)
+                raise AdbFailException(err.msg, err.stdout, err.stderr)
+            if u'error: ' in stderr:
+                error = self.adb_error_re.search(stderr).group(1)
+                self.logger.error("%s: error. %s", name, error)
+                raise AdbFailException(error, stdout, stderr)
+            stdout, stderr, exit_code = self._status_parse(token, stdout, stderr) if shell_v2 else (stdout, stderr, 0)
+        if exit_code != 0:
+            output = u'{}\n{}'.format(stdout, stderr)
+            if u'Permission denied' in output:
+                reason = PERMISSION_DENY
+            elif u'Read-only file system' in output:
+                reason = READONLY
+            elif u'No such file or directory' in output:
+                reason = NOFILEORFOLDER
+            else:
+                reason = SHELL_FAILED
+            self.logger.error("%s: fail - %s", name, output.strip())
+            raise AdbFailException(reason, stdout, stderr)
+        return stdout, stderr
+
     @_device_checkor
     def remount(self, device=None):
         '''
@@ -656,6 +1324,12 @@ class AdbWrapper(BaseWrapper):
                 raise AdbTimeout(err.msg, err.stdout, err.stderr)
             else:
                 raise
+        return self._remount_parse(device, stdout, stderr)
+
+    def _remount_parse(self, device, stdout, stderr):
+        '''
+        Check output of adb remount, shared with AsyncAdbWrapper
+        '''
         if u'Operation not permitted' in stdout \
            or u'Not running as root' in stdout \
            or u'Permission denied' in stdout:
@@ -685,10 +1359,11 @@ class AdbWrapper(BaseWrapper):
         Output: None
         '''
         self.logger.info("root: start")
+        self._device_reset(device)
         self.logger.info("root: target - %s", device)
         cmdlist = ['-s', device, 'root']
         try:
-            stdout, stderr = self._command_blocking(cmdlist)
+            stdout, stderr = self._command_auto(cmdlist, server_request=lambda t: self._server.root(device, t))
         except NoDeviceException:
             raise AdbNoDevice
         except SubprocessException as err:
@@ -696,6 +1371,12 @@ class AdbWrapper(BaseWrapper):
                 raise AdbTimeout(err.msg, err.stdout, err.stderr)
             else:
                 raise
+        return self._root_parse(device, stdout, stderr)
+
+    def _root_parse(self, device, stdout, stderr):
+        '''
+        Check output of adb root, shared with AsyncAdbWrapper
+        '''
         if u'error: ' in stderr:
             error = self.adb_error_re.search(stderr).group(1)
             self.logger.error("root: error. %s", error)
@@ -732,10 +1413,11 @@ class AdbWrapper(BaseWrapper):
         Output: None
         '''
         self.logger.info("unroot: start")
+        self._device_reset(device)
         self.logger.info("unroot: target - %s", device)
         cmdlist = ['-s', device, 'unroot']
         try:
-            stdout, stderr = self._command_blocking(cmdlist)
+            stdout, stderr = self._command_auto(cmdlist, server_request=lambda t: self._server.unroot(device, t))
         except NoDeviceException:
             raise AdbNoDevice
         except SubprocessException as err:
@@ -743,6 +1425,12 @@ class AdbWrapper(BaseWrapper):
                 raise AdbTimeout(err.msg, err.stdout, err.stderr)
             else:
                 raise
+        return self._unroot_parse(device, stdout, stderr)
+
+    def _unroot_parse(self, device, stdout, stderr):
+        '''
+        Check output of adb unroot, shared with AsyncAdbWrapper
+        '''
         if u'error: ' in stderr:
             error = self.adb_error_re.search(stderr).group(1)
             self.logger.error("unroot: error. %s", error)
@@ -782,6 +1470,7 @@ class AdbWrapper(BaseWrapper):
         Output: None
         '''
         self.logger.info("reboot: start")
+        self._device_reset(device)
         if not mode:
             _mode = u'normal'
             cmdlist = ['-s', device, 'reboot']
@@ -790,7 +1479,8 @@ class AdbWrapper(BaseWrapper):
             cmdlist = ['-s', device, 'reboot', _mode]
         self.logger.info("reboot {mode}: target - {device}".format(mode=_mode, device=device))
         try:
-            stdout, stderr = self._command_blocking(cmdlist, timeout=3)
+            stdout, stderr = self._command_auto(cmdlist, timeout=3,
+                                                server_request=lambda t: self._server.reboot(device, mode, t))
         except NoDeviceException:
             raise AdbNoDevice
         except SubprocessException as err:
@@ -798,6 +1488,12 @@ class AdbWrapper(BaseWrapper):
                 stdout, stderr = err.stdout, err.stderr
             else:
                 raise
+        return self._reboot_parse(stdout, stderr)
+
+    def _reboot_parse(self, stdout, stderr):
+        '''
+        Check output of adb reboot, shared with AsyncAdbWrapper
+        '''
         if u'\'adb root\' is required for \'adb reboot sideload\'.' in stdout:
             self.logger.error("reboot: %s", PERMISSION_DENY)
             raise AdbFailException(PERMISSION_DENY, stdout, stderr)
@@ -816,12 +1512,13 @@ class AdbWrapper(BaseWrapper):
         return self.reboot(mode=u'bootloader', device=device)
 
     @_device_checkor
-    def shell(self, cmd, device=None, timeout=None):
+    def shell(self, cmd, device=None, timeout=None, raw=False):
         '''
         Do adb shell with autoexit command
         Input: device [SN(for USB device) / IP:Port(for network device)](str) / None(for self._device)]
                cmd (str)
                timeout [int/float/None(infinite)]
+               raw (bool), True: stdout is memoryview of bytes from adb (no decode/strip/newline convert)
         Output: stdout[from adb command](str)
                 stderr(str)
         '''
@@ -833,7 +1530,11 @@ class AdbWrapper(BaseWrapper):
         self.logger.info("shell(block): target - %s", device)
         self.logger.info("shell(block): cmd - %s", cmd)
         try:
-            stdout, stderr = self._command_blocking(cmdlist, timeout=timeout)
+            if raw:
+                server_request = lambda t: self._server.shell(device, cmd, t)
+            else:
+                server_request = lambda t: self._server_shell(cmd, device, t)
+            stdout, stderr = self._command_auto(cmdlist, timeout=timeout, server_request=server_request, raw=raw)
         except NoDeviceException:
             raise AdbNoDevice
         except SubprocessException as err:
@@ -841,13 +1542,335 @@ class AdbWrapper(BaseWrapper):
                 raise AdbTimeout(err.msg, err.stdout, err.stderr)
             else:
                 raise AdbFailException(err.msg, err.stdout, err.stderr)
+        return self._shell_parse(stdout, stderr)
+
+    def _shell_parse(self, stdout, stderr):
+        '''
+        Check output of adb shell, shared with AsyncAdbWrapper
+        '''
         if u'error: ' in stderr:
             error = self.adb_error_re.search(stderr).group(1)
-            self.logger.error("reboot: error. %s", error)
+            self.logger.error("shell: error. %s", error)
             raise AdbFailException(error, stdout, stderr)
         self.logger.info("shell(block): success")
         return stdout, stderr
 
+    def _server_shell(self, cmd, device, timeout):
+        '''
+        adb shell by adb server socket, stdout/stderr are mixed in stdout
+        Output: stdout(str)
+        '''
+        stdout = _decode_output(self._server.shell(device, cmd, timeout), self.logger)
+        return stdout.replace(u'\r\n', u'\n')
+
+    @_device_checkor
+    def shell_status(self, cmd, device=None, timeout=None):
+        '''
+        Do adb shell with autoexit command, and get its exit code
+        If use_server_socket and device support shell_v2, run by shell protocol v2 in one round trip
+        (stdout/stderr separated), else exit code is echoed after cmd by a unique sentinel
+        Input: device [SN(for USB device) / IP:Port(for network device)](str) / None(for self._device)]
+               cmd (str)
+               timeout [int/float/None(infinite)]
+        Output: stdout[from adb command](str)
+                stderr(str)
+                exit_code(int)
+        '''
+        self.logger.info("shell_status: target - %s", device)
+        self.logger.info("shell_status: cmd - %s", cmd)
+        result = self._server_shell_v2(cmd, device, timeout)
+        if result is not None:
+            self.logger.info("shell_status: exit code %d", result[2])
+            return result
+        token = uuid.uuid4().hex
+        stdout, stderr = self.shell(self._status_cmd(cmd, token), device=device, timeout=timeout)
+        return self._status_parse(token, stdout, stderr)
+
+    def _has_feature(self, device, feature):
+        '''
+        Check feature (such as shell_v2) supported by device
+        By adb server socket if use_server_socket, else by adb features (queried once for each device)
+        Output: bool
+        '''
+        if self.use_server_socket:
+            try:
+                return self._server.has_feature(device, feature)
+            except AdbServerUnavailable:
+                self.logger.warning("adb server socket unavailable, fall back to adb binary")
+            except AdbServerException:
+                return False
+        features = self._features.get(device)
+        if features is None:
+            try:
+                stdout, stderr = self._command_blocking(['-s', device, 'features'])
+            except (SubprocessException, NoDeviceException):
+                return False
+            if u'error' in stderr:
+                # Device not ready or adb binary too old to know features, check again next time
+                return False
+            features = self._features[device] = set(item.strip() for item in stdout.split(u',') if item.strip())
+        return feature in features
+
+    def _server_shell_v2(self, cmd, device, timeout, stdin=None):
+        '''
+        adb shell by shell protocol v2 if use_server_socket and device support it
+        stdin: same as AdbServerClient.shell_v2
+        Output: (stdout(str), stderr(str), exit_code(int)) / None [shell protocol v2 not available]
+        '''
+        if not self.use_server_socket:
+            return None
+        try:
+            if not self._server.has_feature(device, u'shell_v2'):
+                return None
+            stdout, stderr, exit_code = self._server.shell_v2(device, cmd, timeout, stdin)
+        except AdbServerUnavailable:
+            self.logger.warning("adb server socket unavailable, fall back to adb binary")
+            return None
+        except AdbServerException as err:
+            raise self._server_error(err)
+        return _decode_output(stdout, self.logger).strip(), _decode_output(stderr, self.logger).strip(), exit_code
+
+    def _status_cmd(self, cmd, token):
+        '''
+        Output: cmd which echo its exit code after token
+        '''
+        return u'{{ {}\n}}; echo "{}:$?"'.format(_to_unicode(cmd), token)
+
+    def _status_parse(self, token, stdout, stderr):
+        '''
+        Split exit code echoed by _status_cmd from stdout, shared with AsyncAdbWrapper
+        Output: stdout(str) / stderr(str) / exit_code(int)
+        '''
+        match = re.search(token + r':(\d+)\s*$', stdout)
+        if match is None:
+            self.logger.error("shell_status: no exit code in output")
+            raise AdbFailException(SHELL_FAILED, stdout, stderr)
+        self.logger.info("shell_status: exit code %s", match.group(1))
+        return stdout[:match.start()].strip(), stderr, int(match.group(1))
+
+    @_device_checkor
+    def shell_batch(self, cmds, device=None, timeout=None):
+        '''
+        Run many independent shell commands in one adb shell round trip, get result of each one
+        Commands are joined into one remote script (split into more scripts if too long for adb),
+        output of each command is split back by unique markers
+        Commands run one by one in the same shell, so cd/export affect later ones, exit stops the rest
+        Input: device [SN(for USB device) / IP:Port(for network device)](str) / None(for self._device)]
+               cmds (list of str)
+               timeout [int/float/None(infinite)], for each script
+        Output: [(stdout(str), stderr(str), exit_code(int/None [not finished])), ...] same order as cmds
+        '''
+        self.logger.info("shell_batch: target - %s, %d commands", device, len(cmds))
+        results = []
+        for script_cmds in self._batch_split(cmds):
+            token = uuid.uuid4().hex
+            script = self._batch_cmd(script_cmds, token)
+            # Not shell_status, script may stop by exit before its exit code echoed
+            result = self._server_shell_v2(script, device, timeout)
+            stdout, stderr = result[:2] if result is not None else self.shell(script, device=device, timeout=timeout)
+            results.extend(self._batch_parse(token, len(script_cmds), stdout, stderr))
+        return results
+
+    def _batch_split(self, cmds):
+        '''
+        Split cmds for scripts not longer than SHELL_BATCH_SCRIPT_MAX
+        '''
+        script_cmds, size = [], 0
+        for cmd in cmds:
+            cmd = _to_unicode(cmd)
+            if script_cmds and size + len(cmd) > SHELL_BATCH_SCRIPT_MAX:
+                yield script_cmds
+                script_cmds, size = [], 0
+            script_cmds.append(cmd)
+            size += len(cmd) + SHELL_BATCH_CMD_OVERHEAD
+        if script_cmds:
+            yield script_cmds
+
+    def _batch_cmd(self, cmds, token):
+        '''
+        Output: script, each cmd is wrapped as
+                "\\ntoken:index" to stderr, cmd, then "\\ntoken:index:exit_code" to stdout
+        '''
+        return u''.join(u'printf \'\\n{0}:{1}\\n\' >&2; {{ {2}\n}} </dev/null; printf \'\\n{0}:{1}:%s\\n\' $?\n'.format(
+            token, index, cmd) for index, cmd in enumerate(cmds))
+
+    def _batch_parse(self, token, num, stdout, stderr):
+        '''
+        Split output of _batch_cmd script, shared with AsyncAdbWrapper
+        stdout/stderr may be mixed (adb shell without shell protocol), stderr markers are in stdout then
+        pty line end \\r\\n is converted to \\n, same as shell
+        Output: [(stdout, stderr, exit_code), ...]
+        '''
+        marker_re = re.compile(r'^{}:(\d+)(?::(\d+))?$'.format(token))
+        outs, errs, exit_codes = [[] for _ in range(num)], [[] for _ in range(num)], [None] * num
+        # stdout lines belong to first cmd without exit code, stderr lines belong to cmd of last marker
+        pending = 0
+        for line in stdout.replace(u'\r\n', u'\n').split(u'\n'):
+            match = marker_re.match(line)
+            if match is None:
+                if pending < num:
+                    outs[pending].append(line)
+            elif match.group(2) is not None:
+                exit_codes[int(match.group(1))] = int(match.group(2))
+                pending = int(match.group(1)) + 1
+        current = None
+        for line in stderr.replace(u'\r\n', u'\n').split(u'\n'):
+            match = marker_re.match(line)
+            if match is not None:
+                current = int(match.group(1))
+            elif current is not None:
+                errs[current].append(line)
+        if exit_codes[-1] is None:
+            self.logger.error("shell_batch: %d commands not finished", exit_codes.count(None))
+        return [(u'\n'.join(out).strip(), u'\n'.join(err).strip(), exit_code)
+                for out, err, exit_code in zip(outs, errs, exit_codes)]
+
+    @_device_checkor
+    def exec_out(self, cmd, device=None, timeout=None):
+        '''
+        Do adb exec-out, for binary output such as screencap -p / tar
+        No pty on device, so output is not mangled by newline convert
+        Input: device [SN(for USB device) / IP:Port(for network device)](str) / None(for self._device)]
+               cmd (str)
+               timeout [int/float/None(infinite)]
+        Output: stdout(memoryview of bytes)
+        '''
+        self.logger.info("exec_out: target - %s", device)
+        self.logger.info("exec_out: cmd - %s", cmd)
+        if IS_PY2:
+            cmdlist = ['-s', device, 'exec-out', '{}'.format(_to_utf8(cmd))]
+        else:
+            cmdlist = ['-s', device, 'exec-out', '{}'.format(_to_unicode(cmd))]
+        try:
+            stdout, stderr = self._command_auto(cmdlist, timeout=timeout, raw=True,
+                                                server_request=lambda t: self._server.exec_out(device, cmd, t))
+        except NoDeviceException:
+            raise AdbNoDevice
+        except SubprocessException as err:
+            if err.msg == TIMEOUT:
+                raise AdbTimeout(err.msg, err.stdout, err.stderr)
+            raise AdbFailException(err.msg, err.stdout, err.stderr)
+        if u'error: ' in stderr:
+            error = self.adb_error_re.search(stderr).group(1)
+            self.logger.error("exec_out: error. %s", error)
+            raise AdbFailException(error, stdout, stderr)
+        return stdout
+
+    @_device_checkor
+    def shell_iter(self, cmd, device=None, timeout=None, lines=True):
+        '''
+        Do adb shell and yield output as it arrives, for long/huge output (cat, find, dumpsys, ...)
+        Caller can stop early by break or generator close(), adb process/socket is closed at once
+        By adb server socket if use_server_socket (stdout/stderr are mixed), else by adb binary
+        Input: device [SN(for USB device) / IP:Port(for network device)](str) / None(for self._device)]
+               cmd (str)
+               timeout [int/float/None(infinite)], for whole command
+               lines (bool), True: yield lines(str) without line break / False: yield stdout chunks(bytes)
+        Output: generator of line(str) / chunk(bytes)
+        '''
+        self.logger.info("shell_iter: target - %s", device)
+        self.logger.info("shell_iter: cmd - %s", cmd)
+        chunks = self._shell_chunks(cmd, device, timeout)
+        try:
+            for item in (_iter_lines(chunks) if lines else chunks):
+                yield item
+        finally:
+            chunks.close()
+
+    def _shell_chunks(self, cmd, device, timeout, service=u'shell'):
+        '''
+        Generator of adb shell stdout chunks(bytes) for shell_iter
+        service: shell / exec (adb exec-out, raw output without pty)
+        '''
+        conn = None
+        if self.use_server_socket:
+            try:
+                conn = self._server.open_service(device, u'{}:{}'.format(service, _to_unicode(cmd)), timeout)
+            except AdbServerUnavailable:
+                self.logger.warning("adb server socket unavailable, fall back to adb binary")
+            except AdbServerException as err:
+                raise self._server_error(err)
+        if conn is not None:
+            deadline = None if timeout is None else time.time() + timeout
+            try:
+                while 1:
+                    if deadline is not None:
+                        conn.settimeout(max(deadline - time.time(), 0.001))
+                    try:
+                        chunk = conn.read()
+                    except AdbServerException as err:
+                        raise self._server_error(err)
+                    if not chunk:
+                        return
+                    yield chunk
+            finally:
+                conn.close()
+        command = 'exec-out' if service == u'exec' else 'shell'
+        if IS_PY2:
+            cmdlist = ['-s', device, command, '{}'.format(_to_utf8(cmd))]
+        else:
+            cmdlist = ['-s', device, command, '{}'.format(_to_unicode(cmd))]
+        stderr = []
+        try:
+            for name, chunk in self._command_iter(cmdlist, timeout):
+                if name == u'stdout':
+                    yield chunk
+                else:
+                    stderr.append(chunk)
+        except NoDeviceException:
+            raise AdbNoDevice
+        except SubprocessException as err:
+            if err.msg == TIMEOUT:
+                raise AdbTimeout(err.msg, u'', _decode_output(b''.join(stderr), self.logger))
+            raise AdbFailException(err.msg, err.stdout, err.stderr)
+        stderr_str = _decode_output(b''.join(stderr), self.logger)
+        if u'error: ' in stderr_str:
+            error = self.adb_error_re.search(stderr_str).group(1)
+            self.logger.error("shell_iter: error. %s", error)
+            raise AdbFailException(error, u'', stderr_str)
+
+    @_device_checkor
+    def shell_session(self, device=None):
+        '''
+        Get persistent shell session of device, start a new one if not exist or dead
+        Commands run by session.run(cmd, timeout) skip adb process start for each command
+        Input: device [SN(for USB device) / IP:Port(for network device)](str) / None(for self._device)]
+        Output: AdbShellSession
+        '''
+        with self._shell_sessions_lock:
+            session = self._shell_sessions.get(device)
+            if session is not None and session.isalive():
+                return session
+            self.logger.info("shell_session: start new session - %s", device)
+            res, p = self._adbcommand_unblocking(['-s', device, 'shell'])
+            if not isinstance(p, subprocess.Popen):
+                raise AdbFailException(p, u'', u'')
+            session = AdbShellSession(p, device, self.logger, self._nodevice_matcher)
+            self._shell_sessions[device] = session
+            return session
+
+    def shell_session_close(self, device=None):
+        '''
+        Close persistent shell session, it should be called when device connection will be changed
+        Input: device [SN(for USB device) / IP:Port(for network device)](str) / None(for all device)]
+        '''
+        with self._shell_sessions_lock:
+            for name in list(self._shell_sessions):
+                if device is None or name == device:
+                    self._shell_sessions.pop(name).close()
+
+    def _device_reset(self, device=None):
+        '''
+        Drop all state kept for device, called when its connection will be changed (disconnect/reboot/root/unroot)
+        Subclass keeping more per-device state should extend it
+        Input: device [SN(for USB device) / IP:Port(for network device)](str) / None(for all device)]
+        '''
+        self.shell_session_close(device)
+        if device is None:
+            self._features.clear()
+        else:
+            self._features.pop(device, None)
+
     @_device_checkor
     def shell_unblock(self, cmd, device=None):
         '''
@@ -895,14 +1918,7 @@ class AdbWrapper(BaseWrapper):
         self.logger.info("install: start")
         self.logger.info("install: target - %s", device)
         self.logger.info("apk: {}".format(os.path.abspath(apkfile)))
-        cmdlist = ['-s', device, 'install']
-        if forward: cmdlist.append('-l')
-        if replace: cmdlist.append('-r')
-        if test: cmdlist.append('-t')
-        if sdcard: cmdlist.append('-s')
-        if downgrade: cmdlist.append('-d')
-        if permission: cmdlist.append('-g')
-        cmdlist.append(os.path.abspath(apkfile))
+        cmdlist = self._install_cmdlist(apkfile, forward, replace, test, sdcard, downgrade, permission, device)
         try:
             stdout, stderr = self._command_blocking(cmdlist, timeout=timeout)
         except NoDeviceException:
@@ -912,6 +1928,23 @@ class AdbWrapper(BaseWrapper):
                 raise AdbTimeout(err.msg, err.stdout, err.stderr)
             else:
                 raise
+        return self._install_parse(stdout, stderr)
+
+    def _install_cmdlist(self, apkfile, forward, replace, test, sdcard, downgrade, permission, device):
+        cmdlist = ['-s', device, 'install']
+        if forward: cmdlist.append('-l')
+        if replace: cmdlist.append('-r')
+        if test: cmdlist.append('-t')
+        if sdcard: cmdlist.append('-s')
+        if downgrade: cmdlist.append('-d')
+        if permission: cmdlist.append('-g')
+        cmdlist.append(os.path.abspath(apkfile))
+        return cmdlist
+
+    def _install_parse(self, stdout, stderr):
+        '''
+        Check output of adb install, shared with AsyncAdbWrapper
+        '''
         if u'No APK file on command line' in stderr:
             reason = u'No APK file on command line'
             self.logger.error("install: %s", reason)
@@ -978,6 +2011,12 @@ class AdbWrapper(BaseWrapper):
                 raise AdbTimeout(err.msg, err.stdout, err.stderr)
             else:
                 raise
+        return self._uninstall_parse(stdout, stderr)
+
+    def _uninstall_parse(self, stdout, stderr):
+        '''
+        Check output of adb uninstall, shared with AsyncAdbWrapper
+        '''
         if u'Failure' in stdout:
             reason = self.pm_failure_re.search(stdout[stdout.find('Failure'):]).group(1)
             self.logger.error("uninstall: {!r}".format(reason))
@@ -1001,6 +2040,12 @@ class AdbWrapper(BaseWrapper):
         Output: None
         '''
         self.logger.info("wait-for-device")
+        if self._tracked_devices() is not None:
+            if not self._tracker.wait_for(lambda devices: u'device' in devices.values(), timeout):
+                self.logger.error("wait-for-device: timeout")
+                raise AdbTimeout(TIMEOUT, u'', u'')
+            self.logger.info("wait-for-device: success")
+            return
         cmdlist = ['wait-for-device']
         try:
             stdout, stderr = self._command_blocking(cmdlist, timeout=timeout)
@@ -1011,6 +2056,12 @@ class AdbWrapper(BaseWrapper):
                 raise AdbTimeout(err.msg, err.stdout, err.stderr)
             else:
                 raise
+        return self._wait_for_device_parse(stdout, stderr)
+
+    def _wait_for_device_parse(self, stdout, stderr):
+        '''
+        Check output of adb wait-for-device, shared with AsyncAdbWrapper
+        '''
         if 'adb: couldn\'t parse \'wait-for\' command' in stderr:
             reason = 'Fail parse wait-for'
             self.logger.error("wait-for-device: %s", reason)
@@ -1054,6 +2105,12 @@ class AdbWrapper(BaseWrapper):
                 raise AdbTimeout(err.msg, err.stdout, err.stderr)
             else:
                 raise
+        return self._disable_verity_parse(device, stdout, stderr)
+
+    def _disable_verity_parse(self, device, stdout, stderr):
+        '''
+        Check output of adb disable-verity, shared with AsyncAdbWrapper
+        '''
         if u'disable-verity only works for userdebug builds' in stdout:
             self.logger.error("disable-verity: disable-verity only works for userdebug builds - {}".format(device))
             raise AdbFailException(u"disable-verity only works for userdebug builds", stdout, stderr)
@@ -1093,6 +2150,12 @@ class AdbWrapper(BaseWrapper):
                 raise AdbTimeout(err.msg, err.stdout, err.stderr)
             else:
                 raise
+        return self._enable_verity_parse(device, stdout, stderr)
+
+    def _enable_verity_parse(self, device, stdout, stderr):
+        '''
+        Check output of adb enable-verity, shared with AsyncAdbWrapper
+        '''
         if u'error: ' in stderr:
             error = self.adb_error_re.search(stderr).group(1)
             self.logger.error("enable-verity: error. %s", error)
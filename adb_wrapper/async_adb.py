@@ -0,0 +1,815 @@
+# -*- coding: utf-8 -*-
+'''
+asyncio front-end of AdbWrapper/AdbAuto (Python 3.6+ only)
+Commands run by asyncio subprocess or by adb server socket (asyncio streams),
+output parsing and exceptions are shared with AdbWrapper
+AsyncAdbAuto helpers run the AdbAuto implementation in executor
+'''
+import os
+import time
+import shlex
+import asyncio
+import logging
+import uuid
+import codecs
+import functools
+from subprocess import PIPE
+from io import open
+
+from .base_wrapper import _to_unicode, _decode_output
+from .base_wrapper import OUT_CODING, OUT_ERROR_HANDLING
+from .base_wrapper import PIPE_READ_SIZE, PROCESS_EXIT_CHECK_GAP
+from .base_wrapper import COMMON_BLOCKING_TIMEOUT, FILE_TRANSFORM_TIMEOUT, BUGREPORT_TIMEOUT
+from .base_wrapper import _device_checkor
+from .base_wrapper import TIMEOUT
+from .base_wrapper import SubprocessException, NoDeviceException, WrongCommandException
+from .adb_wrapper import AdbWrapper
+from .adb_auto import AdbAuto
+from .adb_wrapper import ADB_SERVER_PORT, ADB_SERVER_POOL_SIZE
+from .adb_wrapper import AdbFailException, AdbNoDevice, AdbTimeout
+from .adb_server import ADB_SERVER_HOST, ADB_SERVER_CONNECT_TIMEOUT, SOCKET_READ_SIZE
+from .adb_server import SHELL_V2_STDOUT, SHELL_V2_STDERR, SHELL_V2_EXIT
+from .adb_server import AdbServerException, AdbServerUnavailable, AdbServerFail, AdbServerTimeout
+
+PROCESS_STREAM_LIMIT = 2 ** 16  # Buffer limit of process StreamReader, same as asyncio default
+
+
+class _ExitNotifyProtocol(asyncio.subprocess.SubprocessStreamProtocol):
+    '''
+    SubprocessStreamProtocol which also resolve exited future once process exit
+    Process.wait also wait pipes closed, which may be held by grandchild (adb server)
+    '''
+    def __init__(self, limit, loop):
+        super(_ExitNotifyProtocol, self).__init__(limit=limit, loop=loop)
+        self.exited = loop.create_future()
+
+    def process_exited(self):
+        super(_ExitNotifyProtocol, self).process_exited()
+        if not self.exited.done():
+            self.exited.set_result(None)
+
+
+async def _create_process(cmdlist, **kwargs):
+    '''
+    Same as asyncio.create_subprocess_exec, Process has exited future for _process_exit
+    Input: cmdlist(list), converted by _cmdlist_convert
+    Output: asyncio.subprocess.Process
+    '''
+    loop = asyncio.get_event_loop()
+    transport, protocol = await loop.subprocess_exec(lambda: _ExitNotifyProtocol(PROCESS_STREAM_LIMIT, loop),
+                                                     *cmdlist, **kwargs)
+    p = asyncio.subprocess.Process(transport, protocol, loop)
+    p.exited = protocol.exited
+    return p
+
+
+async def _process_exit(p):
+    '''
+    Wait process exit only, not its pipes closed, by exit notification of child watcher
+    Output: returncode(int)
+    '''
+    await asyncio.shield(p.exited)
+    return p.returncode
+
+
+def _process_kill(p):
+    '''
+    Kill asyncio process and close its pipes, even if pipes are still held by grandchild
+    '''
+    if p.returncode is None:
+        try:
+            p.kill()
+        except ProcessLookupError:
+            pass
+    transport = getattr(p, '_transport', None)
+    if transport is not None:
+        transport.close()
+
+
+class AsyncAdbServerConnection(object):
+    '''
+    One asyncio stream to adb server (smart socket protocol), see AdbServerConnection
+    '''
+    def __init__(self, reader, writer, logger):
+        self.reader, self.writer = reader, writer
+        self.logger = logger
+
+    @classmethod
+    async def open(cls, host, port, timeout, logger):
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+        except (OSError, asyncio.TimeoutError) as err:
+            logger.error("adb server %s:%s connect fail: %r", host, port, err)
+            raise AdbServerUnavailable(u"{!r}".format(err))
+        return cls(reader, writer, logger)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    async def send(self, data):
+        try:
+            self.writer.write(data)
+            await self.writer.drain()
+        except OSError as err:
+            raise AdbServerException(u"{}".format(err))
+
+    async def read(self, size=SOCKET_READ_SIZE):
+        try:
+            return await self.reader.read(size)
+        except OSError as err:
+            raise AdbServerException(u"{}".format(err))
+
+    async def read_exactly(self, size):
+        try:
+            return await self.reader.readexactly(size)
+        except asyncio.IncompleteReadError:
+            raise AdbServerException(u'connection closed by adb server')
+        except OSError as err:
+            raise AdbServerException(u"{}".format(err))
+
+    async def read_hex_string(self):
+        length = int(await self.read_exactly(4), 16)
+        return await self.read_exactly(length)
+
+    async def request(self, service):
+        '''
+        Send service request, check OKAY/FAIL
+        Raise AdbServerFail with reason if reply FAIL
+        '''
+        _service = service.encode('UTF-8')
+        self.logger.debug("adb server request: %r", _service)
+        await self.send(u'{:04x}'.format(len(_service)).encode('ascii') + _service)
+        status = await self.read_exactly(4)
+        if status == b'OKAY':
+            return
+        elif status == b'FAIL':
+            reason = _to_unicode(await self.read_hex_string())
+            self.logger.error("adb server request %r fail: %s", _service, reason)
+            raise AdbServerFail(reason)
+        raise AdbServerException(u'Invalid adb server status: {!r}'.format(status))
+
+
+class AsyncAdbServerClient(object):
+    '''
+    asyncio version of AdbServerClient, every request open a new stream (no pool needed,
+    stream costs nothing but one socket on event loop)
+    '''
+    def __init__(self, host=ADB_SERVER_HOST, port=ADB_SERVER_PORT, timeout=ADB_SERVER_CONNECT_TIMEOUT, logger=None):
+        self.logger = logger if logger else logging.getLogger('adb')
+        self.host, self.port, self.timeout = host, port, timeout
+        self._features = {}  # serial: features(set)
+
+    async def connection(self):
+        return await AsyncAdbServerConnection.open(self.host, self.port, self.timeout, self.logger)
+
+    async def _host_request(self, service):
+        conn = await self.connection()
+        try:
+            await conn.request(service)
+            return await conn.read_hex_string()
+        finally:
+            conn.close()
+
+    async def version(self):
+        return int(await self._host_request(u'host:version'), 16)
+
+    async def devices(self):
+        return _to_unicode(await self._host_request(u'host:devices'))
+
+    async def features(self, serial):
+        reply = _to_unicode(await self._host_request(u'host-serial:{}:features'.format(serial)))
+        return set(reply.split(u',')) if reply else set()
+
+    async def has_feature(self, serial, feature):
+        features = self._features.get(serial)
+        if features is None:
+            features = self._features[serial] = await self.features(serial)
+        return feature in features
+
+    def evict(self, serial=None):
+        if serial is None:
+            self._features.clear()
+        else:
+            self._features.pop(serial, None)
+
+    async def connect(self, address):
+        return _to_unicode(await self._host_request(u'host:connect:{}'.format(address)))
+
+    async def disconnect(self, address=None):
+        return _to_unicode(await self._host_request(u'host:disconnect:{}'.format(address if address else u'')))
+
+    async def open_service(self, serial, service):
+        '''
+        Output: AsyncAdbServerConnection, the service stream
+        '''
+        conn = await self.connection()
+        try:
+            await conn.request(u'host:transport:{}'.format(serial) if serial else u'host:transport-any')
+            await conn.request(service)
+        except AdbServerFail:
+            conn.close()
+            self.evict(serial)
+            raise
+        except BaseException:
+            conn.close()
+            raise
+        return conn
+
+    async def service(self, serial, service, timeout=None):
+        '''
+        Run device service, read all output until stream closed
+        If timeout, raise AdbServerTimeout with received data
+        Output: output(bytes)
+        '''
+        chunks = []
+
+        async def read_all(conn):
+            while 1:
+                chunk = await conn.read()
+                if not chunk:
+                    return
+                chunks.append(chunk)
+        conn = await self.open_service(serial, service)
+        try:
+            await asyncio.wait_for(read_all(conn), timeout)
+        except asyncio.TimeoutError:
+            raise AdbServerTimeout(u'read timeout', b''.join(chunks))
+        finally:
+            conn.close()
+        return b''.join(chunks)
+
+    async def shell(self, serial, cmd, timeout=None):
+        return await self.service(serial, u'shell:{}'.format(_to_unicode(cmd)), timeout)
+
+    async def exec_out(self, serial, cmd, timeout=None):
+        return await self.service(serial, u'exec:{}'.format(_to_unicode(cmd)), timeout)
+
+    async def shell_v2(self, serial, cmd, timeout=None):
+        '''
+        adb shell by shell protocol v2
+        Output: stdout(bytes) / stderr(bytes) / exit_code(int)
+        '''
+        stdout, stderr = [], []
+
+        async def read_packets(conn):
+            while 1:
+                header = await conn.read_exactly(5)
+                packet_id, length = header[0], int.from_bytes(header[1:], 'little')
+                payload = await conn.read_exactly(length)
+                if packet_id == SHELL_V2_STDOUT:
+                    stdout.append(payload)
+                elif packet_id == SHELL_V2_STDERR:
+                    stderr.append(payload)
+                elif packet_id == SHELL_V2_EXIT:
+                    return payload[0]
+        conn = await self.open_service(serial, u'shell,v2,raw:{}'.format(_to_unicode(cmd)))
+        try:
+            exit_code = await asyncio.wait_for(read_packets(conn), timeout)
+        except asyncio.TimeoutError:
+            raise AdbServerTimeout(u'read timeout', b''.join(stdout))
+        finally:
+            conn.close()
+        return b''.join(stdout), b''.join(stderr), exit_code
+
+    async def reboot(self, serial, mode=None, timeout=None):
+        return await self.service(serial, u'reboot:{}'.format(mode if mode else u''), timeout)
+
+    async def root(self, serial, timeout=None):
+        return await self.service(serial, u'root:', timeout)
+
+    async def unroot(self, serial, timeout=None):
+        return await self.service(serial, u'unroot:', timeout)
+
+
+class AsyncAdbLogcat(object):
+    '''
+    Handle of adb logcat/shell2file process created by AsyncAdbWrapper
+    '''
+    def __init__(self, process, filename, filehandler, logger):
+        self.p = process
+        self.name = filename
+        self._filehandler = filehandler
+        self.logger = logger
+
+    def isalive(self):
+        return self.p.returncode is None
+
+    async def join(self, timeout=None):
+        '''
+        Output: True [Process exist] / False [Timeout]
+        '''
+        try:
+            await asyncio.wait_for(_process_exit(self.p), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    def filename(self):
+        return self.name
+
+    async def close(self):
+        self.logger.info("AsyncAdbLogcat({}): close".format(self.name))
+        _process_kill(self.p)
+        await _process_exit(self.p)
+        self._filehandler.close()
+
+
+class AsyncAdbWrapper(AdbWrapper):
+    '''
+    AdbWrapper with native coroutine commands for asyncio
+    No thread for each command: adb binary is run by asyncio.create_subprocess_exec,
+    adb server socket (use_server_socket) is talked by asyncio streams
+    Output parsing and exceptions are same as AdbWrapper
+    push/pull always run adb binary, adb sync protocol is only in AdbWrapper
+    '''
+
+    def __init__(self, adb_file=None, logger=None, adb_server_port=ADB_SERVER_PORT, use_server_socket=False,
+                 server_pool_size=ADB_SERVER_POOL_SIZE, track_devices=False):
+        super(AsyncAdbWrapper, self).__init__(adb_file, logger, adb_server_port, use_server_socket, server_pool_size,
+                                              track_devices)
+        self._aserver = AsyncAdbServerClient(port=adb_server_port, logger=self.logger)
+
+    @property
+    def aserver(self):
+        '''
+        AsyncAdbServerClient talk to adb server on adb_server_port directly
+        '''
+        return self._aserver
+
+    async def _subprocess_exec(self, cmdlist, **kwargs):
+        '''
+        Start command by _create_process, process is added to subproc_list for kill_binary_proc/cleanup
+        Output: asyncio.subprocess.Process
+        '''
+        p = await _create_process(self._cmdlist_convert(cmdlist), **kwargs)
+        self.subproc_list.append(p)
+        return p
+
+    async def _command_async(self, cmdlist, timeout=COMMON_BLOCKING_TIMEOUT, raw=False):
+        '''
+        Coroutine version of _command_blocking, same input/output/exceptions
+        '''
+        try:
+            p = await self._subprocess_exec(cmdlist, stdin=asyncio.subprocess.DEVNULL, stdout=PIPE, stderr=PIPE)
+        except (OSError, ValueError) as err:
+            self.logger.error("Run %s command Exception: %r", self._binaryname, err)
+            raise SubprocessException(str(err), u'', u"{}".format(err))
+        stdout, stderr = bytearray(), bytearray()
+        nodevice_matcher = self._nodevice_matcher()
+
+        async def read(stream, buffer, matcher=None):
+            while 1:
+                chunk = await stream.read(PIPE_READ_SIZE)
+                if not chunk:
+                    return
+                buffer += chunk
+                if matcher is not None and matcher.feed(chunk):
+                    raise NoDeviceException
+
+        reader = asyncio.ensure_future(asyncio.gather(read(p.stdout, stdout), read(p.stderr, stderr, nodevice_matcher)))
+        waiter = asyncio.ensure_future(_process_exit(p))
+        deadline = None if timeout is None else time.time() + timeout
+        try:
+            pending = set([reader, waiter])
+            # Wait until process exit, reader fail or timeout, reader finish alone does not end the wait
+            while waiter in pending:
+                remaining = None if deadline is None else max(deadline - time.time(), 0)
+                _, pending = await asyncio.wait(pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+                if reader.done() and reader.exception() is not None:
+                    raise reader.exception()
+                if deadline is not None and time.time() >= deadline:
+                    break
+            if waiter.done() and not reader.done():
+                # Process exit, but pipe may be held by its child (adb server)
+                await asyncio.wait([reader], timeout=PROCESS_EXIT_CHECK_GAP)
+            timeout_flag = not waiter.done()
+        finally:
+            reader.cancel()
+            waiter.cancel()
+            # Cancelled gather keep CancelledError as its exception, retrieve it to avoid "never retrieved" log
+            reader.add_done_callback(lambda fut: fut.cancelled() or fut.exception())
+            _process_kill(p)
+        stderr_str = _decode_output(stderr, self.logger)
+        stdout_str = memoryview(stdout) if raw else _decode_output(stdout, self.logger)
+        if timeout_flag:
+            raise SubprocessException(TIMEOUT, stdout_str, stderr_str)
+        if raw:
+            return stdout_str, stderr_str.strip()
+        if stdout_str == self.stdout_help and stderr_str == self.stderr_help:
+            raise WrongCommandException
+        return stdout_str.strip(), stderr_str.strip()
+
+    async def _command_auto_async(self, cmdlist, timeout=COMMON_BLOCKING_TIMEOUT, server_request=None, raw=False):
+        '''
+        Coroutine version of _command_auto, server_request(timeout) should be a coroutine function
+        '''
+        if self.use_server_socket and server_request is not None:
+            try:
+                stdout = await server_request(timeout)
+            except AdbServerUnavailable:
+                self.logger.warning("adb server socket unavailable, fall back to adb binary")
+            except AdbServerFail as err:
+                stderr = u'error: {}'.format(err.msg)
+                if self._nodevice_check(stderr):
+                    raise NoDeviceException
+                return u'', stderr
+            except AdbServerTimeout as err:
+                raise SubprocessException(TIMEOUT, memoryview(err.data) if raw else _decode_output(err.data, self.logger), u'')
+            except AdbServerException as err:
+                raise SubprocessException(err.msg, u'', u'')
+            else:
+                if raw:
+                    return memoryview(stdout), u''
+                if isinstance(stdout, bytes):
+                    stdout = _decode_output(stdout, self.logger)
+                return stdout.strip(), u''
+        return await self._command_async(cmdlist, timeout, raw)
+
+    async def _run(self, cmdlist, timeout=COMMON_BLOCKING_TIMEOUT, server_request=None, raw=False,
+                   fail_exception=None):
+        '''
+        Run adb command, translate exceptions same as AdbWrapper commands
+        Input: fail_exception(class), translate other SubprocessException to it, None to raise directly
+        Output: stdout / stderr
+        '''
+        try:
+            return await self._command_auto_async(cmdlist, timeout, server_request, raw)
+        except NoDeviceException:
+            raise AdbNoDevice
+        except SubprocessException as err:
+            if err.msg == TIMEOUT:
+                raise AdbTimeout(err.msg, err.stdout, err.stderr)
+            if fail_exception is None:
+                raise
+            raise fail_exception(err.msg, err.stdout, err.stderr)
+
+    async def start_server(self):
+        self.logger.info("start_server: start")
+        stdout, stderr = await self._run(['start-server'])
+        return self._start_server_parse(stdout, stderr)
+
+    async def kill_server(self):
+        self.logger.info("kill-server: start")
+        stdout, stderr = await self._run(['kill-server'])
+        return self._kill_server_parse(stdout, stderr)
+
+    async def devices(self):
+        self.logger.info("devices: start")
+        devices = self._tracked_devices()
+        if devices is not None:
+            return devices
+        stdout, stderr = await self._run(['devices'], server_request=lambda _: self._aserver.devices())
+        return self._devices_parse(stdout, stderr)
+
+    @_device_checkor
+    async def connect(self, device=None):
+        self.logger.info("connect: target - %s", device)
+        stdout, stderr = await self._run(['connect', device], server_request=lambda _: self._aserver.connect(device))
+        devicename, retry_device = self._connect_parse(device, stdout, stderr)
+        if retry_device:
+            return await self.connect(retry_device)
+        return devicename
+
+    @_device_checkor
+    async def disconnect(self, device=None):
+        self.logger.info("disconnect: target - %s", device)
+        self._device_reset(device)
+        cmdlist = ['disconnect', device] if device else ['disconnect']
+        stdout, stderr = await self._run(cmdlist, server_request=lambda _: self._aserver.disconnect(device))
+        return self._disconnect_parse(device, stdout, stderr)
+
+    @_device_checkor
+    async def bugreport(self, filename=None, device=None, timeout=BUGREPORT_TIMEOUT):
+        self.logger.info("bugreport: target - %s", device)
+        try:
+            stdout, stderr = await self._command_async(['-s', device, 'bugreport'], timeout=timeout, raw=True)
+        except NoDeviceException:
+            raise AdbNoDevice
+        except SubprocessException as err:
+            if err.msg != TIMEOUT:
+                raise
+            self.logger.warning("bugreport timeout")
+            stdout, stderr = err.stdout, err.stderr
+        return self._bugreport_save(filename, stdout, stderr)
+
+    @_device_checkor
+    async def push(self, src, dst, device=None, timeout=FILE_TRANSFORM_TIMEOUT):
+        self.logger.info("push: target - %s", device)
+        srcs = list(src) if isinstance(src, (list, tuple)) else [src]
+        stdout, stderr = await self._run(['-s', device, 'push'] + srcs + [dst], timeout=timeout)
+        return self._push_parse(stdout, stderr)
+
+    @_device_checkor
+    async def pull(self, src, dst, device=None, timeout=FILE_TRANSFORM_TIMEOUT):
+        self.logger.info("pull: target - %s", device)
+        stdout, stderr = await self._run(['-s', device, 'pull', src, dst], timeout=timeout)
+        return self._pull_parse(src, dst, stdout, stderr)
+
+    @_device_checkor
+    async def remount(self, device=None):
+        self.logger.info("remount: target - %s", device)
+        stdout, stderr = await self._run(['-s', device, 'remount'])
+        return self._remount_parse(device, stdout, stderr)
+
+    @_device_checkor
+    async def root(self, device=None):
+        self.logger.info("root: target - %s", device)
+        self._device_reset(device)
+        stdout, stderr = await self._run(['-s', device, 'root'], server_request=lambda t: self._aserver.root(device, t))
+        return self._root_parse(device, stdout, stderr)
+
+    @_device_checkor
+    async def unroot(self, device=None):
+        self.logger.info("unroot: target - %s", device)
+        self._device_reset(device)
+        stdout, stderr = await self._run(['-s', device, 'unroot'],
+                                         server_request=lambda t: self._aserver.unroot(device, t))
+        return self._unroot_parse(device, stdout, stderr)
+
+    @_device_checkor
+    async def reboot(self, mode=None, device=None):
+        self.logger.info("reboot %s: target - %s", mode, device)
+        self._device_reset(device)
+        cmdlist = ['-s', device, 'reboot', _to_unicode(mode)] if mode else ['-s', device, 'reboot']
+        try:
+            stdout, stderr = await self._command_auto_async(cmdlist, timeout=3,
+                                                            server_request=lambda t: self._aserver.reboot(device, mode, t))
+        except NoDeviceException:
+            raise AdbNoDevice
+        except SubprocessException as err:
+            if err.msg != TIMEOUT:
+                raise
+            stdout, stderr = err.stdout, err.stderr
+        return self._reboot_parse(stdout, stderr)
+
+    @_device_checkor
+    async def reboot_bootloader(self, device=None):
+        return await self.reboot(mode=u'bootloader', device=device)
+
+    @_device_checkor
+    async def shell(self, cmd, device=None, timeout=None, raw=False):
+        self.logger.info("shell: target - %s, cmd - %s", device, cmd)
+        if raw:
+            server_request = lambda t: self._aserver.shell(device, cmd, t)
+        else:
+            server_request = lambda t: self._server_shell_async(cmd, device, t)
+        stdout, stderr = await self._run(['-s', device, 'shell', _to_unicode(cmd)], timeout=timeout,
+                                         server_request=server_request, raw=raw, fail_exception=AdbFailException)
+        return self._shell_parse(stdout, stderr)
+
+    async def _server_shell_async(self, cmd, device, timeout):
+        stdout = _decode_output(await self._aserver.shell(device, cmd, timeout), self.logger)
+        return stdout.replace(u'\r\n', u'\n')
+
+    @_device_checkor
+    async def shell_status(self, cmd, device=None, timeout=None):
+        self.logger.info("shell_status: target - %s, cmd - %s", device, cmd)
+        result = await self._aserver_shell_v2(cmd, device, timeout)
+        if result is not None:
+            return result
+        token = uuid.uuid4().hex
+        stdout, stderr = await self.shell(self._status_cmd(cmd, token), device=device, timeout=timeout)
+        return self._status_parse(token, stdout, stderr)
+
+    async def _aserver_shell_v2(self, cmd, device, timeout):
+        '''
+        Coroutine version of AdbWrapper._server_shell_v2
+        '''
+        if not self.use_server_socket:
+            return None
+        try:
+            if not await self._aserver.has_feature(device, u'shell_v2'):
+                return None
+            stdout, stderr, exit_code = await self._aserver.shell_v2(device, cmd, timeout)
+        except AdbServerUnavailable:
+            self.logger.warning("adb server socket unavailable, fall back to adb binary")
+            return None
+        except AdbServerException as err:
+            raise self._server_error(err)
+        return _decode_output(stdout, self.logger).strip(), _decode_output(stderr, self.logger).strip(), exit_code
+
+    @_device_checkor
+    async def shell_batch(self, cmds, device=None, timeout=None):
+        self.logger.info("shell_batch: target - %s, %d commands", device, len(cmds))
+        results = []
+        for script_cmds in self._batch_split(cmds):
+            token = uuid.uuid4().hex
+            script = self._batch_cmd(script_cmds, token)
+            result = await self._aserver_shell_v2(script, device, timeout)
+            stdout, stderr = result[:2] if result is not None else await self.shell(script, device=device,
+                                                                                    timeout=timeout)
+            results.extend(self._batch_parse(token, len(script_cmds), stdout, stderr))
+        return results
+
+    @_device_checkor
+    async def exec_out(self, cmd, device=None, timeout=None):
+        self.logger.info("exec_out: target - %s, cmd - %s", device, cmd)
+        stdout, stderr = await self._run(['-s', device, 'exec-out', _to_unicode(cmd)], timeout=timeout, raw=True,
+                                         server_request=lambda t: self._aserver.exec_out(device, cmd, t),
+                                         fail_exception=AdbFailException)
+        return self._shell_parse(stdout, stderr)[0]
+
+    @_device_checkor
+    async def shell_iter(self, cmd, device=None, timeout=None, lines=True):
+        '''
+        Async generator version of AdbWrapper.shell_iter, always by adb binary
+        Input: same as AdbWrapper.shell_iter
+        Output: async generator of line(str) / chunk(bytes)
+        '''
+        self.logger.info("shell_iter: target - %s, cmd - %s", device, cmd)
+        p = await self._subprocess_exec(['-s', device, 'shell', _to_unicode(cmd)],
+                                        stdin=asyncio.subprocess.DEVNULL, stdout=PIPE, stderr=PIPE)
+        nodevice_matcher = self._nodevice_matcher()
+
+        async def read_stderr():
+            # Return True as soon as no device found, adb may wait for device forever
+            while 1:
+                chunk = await p.stderr.read(PIPE_READ_SIZE)
+                if not chunk:
+                    return False
+                if nodevice_matcher.feed(chunk):
+                    return True
+        stderr_reader = asyncio.ensure_future(read_stderr())
+        deadline = None if timeout is None else time.time() + timeout
+        decoder = codecs.getincrementaldecoder(OUT_CODING)(OUT_ERROR_HANDLING)
+        pending = u''
+        reader = None
+        try:
+            while 1:
+                remaining = None if deadline is None else max(deadline - time.time(), 0)
+                if reader is None:
+                    reader = asyncio.ensure_future(p.stdout.read(PIPE_READ_SIZE))
+                done, _ = await asyncio.wait([reader] if stderr_reader.done() else [reader, stderr_reader],
+                                             timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+                if stderr_reader.done() and stderr_reader.result():
+                    raise AdbNoDevice
+                if not done:
+                    raise AdbTimeout(TIMEOUT, u'', u'')
+                if not reader.done():
+                    continue
+                chunk, reader = reader.result(), None
+                if not chunk:
+                    break
+                if not lines:
+                    yield chunk
+                    continue
+                parts = (pending + decoder.decode(chunk)).split(u'\n')
+                pending = parts.pop()
+                for line in parts:
+                    yield line.rstrip(u'\r')
+            # stderr may be held by adb server started by this adb, do not wait it forever
+            await asyncio.wait([stderr_reader], timeout=PROCESS_EXIT_CHECK_GAP)
+            if stderr_reader.done() and stderr_reader.result():
+                raise AdbNoDevice
+            pending += decoder.decode(b'', True)
+            if lines and pending:
+                yield pending.rstrip(u'\r')
+        finally:
+            if reader is not None:
+                reader.cancel()
+            stderr_reader.cancel()
+            _process_kill(p)
+
+    @_device_checkor
+    async def install(self, apkfile, forward=False, replace=False, test=False,
+                      sdcard=False, downgrade=False, permission=False,
+                      timeout=FILE_TRANSFORM_TIMEOUT, device=None):
+        self.logger.info("install: target - %s, apk - %s", device, os.path.abspath(apkfile))
+        cmdlist = self._install_cmdlist(apkfile, forward, replace, test, sdcard, downgrade, permission, device)
+        stdout, stderr = await self._run(cmdlist, timeout=timeout)
+        return self._install_parse(stdout, stderr)
+
+    @_device_checkor
+    async def uninstall(self, package, keepdata=False, timeout=FILE_TRANSFORM_TIMEOUT, device=None):
+        self.logger.info("uninstall: target - %s, package - %s", device, package)
+        cmdlist = ['-s', device, 'uninstall'] + (['-k'] if keepdata else []) + [package]
+        stdout, stderr = await self._run(cmdlist, timeout=timeout)
+        return self._uninstall_parse(stdout, stderr)
+
+    async def wait_for_device(self, timeout=None):
+        self.logger.info("wait-for-device")
+        if self._tracked_devices() is not None:
+            # DeviceTracker is thread based, wait it in executor
+            found = await asyncio.get_event_loop().run_in_executor(
+                None, self._tracker.wait_for, lambda devices: u'device' in devices.values(), timeout)
+            if not found:
+                raise AdbTimeout(TIMEOUT, u'', u'')
+            return
+        stdout, stderr = await self._run(['wait-for-device'], timeout=timeout)
+        return self._wait_for_device_parse(stdout, stderr)
+
+    @_device_checkor
+    async def disable_verity(self, device=None):
+        self.logger.info("disable-verity: target - %s", device)
+        stdout, stderr = await self._run(['-s', device, 'disable-verity'])
+        return self._disable_verity_parse(device, stdout, stderr)
+
+    @_device_checkor
+    async def enable_verity(self, device=None):
+        self.logger.info("enable-verity: target - %s", device)
+        stdout, stderr = await self._run(['-s', device, 'enable-verity'])
+        return self._enable_verity_parse(device, stdout, stderr)
+
+    async def _to_file(self, cmdlist, filename):
+        try:
+            filehandler = open(filename, 'ab')
+        except IOError:
+            return False, u'Open {} Error'.format(filename)
+        try:
+            p = await self._subprocess_exec(cmdlist, stdin=asyncio.subprocess.DEVNULL, stdout=filehandler,
+                                            stderr=asyncio.subprocess.DEVNULL)
+        except (OSError, ValueError) as err:
+            filehandler.close()
+            return False, u'{}'.format(err)
+        return True, AsyncAdbLogcat(p, filename, filehandler, self.logger)
+
+    @_device_checkor
+    async def logcat(self, filename, params=None, device=None):
+        '''
+        Output: Result(bool)
+                Reason(str[Result == False]) / AsyncAdbLogcat[Result == True]
+        '''
+        self.logger.info("logcat: target - %s, file - %s", device, filename)
+        return await self._to_file(['-s', device, 'logcat'] + (shlex.split(params) if params else []), filename)
+
+    @_device_checkor
+    async def shell2file(self, filename, cmd, device=None):
+        '''
+        Output: Result(bool)
+                Reason(str[Result == False]) / AsyncAdbLogcat[Result == True]
+        '''
+        self.logger.info("shell2file: target - %s, file - %s", device, filename)
+        return await self._to_file(['-s', device] + shlex.split('shell {}'.format(cmd)), filename)
+
+
+def _auto_method(name):
+    '''
+    Coroutine method which await AdbAuto method of same name by run_auto
+    '''
+    async def method(self, *args, **kwargs):
+        return await self.run_auto(name, *args, **kwargs)
+    method.__name__ = name
+    method.__doc__ = u'Coroutine version of AdbAuto.{}, same input/output'.format(name)
+    return method
+
+
+class AsyncAdbAuto(AsyncAdbWrapper):
+    '''
+    Coroutine version of AdbAuto helpers
+    Helpers are run by one shared AdbAuto (self.auto) in default executor, so connect_auto state cache,
+    getprop snapshot and DeviceProfile are the same as AdbAuto; adb server client and DeviceTracker are shared too
+    Any other AdbAuto method can be awaited by run_auto
+    '''
+
+    def __init__(self, adb_file=None, logger=None, adb_server_port=ADB_SERVER_PORT, use_server_socket=False,
+                 server_pool_size=ADB_SERVER_POOL_SIZE, track_devices=False, **auto_kwargs):
+        '''
+        Input: auto_kwargs, other params of AdbAuto (persistent_shell/device_state_ttl/getprop_ttl)
+        '''
+        super(AsyncAdbAuto, self).__init__(adb_file, logger, adb_server_port, use_server_socket, 0, False)
+        self._auto = AdbAuto(self._binary, self.logger, adb_server_port, use_server_socket, server_pool_size,
+                             track_devices=track_devices, **auto_kwargs)
+        self._server = self._auto.server
+        self._tracker = self._auto.tracker
+
+    @property
+    def auto(self):
+        '''
+        AdbAuto run helpers of this AsyncAdbAuto
+        '''
+        return self._auto
+
+    def track_devices(self):
+        self._tracker = self._auto.track_devices()
+        return self._tracker
+
+    async def run_auto(self, method, *args, **kwargs):
+        '''
+        Await AdbAuto method in default executor
+        e.g. await adb.run_auto('sync_push', 'assets', '/sdcard/assets', device='SN1')
+        Input: method(str), name of AdbAuto method
+               args/kwargs, params of method
+        Output: return of method
+        '''
+        func = functools.partial(getattr(self._auto, method), *args, **kwargs)
+        return await asyncio.get_event_loop().run_in_executor(None, func)
+
+    check_connection = _auto_method('check_connection')
+    connect_auto = _auto_method('connect_auto')
+    disconnect_auto = _auto_method('disconnect_auto')
+    shell_auto = _auto_method('shell_auto')
+    shell_auto_status = _auto_method('shell_auto_status')
+    is_root = _auto_method('is_root')
+    root_auto = _auto_method('root_auto')
+    unroot_auto = _auto_method('unroot_auto')
+    remount_auto = _auto_method('remount_auto')
+    push_auto = _auto_method('push_auto')
+    pull_auto = _auto_method('pull_auto')
+    bugreport_auto = _auto_method('bugreport_auto')
+    reboot_auto = _auto_method('reboot_auto')
+    install_auto = _auto_method('install_auto')
+    uninstall_auto = _auto_method('uninstall_auto')
+    android_getprop = _auto_method('android_getprop')
+    android_sdk_version_get = _auto_method('android_sdk_version_get')
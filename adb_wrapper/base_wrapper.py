@@ -7,8 +7,10 @@ import os
 import re
 import time
 import logging
+import errno
+import codecs
 from io import open
-from threading import Thread, Event
+from threading import Thread, Event, Lock, RLock, Condition, current_thread
 import ctypes
 from functools import wraps
 
@@ -29,6 +31,7 @@ if IS_PY2:
             pass
 
     FILE_TYPES = file
+    selectors = None
 
 else:
     from shutil import which as find_executable
@@ -39,11 +42,17 @@ else:
         from contextlib import ignored
     from io import IOBase
     FILE_TYPES = IOBase
+    import selectors
 
 BINARY_ENC = 'UTF-8'  # Default adb command encode format
 BINARY_ENV = os.environ
 BINARY_ENV['PYTHONIOENCODING'] = BINARY_ENC
 ON_POSIX = 'posix' in sys.builtin_module_names
+# Windows pipes cannot be waited by select, fall back to reader threads there
+SELECTABLE_PIPE = ON_POSIX and selectors is not None
+PIPE_READ_SIZE = 65536  # Max bytes read from subprocess pipe once
+NODEVICE_OVERLAP = 128  # Tail of scanned stderr kept for nodevice pattern across chunk boundary
+PROCESS_EXIT_CHECK_GAP = 0.5  # Pipe may be held by grandchild (adb server), check process exit by this gap
 
 BUGREPORT_TIMEOUT = 300  # Default bugreport timeout
 COMMON_BLOCKING_TIMEOUT = 30  # Default common blocking command timeout
@@ -124,6 +133,188 @@ def _enqueue_output(out, queue, stop_event, logger):
     out.close()
 
 
+def _decode_output(data, logger):
+    '''
+    Decode subprocess output bytes to Unicode with OUT_CODING
+    If decode fail, fall back to BINARY_ENC with OUT_ERROR_HANDLING
+    '''
+    try:
+        _data = data.decode(OUT_CODING)
+    except UnicodeDecodeError:
+        # Sometimes string passthrough wrong data from subprocess, ignore it
+        _data = data.decode(BINARY_ENC, OUT_ERROR_HANDLING)
+        logger.critical("UnicodeDecodeError: %r", data)
+    return _data
+
+
+def _iter_lines(chunks):
+    '''
+    Split bytes chunks to Unicode lines (without line break), decoded incrementally with OUT_CODING
+    Input: chunks(iterable of bytes)
+    Output: generator of line(str)
+    '''
+    decoder = codecs.getincrementaldecoder(OUT_CODING)(OUT_ERROR_HANDLING)
+    pending = u''
+    for chunk in chunks:
+        lines = (pending + decoder.decode(chunk)).split(u'\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line.rstrip(u'\r')
+    pending += decoder.decode(b'', True)
+    if pending:
+        yield pending.rstrip(u'\r')
+
+
+def _read_pipe_chunk(fd):
+    '''
+    Read available data from pipe fd, return b'' once EOF
+    '''
+    while 1:
+        try:
+            return os.read(fd, PIPE_READ_SIZE)
+        except (IOError, OSError) as err:
+            if err.errno == errno.EINTR:
+                continue
+            if err.errno == errno.EAGAIN:
+                return None
+            # Pipe broken, treat as EOF
+            return b''
+
+
+def _enqueue_chunk(fd, queue):
+    '''
+    Continues putting (fd, chunk) from pipe fd to queue, put (fd, b'') at EOF
+    Only used when pipe cannot be selected (Windows)
+    '''
+    while 1:
+        chunk = _read_pipe_chunk(fd)
+        queue.put((fd, chunk))
+        if not chunk:
+            break
+
+
+class IOReactor(object):
+    '''
+    Process-wide reactor, one thread waits all subprocess pipes by selectors
+    Every register fd will be read in reactor thread and pass to callback(chunk)
+    chunk is b'' once EOF, and fd will be unregistered automatically
+    Only work when SELECTABLE_PIPE, use IOReactor.instance() to get it
+    '''
+    _instance = None
+    _instance_lock = Lock()
+
+    def __init__(self):
+        self.logger = logging.getLogger('adb')
+        self._selector = selectors.DefaultSelector()
+        self._requests = []
+        self._requests_lock = Lock()
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ)
+        self._pid = os.getpid()
+        self._thread = Thread(target=self._run, name='adb_wrapper-IOReactor')
+        self._thread.daemon = True
+        self._thread.start()
+
+    @classmethod
+    def instance(cls):
+        '''
+        Get process-wide IOReactor, create it at first time (or after fork)
+        '''
+        with cls._instance_lock:
+            if cls._instance is None or cls._instance._pid != os.getpid():
+                cls._instance = cls()
+            return cls._instance
+
+    def _wakeup(self):
+        with ignored(OSError):
+            os.write(self._wakeup_w, b'\0')
+
+    def _request(self, action, fd, callback=None):
+        done = Event()
+        with self._requests_lock:
+            self._requests.append((action, fd, callback, done))
+        if current_thread() is self._thread:
+            self._apply_requests()
+        else:
+            self._wakeup()
+            done.wait()
+
+    def register(self, fd, callback):
+        '''
+        Input: fd(int) or file object with fileno()
+               callback(function), callback(chunk) run in reactor thread, keep it short
+        Output: None (return after fd is watched by reactor)
+        '''
+        fd = fd if isinstance(fd, int) else fd.fileno()
+        self._request('register', fd, callback)
+
+    def unregister(self, fd):
+        '''
+        Stop watching fd, return after reactor will never read it again
+        After that, caller can close fd safely
+        '''
+        fd = fd if isinstance(fd, int) else fd.fileno()
+        self._request('unregister', fd)
+
+    def _apply_requests(self):
+        with self._requests_lock:
+            requests, self._requests = self._requests, []
+        for action, fd, callback, done in requests:
+            if action == 'register':
+                self._selector.register(fd, selectors.EVENT_READ, callback)
+            else:
+                with ignored(KeyError, ValueError):
+                    self._selector.unregister(fd)
+            done.set()
+
+    def _run(self):
+        while 1:
+            for key, _ in self._selector.select():
+                if key.fd == self._wakeup_r:
+                    _read_pipe_chunk(self._wakeup_r)
+                    continue
+                if key.fd not in self._selector.get_map():
+                    # Unregistered by callback in the same round
+                    continue
+                chunk = _read_pipe_chunk(key.fd)
+                if chunk is None:
+                    continue
+                if not chunk:
+                    self._selector.unregister(key.fd)
+                try:
+                    key.data(chunk)
+                except Exception:
+                    self.logger.exception("IOReactor callback exception: ")
+            self._apply_requests()
+
+
+def watch_pipe(pipe, callback):
+    '''
+    Read pipe in background, call callback(chunk) for every chunk, b'' at EOF
+    POSIX: read by IOReactor / Windows: read by one reader thread
+    Input: pipe(file object)
+           callback(function)
+    Output: unwatch(function), stop reading before close pipe
+    '''
+    fd = pipe.fileno()
+    if SELECTABLE_PIPE:
+        reactor = IOReactor.instance()
+        reactor.register(fd, callback)
+        return lambda: reactor.unregister(fd)
+
+    def reader():
+        while 1:
+            chunk = _read_pipe_chunk(fd)
+            callback(chunk)
+            if not chunk:
+                break
+    reader_t = Thread(target=reader)
+    reader_t.daemon = True
+    reader_t.start()
+    # Reader thread will exit once pipe closed
+    return lambda: None
+
+
 def _device_checkor(func):
     '''
     Check params "device" is valid or not
@@ -161,6 +352,34 @@ def _device_checkor(func):
             return func(*args, **kwargs)
     return wrapper
 
+class NoDeviceMatcher(object):
+    '''
+    Incremental nodevice pattern matcher for one stderr stream
+    All patterns are compiled into one alternation, each chunk is scanned only with
+    a short tail (overlap) of previous data, so cost is constant for every chunk
+    Pattern longer than overlap can not be found across chunk boundary
+    pattern None never match, for wrapper without nodevice_re_list
+    '''
+    def __init__(self, pattern, overlap=NODEVICE_OVERLAP):
+        self.pattern = pattern
+        self.overlap = overlap
+        self._decoder = codecs.getincrementaldecoder(OUT_CODING)(OUT_ERROR_HANDLING)
+        self._tail = u''
+
+    def feed(self, chunk):
+        '''
+        Input: chunk(bytes), new data of stderr
+        Output: True if nodevice pattern found
+        '''
+        if self.pattern is None:
+            return False
+        window = self._tail + self._decoder.decode(bytes(chunk))
+        if self.pattern.search(window):
+            return True
+        self._tail = window[-self.overlap:]
+        return False
+
+
 class BaseWrapperException(Exception):
     pass
 
@@ -379,95 +598,220 @@ class BaseWrapper(object):
         self.logger.info("%s command: %r", self._binaryname, cmdlist2str_forlogging(_cmdlist))
         return _cmdlist
 
-    def _command_blocking(self, cmdlist, timeout=COMMON_BLOCKING_TIMEOUT):
+    def _nodevice_pattern(self):
+        '''
+        Output: compiled alternation of nodevice_re_list, compiled again only if list changed
+                None if nodevice_re_list is empty (empty pattern would match everything)
+        '''
+        key = tuple(self.nodevice_re_list)
+        if getattr(self, '_nodevice_compiled', (None,))[0] != key:
+            pattern = re.compile(u'|'.join(u'(?:{})'.format(p) for p in key)) if key else None
+            self._nodevice_compiled = (key, pattern)
+        return self._nodevice_compiled[1]
+
+    def _nodevice_check(self, stderr_str):
+        '''
+        Check stderr with nodevice_re_list
+        Output: True if no device pattern found
+        '''
+        pattern = self._nodevice_pattern()
+        return pattern is not None and bool(pattern.search(stderr_str))
+
+    def _nodevice_matcher(self):
+        '''
+        Output: NoDeviceMatcher for one stderr stream
+        '''
+        return NoDeviceMatcher(self._nodevice_pattern())
+
+    def _iter_output(self, p, timeout):
+        '''
+        Yield subprocess stdout/stderr chunks as they arrive, until process exit, no busy loop
+        POSIX: pipes are read by process-wide IOReactor thread
+        Windows: pipes are read by reader threads
+        Both put (fd, chunk) into one queue, which is waited with timeout here
+        Input: p(Popen)
+               timeout(int/float/None(infinite))
+        Output: generator of (u'stdout'/u'stderr', chunk(bytes))
+        Raise NoDeviceException once nodevice_re_list found in stderr
+        Raise SubprocessException(TIMEOUT) if process still run after timeout
+        Pipes are unregistered once generator finished or closed
+        '''
+        start_time = time.time()
+        stdout_fd, stderr_fd = p.stdout.fileno(), p.stderr.fileno()
+        names = {stdout_fd: u'stdout', stderr_fd: u'stderr'}
+        nodevice_matcher = self._nodevice_matcher()
+        opening = set((stdout_fd, stderr_fd))
+        queue = Queue()
+
+        def remaining():
+            if timeout is None:
+                return None
+            return max(0, timeout - (time.time() - start_time))
+
+        if SELECTABLE_PIPE:
+            reactor = IOReactor.instance()
+            for fd in opening:
+                reactor.register(fd, lambda chunk, fd=fd: queue.put((fd, chunk)))
+        else:
+            for fd in opening:
+                reader = Thread(target=_enqueue_chunk, args=(fd, queue))
+                reader.daemon = True
+                reader.start()
+        try:
+            while opening:
+                _remaining = remaining()
+                if _remaining == 0:
+                    break
+                wait = PROCESS_EXIT_CHECK_GAP if _remaining is None else min(_remaining, PROCESS_EXIT_CHECK_GAP)
+                try:
+                    fd, chunk = queue.get(timeout=wait)
+                except Empty:
+                    if p.poll() is not None:
+                        # Process exit, but pipe still held by its child
+                        break
+                    continue
+                if not chunk:
+                    opening.discard(fd)
+                    continue
+                self.logger.debug("%s: %r", names[fd], chunk)
+                if fd == stderr_fd and nodevice_matcher.feed(chunk):
+                    raise NoDeviceException
+                yield names[fd], chunk
+        finally:
+            if SELECTABLE_PIPE:
+                for fd in opening:
+                    reactor.unregister(fd)
+        if opening:
+            timeout_flag = p.poll() is None
+        else:
+            # All pipes closed, process should exit soon
+            _remaining = remaining()
+            timeout_flag = False
+            if IS_PY2 or _remaining is None:
+                p.wait()
+            else:
+                try:
+                    p.wait(_remaining)
+                except subprocess.TimeoutExpired:
+                    timeout_flag = True
+        if timeout_flag:
+            raise SubprocessException(TIMEOUT, u'', u'')
+
+    def _wait_output(self, p, timeout):
+        '''
+        Wait subprocess stdout/stderr until process exit
+        Input: p(Popen)
+               timeout(int/float/None(infinite))
+        Output: stdout(bytearray) / stderr(bytearray) / timeout_flag(bool)
+        Output is appended to one buffer for each stream in place, no join copy at end
+        Raise NoDeviceException once nodevice_re_list found in stderr
+        '''
+        buffers = {u'stdout': bytearray(), u'stderr': bytearray()}
+        timeout_flag = False
+        try:
+            for name, chunk in self._iter_output(p, timeout):
+                buffers[name] += chunk
+        except SubprocessException as err:
+            if err.msg != TIMEOUT:
+                raise
+            timeout_flag = True
+        return buffers[u'stdout'], buffers[u'stderr'], timeout_flag
+
+    def _command_iter(self, cmdlist, timeout=None):
+        '''
+        Run command and yield output chunks as they arrive, for long/huge output
+        Input: cmdlist(list)
+               timeout(int/float/None(infinite)), for whole command
+        Output: generator of (u'stdout'/u'stderr', chunk(bytes))
+        Process is killed if timeout/no device, or generator closed before command end
+        '''
+        _cmdlist = self._cmdlist_convert(cmdlist)
+        try:
+            p = subprocess.Popen(_cmdlist, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                 close_fds=ON_POSIX)
+        except (OSError, ValueError) as err:
+            self.logger.error("Run %s command Exception", self._binaryname)
+            self.logger.error("Exception: %r", err)
+            raise SubprocessException(str(err), u'', u"{}".format(err))
+        self.subproc_list.append(p)
+        try:
+            for item in self._iter_output(p, timeout):
+                yield item
+        finally:
+            if p.poll() is None:
+                self.logger.info("%s command not finished, kill it", self._binaryname)
+                with ignored(OSError): p.kill()
+                p.wait()
+            p.stdout.close()
+            p.stderr.close()
+
+    def _command_blocking(self, cmdlist, timeout=COMMON_BLOCKING_TIMEOUT, raw=False, stdin=None):
         '''
         Run command blocking
         Input: cmdlist(list)
                timeout(int/float/None(infinite))
+               raw(bool), True: stdout is not decoded/stripped, returned as memoryview of bytes
+               stdin(function), called as stdin(fileobj) in a writer thread to feed stdin of command,
+                                stdin is closed after it return
         Output: Result(bool) / Reason(str) / stdout(str) / stderr(str)
         If find stderr != '', Result = False, Reason = stderr
         else, Result = True, Reason = stdout
         Exception, Result = False, Reason = Exception
         Only Push/Pull can ignore stderr, others must check when stderr != ''
         '''
-        def stop_queue():
-            stdout_stop.set()
-            stderr_stop.set()
-            with ignored(OSError):
-                p.terminate()
-            stdout_t.join()
-            stderr_t.join()
         _cmdlist = self._cmdlist_convert(cmdlist)
         stdout_str, stderr_str = u'', u''
-        start_time = time.time()
         try:
-            p = subprocess.Popen(_cmdlist, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                                 bufsize=1, close_fds=ON_POSIX)
+            p = subprocess.Popen(_cmdlist, stdin=subprocess.PIPE if stdin else None,
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=ON_POSIX)
         except (OSError, ValueError) as err:
             self.logger.error("Run %s command Exception", self._binaryname)
             self.logger.error("Exception: %r", err)
             self.logger.exception("Stack: ")
             stderr_str = u"{}".format(err)
             raise SubprocessException(str(err), stdout_str, stderr_str)
-        else:
-            self.subproc_list.append(p)
-            _timeout = 999999999 if timeout is None else timeout
-            self.logger.info("%s command timeout: %d", self._binaryname, _timeout)
-            stdout_q = Queue()
-            stdout_stop = Event()
-            stdout_t = Thread(target=_enqueue_output, args=(p.stdout, stdout_q, stdout_stop, self.logger))
-            stdout_t.daemon = True
-            stdout_t.start()
-            stderr_q = Queue()
-            stderr_stop = Event()
-            stderr_t = Thread(target=_enqueue_output, args=(p.stderr, stderr_q, stderr_stop, self.logger))
-            stderr_t.daemon = True
-            stderr_t.start()
-            p.poll()
-            stdout_list = []
-            stderr_list = []
-            while p.returncode is None and time.time() - start_time < _timeout:
-                # Suppose if too much stdout, there will be no stderr output
-                # So check stdout first, once there is no data from stdout, then check stderr
-                with ignored(Empty):
-                    while time.time() - start_time < _timeout:
-                        stdout_tmp = stdout_q.get_nowait()
-                        self.logger.debug("stdout_str: %r", stdout_tmp)
-                        stdout_list.append(stdout_tmp)
-                with ignored(Empty):
-                    while time.time() - start_time < _timeout:
-                        stderr_tmp = stderr_q.get_nowait()
-                        stderr_list.append(stderr_tmp)
-                        self.logger.debug("stderr_str: %r", stderr_tmp)
-                if stderr_list:
-                    stderr_str += ''.join(stderr_list)
-                    stderr_list = []
-                for nodevice_re in self.nodevice_re_list:
-                    if re.search(nodevice_re, stderr_str):
-                        with ignored(OSError): p.kill()
-                        stop_queue()
-                        raise NoDeviceException
-                p.poll()
-            stop_queue()
-            with ignored(Empty):
-                while 1:
-                    stdout_tmp = stdout_q.get_nowait()
-                    stdout_list.append(stdout_tmp)
-                    self.logger.debug("stdout_str: %r", stdout_tmp)
-            stdout_str = u''.join(stdout_list)
-            with ignored(Empty):
-                while 1:
-                    stderr_tmp = stderr_q.get_nowait()
-                    stderr_list.append(stderr_tmp)
-                    self.logger.debug("stderr_str: %r", stderr_str)
-            stderr_str += u''.join(stderr_list)
-            if p.returncode is None:
-                p.poll()
-                with ignored(OSError): p.kill()
-                p.wait()
-                raise SubprocessException(TIMEOUT, stdout_str, stderr_str)
-            if stdout_str == self.stdout_help and stderr_str == self.stderr_help:
-                raise WrongCommandException
+        self.subproc_list.append(p)
+        self.logger.info("%s command timeout: %s", self._binaryname, timeout)
+        writer_errors = []
+        if stdin:
+            def writer():
+                try:
+                    stdin(p.stdin)
+                except Exception as err:
+                    writer_errors.append(err)
+                finally:
+                    with ignored(IOError, OSError, ValueError): p.stdin.close()
+            writer_t = Thread(target=writer)
+            writer_t.daemon = True
+            writer_t.start()
+        try:
+            stdout, stderr, timeout_flag = self._wait_output(p, timeout)
+        except NoDeviceException:
+            with ignored(OSError): p.kill()
+            p.wait()
+            raise
+        finally:
+            p.stdout.close()
+            p.stderr.close()
+            if stdin:
+                if p.poll() is None:
+                    with ignored(OSError): p.kill()
+                writer_t.join()
+        # Broken pipe only means command exit before all input is written, its output tell why
+        for err in writer_errors:
+            if getattr(err, 'errno', None) not in (errno.EPIPE, errno.EINVAL):
+                raise err
+        # stderr is always small, decode it for error check
+        stderr_str = _decode_output(stderr, self.logger)
+        stdout_str = memoryview(stdout) if raw else _decode_output(stdout, self.logger)
+        if timeout_flag:
+            with ignored(OSError): p.kill()
+            p.wait()
+            raise SubprocessException(TIMEOUT, stdout_str, stderr_str)
+        if raw:
+            return stdout_str, stderr_str.strip()
+        if stdout_str == self.stdout_help and stderr_str == self.stderr_help:
+            raise WrongCommandException
         return stdout_str.strip(), stderr_str.strip()
 
     def kill_binary_proc(self):
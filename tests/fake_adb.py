@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+'''
+Fake adb binary for offline tests
+It will be copied as "adb" into a temp folder with current python as interpreter
+'''
+import os
+import sys
+import time
+import subprocess
+
+
+def main(args):
+    if not args:
+        sys.stderr.write("Android Debug Bridge help\n")
+        return 1
+    if args[0] == '-s' and args[2:3] in (['shell'], ['exec-out'], ['exec-in']):
+        if args[1] == 'nodevice':
+            sys.stderr.write("error: device 'nodevice' not found\n")
+            return 1
+        if args[1] == 'waiting':
+            # adb wait device forever
+            sys.stderr.write("- waiting for device -\n")
+            sys.stderr.flush()
+            time.sleep(10)
+            return 1
+        if args[3:]:
+            os.execvp('sh', ['sh', '-c', ' '.join(args[3:])])
+        # Interactive shell without pty, same as adb with shell protocol
+        os.execvp('sh', ['sh'])
+    if args[0] == '-s' and args[2:] == ['features']:
+        # Device 'legacy' has no shell protocol v2
+        sys.stdout.write("cmd\n" if args[1] == 'legacy' else "shell_v2,cmd\n")
+        return 0
+    if args[0] == 'version':
+        sys.stdout.write("Android Debug Bridge version 1.0.32\n")
+    elif args[0] == 'sleep':
+        time.sleep(float(args[1]))
+    elif args[0] == 'nodevice':
+        sys.stderr.write("- waiting for device -\n")
+        sys.stderr.flush()
+        time.sleep(10)
+    elif args[0] == 'daemon':
+        # Child keep stdout/stderr open after adb exit, same as adb server started by adb
+        subprocess.Popen([sys.executable, '-c', 'import time; time.sleep({})'.format(args[1])])
+        sys.stdout.write("daemon started\n")
+    elif args[0] == 'big':
+        sys.stdout.write('x' * int(args[1]))
+        sys.stderr.write('e' * int(args[1]))
+    else:
+        sys.stdout.write(' '.join(args) + '\n')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
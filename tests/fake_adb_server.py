@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+'''
+Fake adb server for offline tests, speak adb server smart socket protocol
+'''
+import os
+import threading
+import subprocess
+import select
+import struct
+import stat
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+
+class FakeAdbHandler(socketserver.BaseRequestHandler):
+
+    def read_exactly(self, size):
+        data = b''
+        while len(data) < size:
+            chunk = self.request.recv(size - len(data))
+            if not chunk:
+                raise EOFError
+            data += chunk
+        return data
+
+    def read_request(self):
+        length = int(self.read_exactly(4), 16)
+        return self.read_exactly(length).decode('UTF-8')
+
+    def okay(self, payload=None):
+        self.request.sendall(b'OKAY')
+        if payload is not None:
+            self.send_hex(payload)
+
+    def fail(self, reason):
+        self.request.sendall(b'FAIL')
+        self.send_hex(reason)
+
+    def send_hex(self, payload):
+        payload = payload.encode('UTF-8') if not isinstance(payload, bytes) else payload
+        self.request.sendall('{:04x}'.format(len(payload)).encode('ascii') + payload)
+
+    def handle(self):
+        server = self.server
+        try:
+            request = self.read_request()
+            server.requests.append(request)
+            if request == 'host:version':
+                self.okay('{:04x}'.format(server.version))
+            elif request == 'host:devices':
+                self.okay(self.devices_text())
+            elif request == 'host:track-devices':
+                self.okay()
+                self.track_devices()
+            elif request.startswith('host-serial:') and request.endswith(':features'):
+                self.okay(server.features)
+            elif request.startswith('host:connect:'):
+                address = request[len('host:connect:'):]
+                server.devices[address] = 'device'
+                self.okay('connected to {}'.format(address))
+            elif request.startswith('host:disconnect:'):
+                address = request[len('host:disconnect:'):]
+                if server.devices.pop(address, None):
+                    self.okay('disconnected {}'.format(address))
+                else:
+                    self.okay('no such device \'{}\''.format(address))
+            elif request.startswith('host:transport:'):
+                serial = request[len('host:transport:'):]
+                if serial not in server.devices:
+                    self.fail('device \'{}\' not found'.format(serial))
+                    return
+                self.okay()
+                self.handle_device(serial, self.read_request())
+            else:
+                self.fail('unknown host service')
+        except EOFError:
+            pass
+
+    def devices_text(self):
+        return ''.join('{}\t{}\n'.format(serial, state) for serial, state in sorted(self.server.devices.items()))
+
+    def track_devices(self):
+        # Push device list once, then every time it changes, until client or server close
+        last = None
+        while not self.server.stopping:
+            text = self.devices_text()
+            if text != last:
+                self.send_hex(text)
+                last = text
+            readable, _, _ = select.select([self.request], [], [], 0.02)
+            if readable and not self.request.recv(1):
+                return
+
+    def handle_device(self, serial, service):
+        server = self.server
+        server.requests.append(service)
+        if service.startswith('shell,v2,raw:'):
+            # Run by local sh, feed stdin packets until close stdin, reply stdout/stderr/exit packets
+            self.okay()
+            p = subprocess.Popen(['sh', '-c', service[len('shell,v2,raw:'):]],
+                                 stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            feeder = threading.Thread(target=self.feed_stdin, args=(p.stdin,))
+            feeder.daemon = True
+            feeder.start()
+            # Output packets are sent as output arrive, same as adbd
+            lock = threading.Lock()
+            reader = threading.Thread(target=self.send_output, args=(p.stderr, 2, lock))
+            reader.start()
+            self.send_output(p.stdout, 1, lock)
+            reader.join()
+            p.wait()
+            self.request.sendall(struct.pack('<BI', 3, 1) + bytes(bytearray([p.returncode])))
+        elif service.startswith('exec:'):
+            # Raw output, stderr is mixed into stdout same as adbd
+            self.okay()
+            p = subprocess.Popen(['sh', '-c', service[len('exec:'):]],
+                                 stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            for chunk in iter(lambda: p.stdout.read(65536), b''):
+                self.request.sendall(chunk)
+            p.wait()
+        elif service.startswith('shell:'):
+            # Run by local sh, stdout/stderr are mixed and newline is \r\n like pty
+            self.okay()
+            p = subprocess.Popen(['sh', '-c', service[len('shell:'):]],
+                                 stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            self.request.sendall(p.communicate()[0].replace(b'\n', b'\r\n'))
+        elif service == 'root:':
+            self.okay()
+            self.request.sendall(b'restarting adbd as root\n')
+        elif service.startswith('reboot:'):
+            self.okay()
+        elif service == 'sync:':
+            self.okay()
+            self.handle_sync()
+        else:
+            self.fail('unknown device service')
+
+    def send_output(self, stream, packet_id, lock):
+        for chunk in iter(lambda: os.read(stream.fileno(), 65536), b''):
+            with lock:
+                self.request.sendall(struct.pack('<BI', packet_id, len(chunk)) + chunk)
+
+    def feed_stdin(self, stdin):
+        try:
+            while 1:
+                packet_id, length = struct.unpack('<BI', self.read_exactly(5))
+                payload = self.read_exactly(length)
+                if packet_id == 0:
+                    stdin.write(payload)
+                elif packet_id == 4:
+                    break
+        except (EOFError, IOError, OSError):
+            pass
+        finally:
+            try:
+                stdin.close()
+            except (IOError, OSError):
+                pass
+
+    def sync_header(self):
+        header = self.read_exactly(8)
+        return header[:4], struct.unpack('<I', header[4:])[0]
+
+    def sync_fail(self, reason):
+        self.request.sendall(b'FAIL' + struct.pack('<I', len(reason)) + reason)
+
+    def handle_sync(self):
+        files = self.server.files
+        while 1:
+            sync_id, length = self.sync_header()
+            if sync_id == b'QUIT':
+                return
+            path = self.read_exactly(length).decode('UTF-8')
+            if self.server.sync_local:
+                self.handle_sync_local(sync_id, path)
+            elif sync_id == b'STAT':
+                if path in files:
+                    mode, size = stat.S_IFREG | 0o644, len(files[path])
+                elif self.server.isdir(path):
+                    mode, size = stat.S_IFDIR | 0o755, 4096
+                else:
+                    mode, size = 0, 0
+                self.request.sendall(b'STAT' + struct.pack('<III', mode, size, 1000))
+            elif sync_id == b'LIST':
+                for name, mode, size in self.server.listdir(path):
+                    name = name.encode('UTF-8')
+                    self.request.sendall(b'DENT' + struct.pack('<IIII', mode, size, 1000, len(name)) + name)
+                self.request.sendall(b'DONE' + struct.pack('<IIII', 0, 0, 0, 0))
+            elif sync_id == b'SEND':
+                path = path.rsplit(',', 1)[0]
+                data = b''
+                while 1:
+                    sync_id, length = self.sync_header()
+                    if sync_id == b'DONE':
+                        break
+                    data += self.read_exactly(length)
+                if path.startswith('/system/'):
+                    self.sync_fail(b'couldn\'t create file: Read-only file system')
+                else:
+                    files[path] = data
+                    self.request.sendall(b'OKAY' + struct.pack('<I', 0))
+            elif sync_id == b'RECV':
+                if path not in files:
+                    self.sync_fail(b'No such file or directory')
+                    continue
+                data = files[path]
+                for offset in range(0, len(data), 65536):
+                    chunk = data[offset:offset + 65536]
+                    self.request.sendall(b'DATA' + struct.pack('<I', len(chunk)) + chunk)
+                self.request.sendall(b'DONE' + struct.pack('<I', 0))
+
+    def handle_sync_local(self, sync_id, path):
+        # Same as handle_sync, but remote path is local file, to work with shell: services
+        if sync_id == b'STAT':
+            try:
+                st = os.lstat(path)
+                reply = (st.st_mode, st.st_size, int(st.st_mtime))
+            except OSError:
+                reply = (0, 0, 0)
+            self.request.sendall(b'STAT' + struct.pack('<III', *reply))
+        elif sync_id == b'LIST':
+            for name in sorted(os.listdir(path)) if os.path.isdir(path) else []:
+                st = os.lstat(os.path.join(path, name))
+                name = name.encode('UTF-8')
+                self.request.sendall(b'DENT' + struct.pack('<IIII', st.st_mode, st.st_size, int(st.st_mtime),
+                                                           len(name)) + name)
+            self.request.sendall(b'DONE' + struct.pack('<IIII', 0, 0, 0, 0))
+        elif sync_id == b'SEND':
+            path, mode = path.rsplit(',', 1)
+            data = b''
+            while 1:
+                sync_id, length = self.sync_header()
+                if sync_id == b'DONE':
+                    break
+                data += self.read_exactly(length)
+            try:
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                with open(path, 'wb') as f:
+                    f.write(data)
+                os.chmod(path, int(mode) & 0o777)
+                os.utime(path, (length, length))
+            except (IOError, OSError) as err:
+                self.sync_fail(str(err).encode('UTF-8'))
+                return
+            self.request.sendall(b'OKAY' + struct.pack('<I', 0))
+        elif sync_id == b'RECV':
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+            except (IOError, OSError):
+                self.sync_fail(b'No such file or directory')
+                return
+            for offset in range(0, len(data), 65536):
+                chunk = data[offset:offset + 65536]
+                self.request.sendall(b'DATA' + struct.pack('<I', len(chunk)) + chunk)
+            self.request.sendall(b'DONE' + struct.pack('<I', 0))
+
+
+class FakeAdbServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, handler=FakeAdbHandler):
+        socketserver.TCPServer.__init__(self, ('127.0.0.1', 0), handler)
+        self.version = 41
+        self.stopping = False
+        self.features = 'shell_v2,cmd'
+        self.devices = {}
+        self.requests = []
+        self.files = {}  # remote path: content(bytes), folders of files are implicit
+        self.sync_local = False  # True: sync: service use local files same as shell:, instead of files
+        self.folders = set(['/', '/sdcard'])  # Empty remote folders
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+
+    def isdir(self, path):
+        prefix = path.rstrip('/') + '/'
+        return path in self.folders or any(name.startswith(prefix) for name in self.files)
+
+    def listdir(self, path):
+        prefix = path.rstrip('/') + '/'
+        entries = {}
+        for name, data in self.files.items():
+            if not name.startswith(prefix):
+                continue
+            rest = name[len(prefix):]
+            if '/' in rest:
+                entries[rest.split('/')[0]] = (stat.S_IFDIR | 0o755, 4096)
+            else:
+                entries[rest] = (stat.S_IFREG | 0o644, len(data))
+        return [(name, mode, size) for name, (mode, size) in sorted(entries.items())]
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopping = True
+        self.shutdown()
+        self.server_close()
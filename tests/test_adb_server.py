@@ -0,0 +1,655 @@
+# -*- coding: utf-8 -*-
+import unittest
+import sys
+import io
+import os
+import shutil
+import tempfile
+import time
+import json
+
+sys.path.insert(1, os.path.abspath(os.path.join(os.path.dirname(__file__), '../')))
+from adb_wrapper.adb_wrapper import AdbWrapper
+from adb_wrapper.adb_auto import AdbAuto
+from adb_wrapper.adb_fleet import push_many, run_all
+from adb_wrapper.adb_sync import SYNC_DATA_MAX, SYNC_LINK_DEPTH
+from adb_wrapper.adb_wrapper import AdbNoDevice, AdbFailException
+from adb_wrapper.adb_wrapper import READONLY, NOFILEORFOLDER
+from adb_wrapper.adb_server import AdbServerClient, AdbServerFail, AdbServerUnavailable
+from adb_wrapper.adb_server import DeviceTracker
+from tests.fake_adb_server import FakeAdbServer
+from tests.test_base import fake_adb_create, quiet_logger
+
+SERIAL = u'emulator-5554'
+
+
+class AdbServerClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeAdbServer().start()
+        self.server.devices[SERIAL] = 'device'
+        self.client = AdbServerClient(port=self.server.port, logger=quiet_logger())
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_version(self):
+        self.assertEqual(self.client.version(), 41)
+
+    def test_devices(self):
+        self.assertEqual(self.client.devices(), u'{}\tdevice\n'.format(SERIAL))
+
+    def test_shell(self):
+        self.assertEqual(self.client.shell(SERIAL, u'echo 中文'), u'中文\r\n'.encode('UTF-8'))
+        self.assertEqual(self.server.requests[-2:], ['host:transport:{}'.format(SERIAL), u'shell:echo 中文'])
+
+    def test_shell_v2(self):
+        self.assertTrue(self.client.has_feature(SERIAL, u'shell_v2'))
+        self.assertEqual(self.client.shell_v2(SERIAL, u'echo out; echo err >&2; exit 3'),
+                         (b'out\n', b'err\n', 3))
+        # Output more than socket buffers while stdin is still sent
+        data = os.urandom(1024 * 1024) * 16
+        self.assertEqual(self.client.shell_v2(SERIAL, u'cat', timeout=10, stdin=lambda f: f.write(data)),
+                         (data, b'', 0))
+
+    def test_nodevice(self):
+        with self.assertRaises(AdbServerFail) as cm:
+            self.client.shell(u'no_such_device', u'id')
+        self.assertTrue(u'not found' in cm.exception.msg)
+
+    def test_pool(self):
+        client = AdbServerClient(port=self.server.port, logger=quiet_logger(), pool_size=2)
+        self.assertEqual(client.shell(SERIAL, u'echo 1'), b'1\r\n')
+        # Warm sockets wait in pool, one request per shell after that
+        for _ in range(50):
+            if len(client.pool._idle[SERIAL]) == 2:
+                break
+            time.sleep(0.05)
+        self.assertEqual(len(client.pool._idle[SERIAL]), 2)
+        # Stop refill, then only the shell request reach server
+        client.pool.size = 0
+        request_num = len(self.server.requests)
+        self.assertEqual(client.shell(SERIAL, u'echo 2'), b'2\r\n')
+        self.assertEqual(self.server.requests[request_num:], [u'shell:echo 2'])
+        # Device drop, pooled sockets are evicted
+        del self.server.devices[SERIAL]
+        with self.assertRaises(AdbServerFail):
+            client.new_transport(SERIAL)
+        self.assertFalse(client.pool._idle.get(SERIAL))
+        client.pool.close()
+
+    def test_pool_idle(self):
+        client = AdbServerClient(port=self.server.port, logger=quiet_logger(), pool_size=1)
+        client.pool.idle_timeout = 0.3
+        self.assertEqual(client.shell(SERIAL, u'echo 1'), b'1\r\n')
+        # Device not acquired any more, warmer close its sockets and forget it
+        for _ in range(50):
+            if SERIAL not in client.pool._acquired:
+                break
+            time.sleep(0.05)
+        self.assertFalse(SERIAL in client.pool._acquired)
+        self.assertFalse(SERIAL in client.pool._idle)
+        # Device leave tracker, its pooled sockets are evicted
+        self.assertEqual(client.shell(SERIAL, u'echo 2'), b'2\r\n')
+        client.pool.idle_timeout = 60
+        tracker = DeviceTracker(client, retry_gap=0.1).start()
+        self.assertTrue(tracker.wait_for_state(SERIAL, u'device', timeout=5))
+        self.server.devices[SERIAL] = 'offline'
+        self.assertTrue(tracker.wait_for_state(SERIAL, u'offline', timeout=5))
+        self.assertFalse(SERIAL in client.pool._acquired)
+        self.assertFalse(SERIAL in client.pool._idle)
+        tracker.stop()
+        client.pool.close()
+
+    def test_tracker(self):
+        changes = []
+        tracker = DeviceTracker(self.client, retry_gap=0.1)
+        tracker.add_callback(lambda *change: changes.append(change))
+        tracker.start()
+        self.assertTrue(tracker.wait_for_state(SERIAL, u'device', timeout=5))
+        self.server.devices[u'10.0.0.2:5555'] = 'offline'
+        self.assertTrue(tracker.wait_for_state(u'10.0.0.2:5555', u'offline', timeout=5))
+        self.server.devices[u'10.0.0.2:5555'] = 'device'
+        self.assertTrue(tracker.wait_for_state(u'10.0.0.2:5555', u'device', timeout=5))
+        del self.server.devices[u'10.0.0.2:5555']
+        self.assertTrue(tracker.wait_for_state(u'10.0.0.2:5555', None, timeout=5))
+        self.assertEqual(changes, [(SERIAL, None, u'device'),
+                                   (u'10.0.0.2:5555', None, u'offline'),
+                                   (u'10.0.0.2:5555', u'offline', u'device'),
+                                   (u'10.0.0.2:5555', u'device', None)])
+        self.assertFalse(tracker.wait_for_state(SERIAL, u'offline', timeout=0.2))
+        self.assertEqual(tracker.devices(), {SERIAL: u'device'})
+        tracker.stop()
+        self.assertFalse(tracker.ready)
+
+    def test_unavailable(self):
+        self.server.stop()
+        with self.assertRaises(AdbServerUnavailable):
+            self.client.version()
+        self.server = FakeAdbServer().start()
+
+
+@unittest.skipIf(sys.platform == 'win32', 'fake adb need POSIX shebang')
+class AdbWrapperServerTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.folder = tempfile.mkdtemp()
+        cls.adb_file = fake_adb_create(cls.folder)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.folder)
+
+    def setUp(self):
+        self.server = FakeAdbServer().start()
+        self.server.devices[SERIAL] = 'device'
+        self.adb = AdbWrapper(adb_file=self.adb_file, logger=quiet_logger(),
+                              adb_server_port=self.server.port, use_server_socket=True)
+
+    def tearDown(self):
+        del self.adb
+        self.server.stop()
+
+    def test_devices(self):
+        self.assertEqual(self.adb.devices(), {SERIAL: u'device'})
+
+    def test_connect(self):
+        self.assertEqual(self.adb.connect(u'10.0.0.2:5555'), u'10.0.0.2:5555')
+        self.adb.disconnect(u'10.0.0.2:5555')
+        self.assertEqual(self.adb.devices(), {SERIAL: u'device'})
+
+    def test_shell(self):
+        stdout, stderr = self.adb.shell(u'echo a b', device=SERIAL)
+        self.assertEqual(stdout, u'a b')
+        self.assertEqual(stderr, u'')
+
+    def test_shell_status(self):
+        self.assertEqual(self.adb.shell_status(u'echo out; echo err >&2; false', device=SERIAL),
+                         (u'out', u'err', 1))
+        self.assertTrue(u'shell,v2,raw:echo out; echo err >&2; false' in self.server.requests)
+        # Device without shell_v2, exit code from adb binary output
+        self.server.features = 'cmd'
+        self.adb.server.evict(SERIAL)
+        self.assertEqual(self.adb.shell_status(u'echo out; false', device=SERIAL), (u'out', u'', 1))
+
+    def test_shell_batch(self):
+        cmds = [u'echo a', u'echo e >&2; false']
+        expect = [(u'a', u'', 0), (u'', u'e', 1)]
+        self.assertEqual(self.adb.shell_batch(cmds, device=SERIAL), expect)
+        # Without shell_v2, stdout/stderr are mixed
+        self.server.features = 'cmd'
+        self.adb.server.evict(SERIAL)
+        self.assertEqual(self.adb.shell_batch(cmds, device=SERIAL), [(u'a', u'', 0), (u'e', u'', 1)])
+        # adb binary shell by pty, line end \r\n is not kept inside output
+        self.assertEqual(self.adb._batch_parse(u't', 2, u'a\r\nb\r\nt:0:0\r\nt:1\r\ne\r\nt:1:1\r\n', u''),
+                         [(u'a\nb', u'', 0), (u'e', u'', 1)])
+
+    def test_shell_iter(self):
+        lines = self.adb.shell_iter(u'seq 1 100000', device=SERIAL)
+        self.assertEqual([next(lines) for _ in range(3)], [u'1', u'2', u'3'])
+        lines.close()
+        with self.assertRaises(AdbNoDevice):
+            list(self.adb.shell_iter(u'id', device=u'no_such_device'))
+
+    def test_shell_nodevice(self):
+        with self.assertRaises(AdbNoDevice):
+            self.adb.shell(u'id', device=u'no_such_device')
+
+    def test_root_reboot(self):
+        self.adb.root(SERIAL)
+        self.adb.reboot(device=SERIAL)
+        self.assertTrue(u'reboot:' in self.server.requests)
+
+    def test_push_pull_file(self):
+        local_file = os.path.join(self.folder, u'push_file')
+        with open(local_file, 'wb') as f:
+            f.write(b'x' * 200000)
+        result = self.adb.push(local_file, u'/sdcard', device=SERIAL)
+        self.assertEqual(result, [u'/sdcard/push_file'])
+        self.assertEqual(result.total_bytes, 200000)
+        self.assertEqual(self.server.files[u'/sdcard/push_file'], b'x' * 200000)
+        pull_folder = tempfile.mkdtemp(dir=self.folder)
+        result = self.adb.pull(u'/sdcard/push_file', pull_folder, device=SERIAL)
+        self.assertEqual(result, [os.path.join(pull_folder, u'push_file')])
+        self.assertEqual(result.files[0].size, 200000)
+        with open(result[0], 'rb') as f:
+            self.assertEqual(f.read(), b'x' * 200000)
+
+    def test_push_pull_folder(self):
+        local_folder = tempfile.mkdtemp(dir=self.folder)
+        os.makedirs(os.path.join(local_folder, u'sub'))
+        for name in (u'a', os.path.join(u'sub', u'b')):
+            with open(os.path.join(local_folder, name), 'wb') as f:
+                f.write(name.encode('UTF-8'))
+        result = self.adb.push(local_folder, u'/sdcard/new', device=SERIAL)
+        self.assertEqual(sorted(result), [u'/sdcard/new/a', u'/sdcard/new/sub/b'])
+        pull_folder = os.path.join(self.folder, u'pulled')
+        result = self.adb.pull(u'/sdcard/new', pull_folder, device=SERIAL)
+        self.assertEqual(sorted(result), [os.path.join(pull_folder, u'a'),
+                                          os.path.join(pull_folder, u'sub', u'b')])
+
+    def test_push_pull_streams(self):
+        local_folder = tempfile.mkdtemp(dir=self.folder)
+        os.makedirs(os.path.join(local_folder, u'sub'))
+        names = [u'big'] + [os.path.join(u'sub', u'{}'.format(num)) for num in range(10)]
+        for name in names:
+            with open(os.path.join(local_folder, name), 'wb') as f:
+                f.write(b'x' * (300000 if name == u'big' else 100))
+        sync_count = self.server.requests.count(u'sync:')
+        result = self.adb.push(local_folder, u'/sdcard/streams', device=SERIAL, streams=3)
+        self.assertEqual(self.server.requests.count(u'sync:') - sync_count, 3)
+        self.assertEqual(sorted(result), sorted(u'/sdcard/streams/' + name.replace(os.sep, u'/') for name in names))
+        self.assertEqual(result.total_bytes, 301000)
+        self.assertEqual(self.server.files[u'/sdcard/streams/big'], b'x' * 300000)
+        pull_folder = os.path.join(self.folder, u'pulled_streams')
+        result = self.adb.pull(u'/sdcard/streams', pull_folder, device=SERIAL, streams=3)
+        serial_result = self.adb.pull(u'/sdcard/streams', pull_folder + u'_serial', device=SERIAL)
+        self.assertEqual([path[len(pull_folder):] for path in result],
+                         [path[len(pull_folder + u'_serial'):] for path in serial_result])
+        self.assertEqual(os.path.getsize(os.path.join(pull_folder, u'big')), 300000)
+
+    def test_tar(self):
+        local = tempfile.mkdtemp(dir=self.folder)
+        os.makedirs(os.path.join(local, u'sub'))
+        for name in [u'{}'.format(num) for num in range(50)] + [u'sub/x']:
+            with open(os.path.join(local, name), 'wb') as f:
+                f.write(b'x' * 5000)
+        remote = os.path.join(self.folder, u'remote_tar')
+        files = self.adb.push_tar(local, remote, device=SERIAL, compress=True)
+        self.assertEqual(len(files), 51)
+        self.assertTrue(any(request.startswith(u'shell,v2,raw:mkdir') for request in self.server.requests))
+        name = os.path.basename(local)
+        self.assertEqual(os.path.getsize(os.path.join(remote, name, u'sub', u'x')), 5000)
+        pulled = tempfile.mkdtemp(dir=self.folder)
+        files = self.adb.pull_tar(os.path.join(remote, name), pulled, device=SERIAL)
+        expected = [os.path.join(pulled, name, u'{}'.format(num)) for num in range(50)]
+        self.assertEqual(sorted(files), sorted(expected + [os.path.join(pulled, name, u'sub', u'x')]))
+        with self.assertRaises(AdbFailException) as cm:
+            self.adb.push_tar(local, u'/proc/no_such/dir', device=SERIAL)
+        self.assertEqual(cm.exception.msg, NOFILEORFOLDER)
+        # adb binary, device support shell_v2 by adb features: adb shell with exit code, no server socket used
+        adb = AdbWrapper(adb_file=self.adb_file, logger=quiet_logger(), adb_server_port=self.server.port)
+        del self.server.requests[:]
+        self.assertEqual(len(adb.push_tar(local, remote + u'_binary', device=SERIAL)), 51)
+        with self.assertRaises(AdbFailException) as cm:
+            adb.push_tar(local, u'/proc/no_such/dir', device=SERIAL)
+        self.assertEqual(cm.exception.msg, NOFILEORFOLDER)
+        self.assertEqual(self.server.requests, [])
+        # Legacy device fed by adb exec-in, error of command is not known
+        self.assertEqual(len(adb.push_tar(local, remote + u'_legacy', device=u'legacy')), 51)
+        self.assertEqual(os.path.getsize(os.path.join(remote + u'_legacy', name, u'sub', u'x')), 5000)
+
+    @unittest.skipIf(sys.platform == 'win32', 'symlink need POSIX')
+    def test_pull_symlink(self):
+        self.server.sync_local = True
+        remote = tempfile.mkdtemp(dir=self.folder)
+        os.makedirs(os.path.join(remote, u'real'))
+        with open(os.path.join(remote, u'real', u'a'), 'wb') as f:
+            f.write(b'aaa')
+        os.symlink(os.path.join(remote, u'real'), os.path.join(remote, u'dir_link'))
+        os.symlink(os.path.join(remote, u'real', u'a'), os.path.join(remote, u'file_link'))
+        os.symlink(os.path.join(remote, u'real'), os.path.join(remote, u'real', u'loop'))
+        local = tempfile.mkdtemp(dir=self.folder)
+        result = self.adb.pull(remote, local, device=SERIAL)
+        pulled = os.path.join(local, os.path.basename(remote))
+        for name in (u'real/a', u'dir_link/a', u'file_link'):
+            with open(os.path.join(pulled, name), 'rb') as f:
+                self.assertEqual(f.read(), b'aaa')
+        # Symlink loop stop after SYNC_LINK_DEPTH links: real/(loop/)*a, dir_link/(loop/)*a, file_link
+        self.assertEqual(len(result), 2 + SYNC_LINK_DEPTH * 2)
+
+    def test_push_pull_stream(self):
+        data = os.urandom(300000)
+        self.assertEqual(self.adb.push_bytes(data, u'/sdcard/stream/blob', device=SERIAL), 300000)
+        self.assertEqual(self.server.files[u'/sdcard/stream/blob'], data)
+        self.assertEqual(self.adb.pull_bytes(u'/sdcard/stream/blob', device=SERIAL), data)
+
+        class ReadOnly(object):
+            # File object without readinto
+            def __init__(self, data):
+                self.stream = io.BytesIO(data)
+
+            def read(self, size=-1):
+                return self.stream.read(size)
+        self.assertEqual(self.adb.push_stream(ReadOnly(b'abc'), u'/sdcard/stream/abc', device=SERIAL), 3)
+        out = io.BytesIO()
+        self.assertEqual(self.adb.pull_stream(u'/sdcard/stream/abc', out, device=SERIAL), 3)
+        self.assertEqual(out.getvalue(), b'abc')
+        with self.assertRaises(AdbFailException) as cm:
+            self.adb.pull_bytes(u'/sdcard/stream/missing', device=SERIAL)
+        self.assertEqual(cm.exception.msg, NOFILEORFOLDER)
+
+    def test_push_many(self):
+        devices = [SERIAL] + [u'emulator-{}'.format(port) for port in (5556, 5558, 5560)]
+        for device in devices:
+            self.server.devices[device] = 'device'
+        data = os.urandom(SYNC_DATA_MAX * 10 + 1)
+
+        class Source(io.BytesIO):
+            # Count bytes read from source
+            read_size = 0
+
+            def read(self, size=-1):
+                block = io.BytesIO.read(self, size)
+                self.read_size += len(block)
+                return block
+        src = Source(data)
+        results = push_many(src, u'/sdcard/many/blob', devices + [u'no_such_device'], adb=self.adb,
+                            window=2, logger=quiet_logger())
+        self.assertEqual(src.read_size, len(data))
+        self.assertEqual(list(results.succeeded.values()), [len(data)] * len(devices))
+        self.assertEqual(list(results.failed), [u'no_such_device'])
+        self.assertEqual(self.server.files[u'/sdcard/many/blob'], data)
+        self.assertEqual(len([req for req in self.server.requests if req == u'sync:']), len(devices))
+        # Bounded workers: pushed in rounds, source read once for each round
+        src = Source(data)
+        results = push_many(src, u'/sdcard/many/blob2', devices + [u'no_such_device'], adb=self.adb,
+                            window=2, max_workers=2, logger=quiet_logger())
+        # Round of no_such_device only stop reading once it fail
+        self.assertTrue(len(data) * 2 < src.read_size < len(data) * 3)
+        self.assertEqual(list(results), devices + [u'no_such_device'])
+        self.assertEqual(list(results.succeeded.values()), [len(data)] * len(devices))
+        self.assertEqual(self.server.files[u'/sdcard/many/blob2'], data)
+
+    def test_sync_fail(self):
+        local_file = os.path.join(self.folder, u'push_file')
+        with open(local_file, 'wb') as f:
+            f.write(b'x')
+        with self.assertRaises(AdbFailException) as cm:
+            self.adb.push(local_file, u'/system/push_file', device=SERIAL)
+        self.assertEqual(cm.exception.msg, READONLY)
+        with self.assertRaises(AdbFailException) as cm:
+            self.adb.pull(u'/sdcard/no_such_file', self.folder, device=SERIAL)
+        self.assertEqual(cm.exception.msg, NOFILEORFOLDER)
+
+    def test_track_devices(self):
+        adb = AdbAuto(adb_file=self.adb_file, logger=quiet_logger(), adb_server_port=self.server.port,
+                      use_server_socket=True, server_pool_size=0, track_devices=True)
+        self.assertTrue(adb.tracker.wait_for_state(SERIAL, u'device', timeout=5))
+        self.assertEqual(adb.devices(), {SERIAL: u'device'})
+        adb.wait_for_device(timeout=1)
+        self.assertEqual(adb.connect_auto(SERIAL), SERIAL)
+        # No host:devices / shell exit at all
+        self.assertFalse(u'host:devices' in self.server.requests)
+        self.assertFalse(u'shell:exit' in self.server.requests)
+        # Device leave "device" state, connect_auto cache dropped
+        self.server.devices[SERIAL] = 'offline'
+        self.assertTrue(adb.tracker.wait_for_state(SERIAL, u'offline', timeout=5))
+        self.assertEqual(adb._device_state_get(SERIAL), None)
+        adb.track_devices_stop()
+
+
+class AdbAutoTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.folder = tempfile.mkdtemp()
+        cls.adb_file = fake_adb_create(cls.folder)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.folder)
+
+    def setUp(self):
+        self.server = FakeAdbServer().start()
+        self.server.devices[SERIAL] = 'device'
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_device_state_cache(self):
+        adb = AdbAuto(adb_file=self.adb_file, logger=quiet_logger(),
+                      adb_server_port=self.server.port, use_server_socket=True, server_pool_size=0)
+        self.assertEqual(adb.shell_auto(u'echo 1', device=SERIAL), (u'1', u''))
+        self.assertEqual(adb.shell_auto(u'echo 2', device=SERIAL), (u'2', u''))
+        self.assertEqual(self.server.requests.count(u'host:devices'), 1)
+        # Stale cache, device gone: full connect_auto again
+        del self.server.devices[SERIAL]
+        self.assertEqual(adb.shell_auto(u'echo 3', device=SERIAL), (u'3', u''))
+        self.assertTrue(u'host:connect:{}'.format(SERIAL) in self.server.requests)
+        # Reboot drop cache
+        adb.device_state_ttl = 0.2
+        adb.reboot(device=SERIAL)
+        adb.shell_auto(u'echo 4', device=SERIAL)
+        self.assertEqual(self.server.requests.count(u'host:devices'), 3)
+        # Expired
+        time.sleep(0.3)
+        adb.shell_auto(u'echo 5', device=SERIAL)
+        self.assertEqual(self.server.requests.count(u'host:devices'), 4)
+
+    def test_getprop_cache(self):
+        # getprop on PATH of fake adb server shell
+        with open(os.path.join(self.folder, u'getprop'), 'w') as f:
+            f.write(u'#!/bin/sh\n[ "$1" = sys.boot_completed ] && echo 0 && exit\n'
+                    u'printf "[ro.build.version.sdk]: [28]\\n[sys.boot_completed]: [1]\\n[multi.line]: [a\\nb]\\n"\n')
+        os.chmod(os.path.join(self.folder, u'getprop'), 0o755)
+        path = os.environ['PATH']
+        os.environ['PATH'] = self.folder + os.pathsep + path
+        try:
+            adb = AdbAuto(adb_file=self.adb_file, logger=quiet_logger(), adb_server_port=self.server.port,
+                          use_server_socket=True, server_pool_size=0, getprop_ttl=0.2)
+            self.assertEqual(adb.android_sdk_version_get(device=SERIAL), 28)
+            self.assertEqual(adb.android_getprop(u'sys.boot_completed', device=SERIAL), u'1')
+            self.assertEqual(adb.android_getprop(u'multi.line', device=SERIAL), u'a\nb')
+            self.assertEqual(adb.android_getprop(u'no.such.key', device=SERIAL), u'')
+            shells = [request for request in self.server.requests if request.startswith(u'shell:')]
+            self.assertEqual(shells, [u'shell:exit', u'shell:cat /proc/sys/kernel/random/boot_id; getprop'])
+            # After ttl, ro.* only check boot_id, mutable key is fetched alone
+            time.sleep(0.3)
+            self.assertEqual(adb.android_getprop(u'ro.build.version.sdk', device=SERIAL), u'28')
+            self.assertEqual(self.server.requests[-1], u'shell:cat /proc/sys/kernel/random/boot_id')
+            self.assertEqual(adb.android_getprop(u'sys.boot_completed', device=SERIAL), u'0')
+            self.assertEqual(self.server.requests[-1],
+                             u"shell:cat /proc/sys/kernel/random/boot_id; getprop 'sys.boot_completed'")
+            request_num = len(self.server.requests)
+            self.assertEqual(adb.android_getprop(u'sys.boot_completed', device=SERIAL), u'0')
+            self.assertEqual(adb.android_getprop(u'ro.build.version.sdk', device=SERIAL), u'28')
+            self.assertEqual(len(self.server.requests), request_num)
+            # All keys after ttl reload whole snapshot
+            time.sleep(0.3)
+            self.assertEqual(adb.android_getprop_all(device=SERIAL)[u'sys.boot_completed'], u'1')
+            self.assertEqual(self.server.requests[-1], u'shell:cat /proc/sys/kernel/random/boot_id; getprop')
+            # reboot drop snapshot
+            self.assertTrue(SERIAL in adb._props)
+            adb.reboot(device=SERIAL)
+            self.assertFalse(SERIAL in adb._props)
+        finally:
+            os.environ['PATH'] = path
+
+    def test_device_profile(self):
+        adb = AdbAuto(adb_file=self.adb_file, logger=quiet_logger(), adb_server_port=self.server.port,
+                      use_server_socket=True, server_pool_size=0)
+        adb.file_exist(u'/', device=SERIAL)
+        self.assertTrue(u'shell:id' in self.server.requests)
+        # Probed once, file_exist is one shell command after that
+        request_num = len(self.server.requests)
+        self.assertTrue(adb.file_exist(u'/', device=SERIAL))
+        self.assertFalse(adb.file_exist(u'/no_such_file', device=SERIAL))
+        self.assertEqual([request for request in self.server.requests[request_num:]
+                          if not request.startswith(u'host')],
+                         [u'shell,v2,raw:ls -d \'/\'', u'shell,v2,raw:ls -d \'/no_such_file\''])
+        # reboot drop probed root state
+        self.assertTrue(adb.device_profile(SERIAL).root is not None)
+        adb.reboot(device=SERIAL)
+        self.assertTrue(adb.device_profile(SERIAL).root is None)
+        # Device used by many threads at the same time is still probed once
+        request_num = len(self.server.requests)
+        results = run_all(lambda num: adb.is_root(device=SERIAL), list(range(8)), max_workers=8)
+        self.assertEqual(list(results.failed), [])
+        self.assertEqual(self.server.requests[request_num:].count(u'shell:id'), 1)
+
+    def test_file_stat_many(self):
+        adb = AdbAuto(adb_file=self.adb_file, logger=quiet_logger(), adb_server_port=self.server.port,
+                      use_server_socket=True)
+        folder = tempfile.mkdtemp(dir=self.folder)
+        paths = [os.path.join(folder, name) for name in (u'a', u'b c', u"it's")]
+        for path in paths:
+            with open(path, 'wb') as f:
+                f.write(b'12345')
+        missing = os.path.join(folder, u'missing')
+        stats = adb.file_stat_many(paths + [folder, missing], device=SERIAL)
+        self.assertEqual(list(stats), paths + [folder, missing])
+        self.assertEqual([stats[path].size for path in paths], [5, 5, 5])
+        self.assertTrue(stats[paths[0]].isfile() and stats[folder].isdir())
+        self.assertEqual(stats[paths[0]].mtime, int(os.stat(paths[0]).st_mtime))
+        self.assertEqual(stats[paths[0]].mode, os.stat(paths[0]).st_mode)
+        self.assertTrue(stats[missing] is None)
+        self.assertTrue(adb.device_profile(SERIAL).stat_format)
+        self.assertEqual(dict(adb.file_exist(paths + [missing], device=SERIAL)),
+                         dict([(path, True) for path in paths] + [(missing, False)]))
+        # Fall back to ls -ld, GNU ls print time as 2020-01-01 00:00 by TIME_STYLE
+        adb.device_profile(SERIAL).stat_format = False
+        adb.device_profile(SERIAL).ls_context = False
+        os.environ['TIME_STYLE'] = 'long-iso'
+        try:
+            stats_ls = adb.file_stat_many(paths[:2] + [missing], device=SERIAL)
+        finally:
+            del os.environ['TIME_STYLE']
+        for path in paths[:2]:
+            self.assertEqual((stats_ls[path].size, stats_ls[path].mode), (5, stats[path].mode))
+            self.assertEqual(stats_ls[path].mtime // 60, stats[path].mtime // 60)
+        self.assertTrue(stats_ls[missing] is None)
+        adb.file_remove(paths, device=SERIAL)
+        self.assertFalse(any(os.path.exists(path) for path in paths))
+
+    def test_file_stat_many_batches(self):
+        adb = AdbAuto(adb_file=self.adb_file, logger=quiet_logger(), adb_server_port=self.server.port,
+                      use_server_socket=True, server_pool_size=0)
+        folder = tempfile.mkdtemp(dir=self.folder)
+        paths = [os.path.join(folder, u'{:03d}_'.format(num) + u'x' * 40) for num in range(300)]
+        for path in paths:
+            open(path, 'wb').close()
+        adb.file_stat_many(paths[:1], device=SERIAL)
+        del self.server.requests[:]
+        stats = adb.file_stat_many(paths, device=SERIAL)
+        self.assertTrue(all(stats[path] is not None for path in paths))
+        shells = [req for req in self.server.requests if req.startswith(u'shell')]
+        # Every command fit in adb service payload of old adbd
+        self.assertTrue(len(shells) > 1 and all(len(req.encode('UTF-8')) < 4096 for req in shells))
+        self.assertTrue(all(adb.file_exist(paths, device=SERIAL).values()))
+        adb.file_remove(paths, device=SERIAL)
+        self.assertFalse(any(os.path.exists(path) for path in paths))
+
+    def test_walk(self):
+        adb = AdbAuto(adb_file=self.adb_file, logger=quiet_logger(), adb_server_port=self.server.port,
+                      use_server_socket=True)
+        folder = tempfile.mkdtemp(dir=self.folder)
+        os.makedirs(os.path.join(folder, u'sub', u'deep'))
+        for name in (u'a', os.path.join(u'sub', u'b c'), os.path.join(u'sub', u'deep', u'.hidden')):
+            with open(os.path.join(folder, name), 'wb') as f:
+                f.write(b'123')
+        expected = set(os.path.join(folder, name) for name in (u'a', u'sub', u'sub/b c', u'sub/deep',
+                                                               u'sub/deep/.hidden'))
+        stats = list(adb.walk(folder, device=SERIAL))
+        self.assertEqual(set(stat.path for stat in stats), expected)
+        self.assertTrue(all(stat.isdir() == os.path.isdir(stat.path) for stat in stats))
+        self.assertEqual(sum(1 for request in self.server.requests if u'find ' in request), 1)
+        # Fall back to ls -laR
+        adb.device_profile(SERIAL).stat_format = False
+        adb.device_profile(SERIAL).ls_context = False
+        os.environ['TIME_STYLE'] = 'long-iso'
+        try:
+            stats_ls = list(adb.walk(folder + u'/', device=SERIAL))
+        finally:
+            del os.environ['TIME_STYLE']
+        self.assertEqual(set(stat.path for stat in stats_ls), expected)
+        self.assertEqual(dict((stat.path, stat.size) for stat in stats_ls if stat.isfile()),
+                         dict((stat.path, stat.size) for stat in stats if stat.isfile()))
+
+    def test_sync_push(self):
+        adb = AdbAuto(adb_file=self.adb_file, logger=quiet_logger(), adb_server_port=self.server.port,
+                      use_server_socket=True, server_pool_size=0)
+        self.server.sync_local = True
+        local = tempfile.mkdtemp(dir=self.folder)
+        remote = os.path.join(tempfile.mkdtemp(dir=self.folder), u'remote')
+        os.makedirs(os.path.join(local, u'sub'))
+        for name, content in ((u'a', b'aaa'), (u'sub/b', b'bbbb'), (u'sub/c c', b'ccccc')):
+            with open(os.path.join(local, name), 'wb') as f:
+                f.write(content)
+        result = adb.sync_push(local, remote, device=SERIAL)
+        self.assertEqual(sorted(result.pushed), [remote + u'/a', remote + u'/sub/b', remote + u'/sub/c c'])
+        self.assertEqual((result.bytes_sent, result.bytes_saved), (12, 0))
+        with open(os.path.join(remote, u'sub', u'c c'), 'rb') as f:
+            self.assertEqual(f.read(), b'ccccc')
+        # Nothing changed: no transfer
+        sync_count = self.server.requests.count(u'sync:')
+        result = adb.sync_push(local, remote, device=SERIAL)
+        self.assertEqual((result.pushed, len(result.skipped), result.bytes_saved), ([], 3, 12))
+        self.assertEqual(self.server.requests.count(u'sync:'), sync_count)
+        # Size changed / same content with new mtime / same size with new content, and extra remote file
+        with open(os.path.join(local, u'a'), 'wb') as f:
+            f.write(b'aaaa')
+        os.utime(os.path.join(local, u'sub', u'b'), (1000000, 1000000))
+        with open(os.path.join(local, u'sub', u'c c'), 'wb') as f:
+            f.write(b'CCCCC')
+        os.utime(os.path.join(local, u'sub', u'c c'), (1000000, 1000000))
+        os.makedirs(os.path.join(remote, u'extra'))
+        with open(os.path.join(remote, u'extra', u'x'), 'wb') as f:
+            f.write(b'x')
+        result = adb.sync_push(local, remote, device=SERIAL, delete=True)
+        self.assertEqual(sorted(result.pushed), [remote + u'/a', remote + u'/sub/c c'])
+        self.assertEqual(result.skipped, [remote + u'/sub/b'])
+        self.assertEqual(result.deleted, [remote + u'/extra'])
+        self.assertFalse(os.path.exists(os.path.join(remote, u'extra')))
+        with open(os.path.join(remote, u'sub', u'c c'), 'rb') as f:
+            self.assertEqual(f.read(), b'CCCCC')
+
+    def test_pull_resume(self):
+        adb = AdbAuto(adb_file=self.adb_file, logger=quiet_logger(), adb_server_port=self.server.port,
+                      use_server_socket=True)
+        remote = os.path.join(tempfile.mkdtemp(dir=self.folder), u'big.bin')
+        content = os.urandom(1000000)
+        with open(remote, 'wb') as f:
+            f.write(content)
+        local = tempfile.mkdtemp(dir=self.folder)
+        # Device lost after 3 chunks, progress is kept
+        exec_out = adb.exec_out
+        calls = []
+
+        def flaky_exec_out(*args, **kwargs):
+            calls.append(args)
+            if len(calls) > 3:
+                raise AdbNoDevice(u'device lost', u'', u'')
+            return exec_out(*args, **kwargs)
+        adb.exec_out = flaky_exec_out
+        with self.assertRaises(AdbNoDevice):
+            adb.pull_resume(remote, local, device=SERIAL, chunk_size=100000, retry_times=1)
+        self.assertEqual(len(calls), 3 + 1)
+        with open(os.path.join(local, u'big.bin.adbpart.json')) as f:
+            self.assertEqual(json.load(f)[u'done'], 3)
+        # Give up after retry_times fails in a row
+        del calls[:]
+        with self.assertRaises(AdbNoDevice):
+            adb.pull_resume(remote, local, device=SERIAL, chunk_size=100000, retry_times=2)
+        self.assertEqual(len(calls), 3 + 2)
+        with open(os.path.join(local, u'big.bin.adbpart.json')) as f:
+            self.assertEqual(json.load(f)[u'done'], 6)
+        # Continue from chunk 6
+        adb.exec_out = exec_out
+        exec_count = sum(1 for request in self.server.requests if request.startswith(u'exec:dd'))
+        self.assertEqual(adb.pull_resume(remote, local, device=SERIAL, chunk_size=100000),
+                         os.path.join(local, u'big.bin'))
+        self.assertEqual(sum(1 for request in self.server.requests if request.startswith(u'exec:dd')) - exec_count, 4)
+        with open(os.path.join(local, u'big.bin'), 'rb') as f:
+            self.assertEqual(f.read(), content)
+        self.assertEqual(sorted(os.listdir(local)), [u'big.bin'])
+        # Pulled data broken between calls, found by md5 of whole file and dropped
+        del calls[:]
+        adb.exec_out = flaky_exec_out
+        with self.assertRaises(AdbNoDevice):
+            adb.pull_resume(remote, local, device=SERIAL, chunk_size=100000, retry_times=1)
+        with open(os.path.join(local, u'big.bin.adbpart'), 'r+b') as f:
+            f.write(b'x' if content[:1] != b'x' else b'y')
+        adb.exec_out = exec_out
+        with self.assertRaises(AdbFailException) as cm:
+            adb.pull_resume(remote, local, device=SERIAL, chunk_size=100000)
+        self.assertEqual(cm.exception.msg, u'md5 check fail')
+        self.assertEqual(sorted(os.listdir(local)), [u'big.bin'])
+        with self.assertRaises(AdbFailException) as cm:
+            adb.pull_resume(remote + u'.missing', local, device=SERIAL)
+        self.assertEqual(cm.exception.msg, NOFILEORFOLDER)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+import unittest
+import sys
+import os
+import shutil
+import tempfile
+import time
+
+sys.path.insert(1, os.path.abspath(os.path.join(os.path.dirname(__file__), '../')))
+from adb_wrapper.adb_wrapper import AdbNoDevice, AdbTimeout
+from tests.fake_adb_server import FakeAdbServer
+from tests.test_base import fake_adb_create, quiet_logger
+
+if sys.version_info >= (3, 7):
+    import asyncio
+    from adb_wrapper.async_adb import AsyncAdbWrapper, AsyncAdbAuto
+
+SERIAL = u'emulator-5554'
+
+
+@unittest.skipIf(sys.version_info < (3, 7) or sys.platform == 'win32', 'asyncio.run and POSIX fake adb needed')
+class AsyncAdbWrapperTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.folder = tempfile.mkdtemp()
+        cls.adb_file = fake_adb_create(cls.folder)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.folder)
+
+    def setUp(self):
+        self.server = FakeAdbServer().start()
+        self.server.devices[SERIAL] = 'device'
+
+    def tearDown(self):
+        self.server.stop()
+
+    def adb(self, cls=None, use_server_socket=False):
+        return (cls or AsyncAdbWrapper)(adb_file=self.adb_file, logger=quiet_logger(),
+                                        adb_server_port=self.server.port, use_server_socket=use_server_socket)
+
+    def test_shell(self):
+        adb = self.adb()
+        self.assertEqual(asyncio.run(adb.shell(u'echo 中文', device=SERIAL)), (u'中文', u''))
+        self.assertEqual(asyncio.run(adb.shell_status(u'echo out; false', device=SERIAL)), (u'out', u'', 1))
+        self.assertEqual(bytes(asyncio.run(adb.exec_out(u'printf "\\001\\002"', device=SERIAL))), b'\x01\x02')
+        self.assertEqual(asyncio.run(adb.shell_batch([u'echo a', u'echo e >&2; false'], device=SERIAL)),
+                         [(u'a', u'', 0), (u'', u'e', 1)])
+
+    def test_concurrent_shell(self):
+        adb = self.adb()
+
+        async def run_all():
+            return await asyncio.gather(*[adb.shell(u'sleep 0.5; echo {}'.format(num), device=SERIAL)
+                                          for num in range(20)])
+        start_time = time.time()
+        results = asyncio.run(run_all())
+        self.assertEqual([stdout for stdout, _ in results], [u'{}'.format(num) for num in range(20)])
+        self.assertTrue(time.time() - start_time < 5)
+
+    def test_timeout(self):
+        with self.assertRaises(AdbTimeout):
+            asyncio.run(self.adb().shell(u'sleep 10', device=SERIAL, timeout=0.5))
+
+    def test_pipe_held_by_child(self):
+        adb = self.adb()
+        for timeout in (None, 4):
+            start_time = time.time()
+            self.assertEqual(asyncio.run(adb._command_async(['daemon', '5'], timeout=timeout)),
+                             (u'daemon started', u''))
+            self.assertTrue(time.time() - start_time < 3)
+
+    def test_nodevice(self):
+        with self.assertRaises(AdbNoDevice):
+            asyncio.run(self.adb().shell(u'id', device=u'nodevice'))
+
+    def test_shell_iter(self):
+        adb = self.adb()
+
+        async def first_lines():
+            result = []
+            async for line in adb.shell_iter(u'seq 1 100000', device=SERIAL):
+                result.append(line)
+                if len(result) == 3:
+                    break
+            return result
+        self.assertEqual(asyncio.run(first_lines()), [u'1', u'2', u'3'])
+
+    def test_shell_iter_nodevice(self):
+        adb = self.adb()
+
+        async def read_all():
+            return [line async for line in adb.shell_iter(u'echo 1', device=u'waiting')]
+        start_time = time.time()
+        with self.assertRaises(AdbNoDevice):
+            asyncio.run(read_all())
+        self.assertTrue(time.time() - start_time < 5)
+
+    def test_subproc_list(self):
+        adb = self.adb()
+        count = len(adb.subproc_list)
+        asyncio.run(adb.shell(u'echo 1', device=SERIAL))
+        self.assertEqual(len(adb.subproc_list), count + 1)
+        self.assertEqual(adb.subproc_list[-1].returncode, 0)
+
+    def test_server_socket(self):
+        adb = self.adb(use_server_socket=True)
+        self.assertEqual(asyncio.run(adb.devices()), {SERIAL: u'device'})
+        self.assertEqual(asyncio.run(adb.shell(u'echo a b', device=SERIAL)), (u'a b', u''))
+        self.assertEqual(asyncio.run(adb.shell_status(u'echo out; echo err >&2; exit 3', device=SERIAL)),
+                         (u'out', u'err', 3))
+        with self.assertRaises(AdbNoDevice):
+            asyncio.run(adb.shell(u'id', device=u'no_such_device'))
+
+    def test_auto(self):
+        adb = self.adb(AsyncAdbAuto, use_server_socket=True)
+        self.assertEqual(asyncio.run(adb.shell_auto(u'echo 1', device=SERIAL)), (u'1', u''))
+        # Same connect_auto state cache as AdbAuto
+        self.assertEqual(asyncio.run(adb.connect_auto(device=SERIAL)), SERIAL)
+        self.assertEqual(self.server.requests.count(u'host:devices'), 1)
+        self.assertEqual(asyncio.run(adb.run_auto('file_exist', [u'/', u'/no_such_file'], device=SERIAL)),
+                         {u'/': True, u'/no_such_file': False})
+
+if __name__ == '__main__':
+    unittest.main()
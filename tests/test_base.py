@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+import unittest
+import sys
+import os
+import time
+import shutil
+import tempfile
+import logging
+import threading
+
+sys.path.insert(1, os.path.abspath(os.path.join(os.path.dirname(__file__), '../')))
+from adb_wrapper.adb_wrapper import AdbWrapper
+from adb_wrapper.adb_wrapper import AdbNoDevice, AdbTimeout, AdbFailException
+from adb_wrapper.base_wrapper import SubprocessException, NoDeviceException
+from adb_wrapper.base_wrapper import TIMEOUT, NOFILEORFOLDER
+from adb_wrapper.base_wrapper import SELECTABLE_PIPE
+from adb_wrapper.base_wrapper import NoDeviceMatcher
+from adb_wrapper.adb_fleet import AdbFleet, run_all
+
+
+def fake_adb_create(folder):
+    '''
+    Create executable fake adb in folder, return its path
+    '''
+    adb_file = os.path.join(folder, 'adb')
+    with open(os.path.join(os.path.dirname(__file__), 'fake_adb.py')) as src:
+        content = src.read()
+    with open(adb_file, 'w') as dst:
+        dst.write('#!{}\n'.format(sys.executable))
+        dst.write(content)
+    os.chmod(adb_file, 0o755)
+    return adb_file
+
+
+def quiet_logger():
+    '''
+    Logger without output for tests
+    '''
+    logger = logging.getLogger('adb_test')
+    if not logger.handlers:
+        logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+    return logger
+
+
+@unittest.skipIf(sys.platform == 'win32', 'fake adb need POSIX shebang')
+class CommandBlockingTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.folder = tempfile.mkdtemp()
+        cls.adb = AdbWrapper(adb_file=fake_adb_create(cls.folder), logger=quiet_logger())
+
+    @classmethod
+    def tearDownClass(cls):
+        del cls.adb
+        shutil.rmtree(cls.folder)
+
+    def test_version(self):
+        self.assertEqual(self.adb.binary_version, u'1.0.32')
+
+    def test_output(self):
+        stdout, stderr = self.adb._command_blocking(['hello', u'中文'])
+        self.assertEqual(stdout, u'hello 中文')
+        self.assertEqual(stderr, u'')
+
+    def test_big_output(self):
+        stdout, stderr = self.adb._command_blocking(['big', '1000000'])
+        self.assertEqual(len(stdout), 1000000)
+        self.assertEqual(len(stderr), 1000000)
+
+    def test_pipe_held_by_child(self):
+        start_time = time.time()
+        self.assertEqual(self.adb._command_blocking(['daemon', '5'], timeout=None), (u'daemon started', u''))
+        self.assertTrue(time.time() - start_time < 3)
+
+    def test_no_nodevice_pattern(self):
+        # Wrapper without nodevice_re_list (such as AaptWrapper), stderr is never no device
+        class NoPatternWrapper(AdbWrapper):
+            nodevice_re_list = []
+        adb = NoPatternWrapper(adb_file=self.adb._binary, logger=quiet_logger())
+        self.assertEqual(adb._command_blocking(['-s', 'serial', 'shell', 'echo out; echo warn >&2']),
+                         (u'out', u'warn'))
+        self.assertFalse(adb._nodevice_check(u'warn'))
+        self.assertFalse(NoDeviceMatcher(None).feed(b'warn'))
+
+    def test_raw(self):
+        stdout, stderr = self.adb._command_blocking(['big', '1000000'], raw=True)
+        self.assertTrue(isinstance(stdout, memoryview))
+        self.assertEqual(stdout.tobytes(), b'x' * 1000000)
+        self.assertEqual(len(stderr), 1000000)
+        stdout = self.adb.exec_out(u"printf '\\000\\377\\r\\n'", device='serial')
+        self.assertEqual(stdout.tobytes(), b'\x00\xff\r\n')
+
+    def test_timeout(self):
+        start_cpu = time.process_time() if hasattr(time, 'process_time') else time.clock()
+        with self.assertRaises(SubprocessException) as cm:
+            self.adb._command_blocking(['sleep', '3'], timeout=1)
+        self.assertEqual(cm.exception.msg, TIMEOUT)
+        end_cpu = time.process_time() if hasattr(time, 'process_time') else time.clock()
+        # Waiting should not busy loop
+        self.assertLess(end_cpu - start_cpu, 0.5)
+
+    def test_nodevice(self):
+        start_time = time.time()
+        with self.assertRaises(NoDeviceException):
+            self.adb._command_blocking(['nodevice'])
+        self.assertLess(time.time() - start_time, 5)
+
+    def test_nodevice_matcher(self):
+        matcher = self.adb._nodevice_matcher()
+        self.assertTrue(isinstance(matcher, NoDeviceMatcher))
+        for _ in range(10000):
+            self.assertFalse(matcher.feed(b'[ 10%] /sdcard/file: 1024 bytes\n'))
+        # Pattern split across chunks, and multi-bytes char split too
+        self.assertFalse(matcher.feed(b'\xe4\xb8'))
+        self.assertFalse(matcher.feed(b'\xad error: device emu'))
+        self.assertTrue(matcher.feed(b'lator-5554 not found\n'))
+
+    @unittest.skipIf(not SELECTABLE_PIPE, 'IOReactor need selectable pipe')
+    def test_reactor_thread_count(self):
+        self.adb._command_blocking(['hello'])
+        thread_num = threading.active_count()
+        workers = [threading.Thread(target=self.adb._command_blocking, args=(['sleep', '1'],))
+                   for _ in range(10)]
+        for worker in workers:
+            worker.start()
+        time.sleep(0.5)
+        # Only 10 caller threads, no reader thread for each command
+        self.assertEqual(threading.active_count(), thread_num + 10)
+        for worker in workers:
+            worker.join()
+
+
+@unittest.skipIf(sys.platform == 'win32', 'fake adb need POSIX shebang')
+class ShellSessionTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.folder = tempfile.mkdtemp()
+        cls.adb = AdbWrapper(adb_file=fake_adb_create(cls.folder), logger=quiet_logger())
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.adb.shell_session_close()
+        del cls.adb
+        shutil.rmtree(cls.folder)
+
+    def test_run(self):
+        session = self.adb.shell_session(device='serial')
+        self.assertEqual(session.run(u'echo 中文'), (u'中文', u'', 0))
+        self.assertEqual(session.run(u'echo out; echo err >&2; false'), (u'out', u'err', 1))
+        self.assertEqual(session.run(u'cat; echo done'), (u'done', u'', 0))
+        for num in range(100):
+            self.assertEqual(session.run(u'echo {}'.format(num))[0], u'{}'.format(num))
+        self.assertTrue(self.adb.shell_session(device='serial') is session)
+
+    def test_broken(self):
+        session = self.adb.shell_session(device='serial')
+        with self.assertRaises(AdbTimeout):
+            session.run(u'sleep 3', timeout=0.5)
+        self.assertFalse(session.isalive())
+        session = self.adb.shell_session(device='serial')
+        with self.assertRaises(AdbFailException):
+            session.run(u'exit 3')
+        session = self.adb.shell_session(device='serial')
+        self.assertEqual(session.run(u'echo ok'), (u'ok', u'', 0))
+
+    def test_nodevice(self):
+        with self.assertRaises(AdbNoDevice):
+            self.adb.shell_session(device='nodevice')
+
+
+@unittest.skipIf(sys.platform == 'win32', 'fake adb need POSIX shebang')
+class ShellIterTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.folder = tempfile.mkdtemp()
+        cls.adb = AdbWrapper(adb_file=fake_adb_create(cls.folder), logger=quiet_logger())
+
+    @classmethod
+    def tearDownClass(cls):
+        del cls.adb
+        shutil.rmtree(cls.folder)
+
+    def test_lines(self):
+        self.assertEqual(list(self.adb.shell_iter(u'seq 1 3; printf 中文', device='serial')),
+                         [u'1', u'2', u'3', u'中文'])
+        self.assertEqual(b''.join(self.adb.shell_iter(u'seq 1 3', device='serial', lines=False)), b'1\n2\n3\n')
+
+    def test_stop_early(self):
+        lines = self.adb.shell_iter(u'yes', device='serial')
+        self.assertEqual(next(lines), u'y')
+        lines.close()
+        process = self.adb.subproc_list[-1]
+        self.assertTrue(process.poll() is not None)
+
+    def test_timeout(self):
+        lines = self.adb.shell_iter(u'echo first; sleep 3', device='serial', timeout=1)
+        self.assertEqual(next(lines), u'first')
+        with self.assertRaises(AdbTimeout):
+            next(lines)
+
+
+@unittest.skipIf(sys.platform == 'win32', 'fake adb need POSIX shebang')
+class ShellBatchTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.folder = tempfile.mkdtemp()
+        cls.adb = AdbWrapper(adb_file=fake_adb_create(cls.folder), logger=quiet_logger())
+
+    @classmethod
+    def tearDownClass(cls):
+        del cls.adb
+        shutil.rmtree(cls.folder)
+
+    def test_batch(self):
+        cmds = [u'echo a', u'printf b; echo e >&2; false', u'cd /; pwd', u'echo 中文; exit 3', u'echo never']
+        self.assertEqual(self.adb.shell_batch(cmds, device='serial'),
+                         [(u'a', u'', 0), (u'b', u'e', 1), (u'/', u'', 0), (u'中文', u'', None), (u'', u'', None)])
+        # Long batch is split into more scripts
+        results = self.adb.shell_batch([u'echo {}'.format(num) for num in range(300)], device='serial')
+        self.assertEqual(results, [(u'{}'.format(num), u'', 0) for num in range(300)])
+
+
+@unittest.skipIf(sys.platform == 'win32', 'fake adb need POSIX shebang')
+class TarTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.folder = tempfile.mkdtemp()
+        cls.adb = AdbWrapper(adb_file=fake_adb_create(cls.folder), logger=quiet_logger())
+
+    @classmethod
+    def tearDownClass(cls):
+        del cls.adb
+        shutil.rmtree(cls.folder)
+
+    def test_tar(self):
+        local = tempfile.mkdtemp(dir=self.folder)
+        os.makedirs(os.path.join(local, u'tree', u'sub'))
+        for name in (u'a', u'sub/b c', u'sub/中文'):
+            with open(os.path.join(local, u'tree', name), 'wb') as f:
+                f.write(name.encode('UTF-8') * 100)
+        remote = os.path.join(self.folder, u'remote')
+        for compress in (False, True):
+            files = self.adb.push_tar(os.path.join(local, u'tree'), remote, device='serial', compress=compress)
+            self.assertEqual(sorted(files), sorted(remote + u'/tree/' + name for name in (u'a', u'sub/b c', u'sub/中文')))
+            pulled = tempfile.mkdtemp(dir=self.folder)
+            files = self.adb.pull_tar(remote + u'/tree/', pulled, device='serial', compress=compress)
+            self.assertEqual(len(files), 3)
+            with open(os.path.join(pulled, u'tree', u'sub', u'中文'), 'rb') as f:
+                self.assertEqual(f.read(), u'sub/中文'.encode('UTF-8') * 100)
+        with self.assertRaises(AdbFailException) as cm:
+            self.adb.pull_tar(remote + u'/no_such', pulled, device='serial')
+        self.assertEqual(cm.exception.msg, NOFILEORFOLDER)
+
+
+@unittest.skipIf(sys.platform == 'win32', 'fake adb need POSIX shebang')
+class StreamTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.folder = tempfile.mkdtemp()
+        cls.adb = AdbWrapper(adb_file=fake_adb_create(cls.folder), logger=quiet_logger())
+
+    @classmethod
+    def tearDownClass(cls):
+        del cls.adb
+        shutil.rmtree(cls.folder)
+
+    def test_bytes(self):
+        remote = os.path.join(self.folder, u'bytes', u'blob')
+        data = os.urandom(200000)
+        self.assertEqual(self.adb.push_bytes(data, remote, device='serial'), 200000)
+        self.assertEqual(self.adb.pull_bytes(remote, device='serial'), data)
+        for small in (b'', b'x'):
+            self.adb.push_bytes(small, remote, device='serial')
+            self.assertEqual(self.adb.pull_bytes(remote, device='serial'), small)
+        with self.assertRaises(AdbFailException) as cm:
+            self.adb.pull_bytes(remote + u'.missing', device='serial')
+        self.assertEqual(cm.exception.msg, NOFILEORFOLDER)
+
+
+@unittest.skipIf(sys.platform == 'win32', 'fake adb need POSIX shebang')
+class FleetTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.folder = tempfile.mkdtemp()
+        cls.adb = AdbWrapper(adb_file=fake_adb_create(cls.folder), logger=quiet_logger())
+
+    @classmethod
+    def tearDownClass(cls):
+        del cls.adb
+        shutil.rmtree(cls.folder)
+
+    def test_map(self):
+        devices = [u'serial{}'.format(num) for num in range(8)] + [u'nodevice']
+        fleet = AdbFleet(devices, adb=self.adb, max_workers=len(devices))
+        start_time = time.time()
+        results = fleet.map('shell', u'sleep 1; echo $0', timeout=10)
+        # Concurrent, take time of the slowest device instead of the sum
+        self.assertTrue(time.time() - start_time < 5)
+        self.assertEqual(list(results), devices)
+        self.assertEqual(set(results.succeeded.values()), set([(u'sh', u'')]))
+        self.assertEqual(list(results.failed), [u'nodevice'])
+        self.assertTrue(isinstance(results[u'nodevice'].exception, AdbNoDevice))
+        with self.assertRaises(AdbNoDevice):
+            results.raise_first()
+        self.assertEqual(fleet.shell(u'echo 1')[u'serial0'].result, (u'1', u''))
+
+    def test_push_many(self):
+        src = os.path.join(self.folder, u'many_src')
+        with open(src, 'wb') as f:
+            f.write(os.urandom(200000))
+        remote = os.path.join(self.folder, u'many') + u'/'
+        results = AdbFleet([u'serial', u'nodevice'], adb=self.adb).push_many(src, remote)
+        self.assertEqual(results[u'serial'].result, 200000)
+        self.assertTrue(isinstance(results[u'nodevice'].exception, AdbNoDevice))
+        with open(os.path.join(remote, u'many_src'), 'rb') as f, open(src, 'rb') as f_src:
+            self.assertEqual(f.read(), f_src.read())
+
+    def test_run_all_bounded(self):
+        lock = threading.Lock()
+        running = [0, 0]  # current, max
+
+        def func(device):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.1)
+            with lock:
+                running[0] -= 1
+            return device
+        results = run_all(func, range(10), max_workers=3)
+        self.assertEqual([res.result for res in results.values()], list(range(10)))
+        self.assertEqual(running[1], 3)
+
+if __name__ == '__main__':
+    unittest.main()